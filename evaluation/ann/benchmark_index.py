@@ -0,0 +1,107 @@
+"""Benchmark ANN index types of feature store on a synthetic corpus.
+
+Report recall@k against exact `IndexFlat`, p50/p99 single query latency,
+build time and bytes per vector, for choosing `index_type` in config.ini.
+
+    python3 evaluation/ann/benchmark_index.py --num 200000 --dim 768
+"""
+import argparse
+import time
+
+import faiss
+import numpy as np
+
+from huixiangdou.primitive import Faiss, IndexConfig
+from huixiangdou.primitive.query import DistanceStrategy
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark ANN index types.')
+    parser.add_argument('--num', type=int, default=100000, help='Corpus size.')
+    parser.add_argument('--dim', type=int, default=768, help='Feature dimension, 768 for bce-embedding-base_v1.')
+    parser.add_argument('--queries', type=int, default=1000, help='Query number.')
+    parser.add_argument('--k', type=int, default=30, help='Recall@k, same as `Faiss.k`.')
+    parser.add_argument('--clusters', type=int, default=256, help='Topic number of synthetic corpus.')
+    parser.add_argument('--types', type=str, default=','.join(IndexConfig.TYPES), help='Comma separated index types.')
+    parser.add_argument('--ef_search', type=str, default='64,128,256', help='Comma separated HNSW efSearch to sweep.')
+    parser.add_argument('--nprobe', type=str, default='8,16,64', help='Comma separated IVF nprobe to sweep.')
+    parser.add_argument('--nlist', type=int, default=1024)
+    parser.add_argument('--pq_m', type=int, default=64)
+    parser.add_argument('--train_size', type=int, default=65536)
+    parser.add_argument('--threads', type=int, default=1, help='faiss OpenMP threads, 1 is close to serving.')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def synthetic(num: int, dim: int, clusters: int, rng: np.random.Generator) -> np.ndarray:
+    """Normalized vectors around random topic centers, like text embeddings."""
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, clusters, num)
+    features = centers[labels] + 0.6 * rng.standard_normal((num, dim)).astype(np.float32)
+    faiss.normalize_L2(features)
+    return features
+
+
+def recall(result: np.ndarray, truth: np.ndarray) -> float:
+    hits = [len(np.intersect1d(r, t)) for r, t in zip(result, truth)]
+    return float(np.mean(hits)) / truth.shape[1]
+
+
+def bench(name: str, dense: Faiss, queries: np.ndarray, truth: np.ndarray, k: int, build_time: float, **knob):
+    params = dense.search_params(**knob)
+    result = np.zeros((len(queries), k), dtype=np.int64)
+    costs = []
+    for i in range(len(queries)):
+        t = time.perf_counter()
+        if params is None:
+            _, indices = dense.index.search(queries[i:i + 1], k)
+        else:
+            _, indices = dense.index.search(queries[i:i + 1], k, params=params)
+        costs.append(time.perf_counter() - t)
+        result[i] = indices[0]
+
+    bytes_per_vector = len(faiss.serialize_index(dense.index)) / dense.index.ntotal
+    knob_str = ','.join('{}={}'.format(key, value) for key, value in knob.items() if value is not None)
+    print('{:<10} {:<14} {:>9.4f} {:>9.3f} {:>9.3f} {:>10.1f} {:>9.1f}'.format(
+        name, knob_str or '-', recall(result, truth), 1000 * np.percentile(costs, 50),
+        1000 * np.percentile(costs, 99), bytes_per_vector, build_time))
+
+
+def main():
+    args = parse_args()
+    faiss.omp_set_num_threads(args.threads)
+    rng = np.random.default_rng(args.seed)
+    corpus = synthetic(args.num, args.dim, args.clusters, rng)
+    queries = synthetic(args.queries, args.dim, args.clusters, rng)
+    ids = np.arange(args.num, dtype=np.int64)
+
+    exact = faiss.IndexFlatIP(args.dim)
+    exact.add(corpus)
+    _, truth = exact.search(queries, args.k)
+
+    print('{} vectors, dim {}, {} queries, recall@{}'.format(args.num, args.dim, args.queries, args.k))
+    print('{:<10} {:<14} {:>9} {:>9} {:>9} {:>10} {:>9}'.format(
+        'type', 'knob', 'recall', 'p50(ms)', 'p99(ms)', 'bytes/vec', 'build(s)'))
+    for index_type in args.types.split(','):
+        config = IndexConfig(index_type=index_type, nlist=args.nlist, pq_m=args.pq_m,
+                             train_size=args.train_size)
+        t = time.perf_counter()
+        index = Faiss.build_index(np_feature=corpus[0:args.train_size],
+                                  distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+                                  index_config=config)
+        index.add_with_ids(corpus, ids)
+        build_time = time.perf_counter() - t
+        dense = Faiss(index=index, chunks=[], strategy=DistanceStrategy.MAX_INNER_PRODUCT, index_config=config)
+
+        if index_type.startswith('hnsw'):
+            for ef_search in args.ef_search.split(','):
+                bench(index_type, dense, queries, truth, args.k, build_time, ef_search=int(ef_search))
+        elif index_type.startswith('ivf'):
+            for nprobe in args.nprobe.split(','):
+                bench(index_type, dense, queries, truth, args.k, build_time, nprobe=int(nprobe))
+        else:
+            bench(index_type, dense, queries, truth, args.k, build_time)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""Compare a new AsyncOpenAI client per request with the pooled client of
+`Backend`.
+
+A local OpenAI-compatible stand-in server answers chat completions after
+`--delay` seconds and counts accepted connections, so the cost of
+connection setup is measured without network noise:
+
+    python3 evaluation/llm_pool/benchmark_client.py --requests 512 --concurrency 16
+"""
+import argparse
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from openai import AsyncOpenAI
+
+from huixiangdou.services.llm import Backend
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        request = json.loads(body)
+        time.sleep(self.server.delay)
+        data = json.dumps({
+            'id': 'chatcmpl-stub',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request['model'],
+            'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': 'yes'}}],
+            'usage': {'prompt_tokens': 8, 'completion_tokens': 1, 'total_tokens': 9}
+        }).encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark LLM client connection pool.')
+    parser.add_argument('--requests', type=int, default=512)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--delay', type=float, default=0.01, help='Server side latency of each completion.')
+    parser.add_argument('--max_connections', type=int, default=64)
+    return parser.parse_args()
+
+
+async def run(args, backend: Backend, pooled: bool):
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+
+    async def one():
+        async with semaphore:
+            t = time.perf_counter()
+            if pooled:
+                client = backend.client()
+            else:
+                client = AsyncOpenAI(base_url=backend.base_url, api_key=backend.api_key, timeout=60)
+            await client.chat.completions.create(model='stub',
+                                                 messages=[{'role': 'user', 'content': 'Is it a question?'}],
+                                                 max_tokens=8)
+            latencies.append(time.perf_counter() - t)
+            if not pooled:
+                await client.close()
+
+    t = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(args.requests)])
+    cost = time.perf_counter() - t
+    await backend.close()
+    return np.array(latencies) * 1000, cost
+
+
+def main():
+    args = parse_args()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.delay = args.delay
+    server.connections = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:{}/v1'.format(server.server_address[1])
+
+    print('{} requests, concurrency {}, server delay {}ms'.format(args.requests, args.concurrency, args.delay * 1000))
+    print('{:<8} {:>10} {:>10} {:>10} {:>12} {:>12}'.format('client', 'p50 ms', 'p99 ms', 'req/s', 'connections',
+                                                         'reuse rate'))
+    for name, pooled in [('fresh', False), ('pooled', True)]:
+        backend = Backend(name='vllm', data={'remote_api_key': 'EMPTY', 'base_url': base_url,
+                                             'max_connections': args.max_connections})
+        server.connections = 0
+        latencies, cost = asyncio.run(run(args, backend, pooled=pooled))
+        reuse_rate = 1 - server.connections / args.requests
+        print('{:<8} {:>10.2f} {:>10.2f} {:>10.1f} {:>12} {:>12.3f}'.format(
+            name, np.percentile(latencies, 50), np.percentile(latencies, 99), args.requests / cost,
+            server.connections, reuse_rate))
+        if pooled:
+            # counted by the client, should match the server side
+            print('backend stats {}'.format(backend.reuse_stats()))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
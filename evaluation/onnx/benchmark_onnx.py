@@ -0,0 +1,106 @@
+"""Compare onnx backend with torch for bce text2vec and reranker.
+
+Report throughput and score drift of torch, onnx fp32 and onnx int8 on
+paragraphs of local markdown files, run on the CPU serving node:
+
+    python3 evaluation/onnx/benchmark_onnx.py --corpus_dir docs --work_dir workdir
+"""
+import argparse
+import os
+import time
+from typing import List
+
+import numpy as np
+
+from huixiangdou.primitive import Chunk, Embedder, LLMReranker
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark onnx backend.')
+    parser.add_argument('--embedding_model_path', type=str, default='maidalun1020/bce-embedding-base_v1')
+    parser.add_argument('--reranker_model_path', type=str, default='maidalun1020/bce-reranker-base_v1')
+    parser.add_argument('--corpus_dir', type=str, default='docs', help='Markdown files to sample paragraphs from.')
+    parser.add_argument('--work_dir', type=str, default='workdir', help='Exported onnx graphs are cached here.')
+    parser.add_argument('--num', type=int, default=512, help='Paragraph number.')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--intra_threads', type=int, default=0)
+    parser.add_argument('--rerank_topn', type=int, default=4)
+    return parser.parse_args()
+
+
+def load_paragraphs(corpus_dir: str, num: int) -> List[str]:
+    texts = []
+    for root, _, files in os.walk(corpus_dir):
+        for name in sorted(files):
+            if not name.endswith('.md'):
+                continue
+            with open(os.path.join(root, name), encoding='utf8', errors='ignore') as f:
+                texts += [p.strip()[0:1024] for p in f.read().split('\n\n') if len(p.strip()) > 16]
+            if len(texts) >= num:
+                return texts[0:num]
+    if len(texts) < 1:
+        raise ValueError('no paragraph found in {}'.format(corpus_dir))
+    return texts
+
+
+def build(args, backend: str, quantize: bool = True):
+    config = {
+        'embedding_model_path': args.embedding_model_path,
+        'reranker_model_path': args.reranker_model_path,
+        'model_backend': backend,
+        'work_dir': args.work_dir,
+        'onnx_quantize': quantize,
+        'onnx_intra_threads': args.intra_threads,
+        'onnx_batch_size': args.batch_size,
+        # measure the model, not the cache
+        'query_cache_size': 0
+    }
+    return Embedder(model_config=config), LLMReranker(model_config=config, topn=args.rerank_topn)
+
+
+def embed(embedder: Embedder, texts: List[str], batch_size: int):
+    t = time.perf_counter()
+    features = []
+    for start in range(0, len(texts), batch_size):
+        chunks = [Chunk(content_or_path=text) for text in texts[start:start + batch_size]]
+        features.append(embedder.embed_query_batch_text(chunks=chunks))
+    return np.concatenate(features), time.perf_counter() - t
+
+
+def rerank(reranker: LLMReranker, queries: List[str], texts: List[str]):
+    t = time.perf_counter()
+    orders = [list(reranker._sort(texts=texts, query=query)) for query in queries]
+    return orders, time.perf_counter() - t
+
+
+def main():
+    args = parse_args()
+    texts = load_paragraphs(args.corpus_dir, args.num)
+    # reranker queries use the first sentence of some paragraphs
+    queries = [text.split('\n')[0][0:64] for text in texts[0:16]]
+    candidates = texts[0:32]
+
+    rows = []
+    baseline = None
+    for name, backend, quantize in [('torch', 'torch', False), ('onnx fp32', 'onnx', False), ('onnx int8', 'onnx', True)]:
+        embedder, reranker = build(args, backend=backend, quantize=quantize)
+        embed(embedder, texts[0:args.batch_size], args.batch_size)  # warmup
+        features, embed_cost = embed(embedder, texts, args.batch_size)
+        orders, rerank_cost = rerank(reranker, queries, candidates)
+        if baseline is None:
+            baseline = (features, orders)
+
+        cosine = np.sum(features * baseline[0], axis=1)
+        overlap = np.mean([len(set(o) & set(b)) / len(b) for o, b in zip(orders, baseline[1])])
+        rows.append((name, len(texts) / embed_cost, cosine.min(), cosine.mean(), len(queries) / rerank_cost, overlap))
+        del embedder, reranker
+
+    print('{} paragraphs, batch size {}'.format(len(texts), args.batch_size))
+    print('{:<10} {:>12} {:>12} {:>12} {:>14} {:>14}'.format(
+        'backend', 'embed/s', 'min cosine', 'mean cosine', 'rerank q/s', 'top{} overlap'.format(args.rerank_topn)))
+    for row in rows:
+        print('{:<10} {:>12.1f} {:>12.4f} {:>12.4f} {:>14.2f} {:>14.3f}'.format(*row))
+
+
+if __name__ == '__main__':
+    main()
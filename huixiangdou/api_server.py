@@ -3,6 +3,7 @@ import argparse
 from .services import SerialPipeline, ParallelPipeline
 from .primitive import Query
 from fastapi import FastAPI
+from loguru import logger
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 import uvicorn
@@ -56,6 +57,13 @@ async def huixiangdou_inference(talk: Talk):
         return sentence
 
 
+@app.on_event('shutdown')
+async def shutdown():
+    if assistant is not None:
+        logger.info('LLM usage by task {}'.format(json.dumps(assistant.llm.task_report(), indent=2)))
+        await assistant.llm.close()
+
+
 @app.post("/huixiangdou_stream")
 async def huixiangdou_stream(talk: Talk):
     global assistant
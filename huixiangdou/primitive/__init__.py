@@ -1,10 +1,15 @@
 
 """primitive module."""
+from .batcher import MicroBatcher  # noqa E401
 from .chunk import Chunk  # noqa E401
+from .chunk_store import ChunkStore  # noqa E401
+from .doc_store import DocStore  # noqa E401
 from .embedder import Embedder  # noqa E401
-from .faiss import Faiss  # noqa E401
+from .embedding_cache import EmbeddingCache, QueryEmbeddingCache  # noqa E401
+from .faiss import Faiss, IndexConfig, ShardedFaiss  # noqa E401
 from .file_operation import FileName, FileOperation  # noqa E401
 from .llm_reranker import LLMReranker  # noqa E401
+from .partition_client import PartitionedFaiss  # noqa E401
 from .query import Query
 from .splitter import (
     CharacterTextSplitter,  # noqa E401
@@ -15,5 +20,5 @@ from .splitter import (
     nested_split_markdown, split_python_code)
 from .limitter import RPM, TPM
 from .bm250kapi import BM25Okapi
-from .entity import NamedEntity2Chunk
+from .entity import EntityAutomaton, EntityIndex, NamedEntity2Chunk
 from .utils import always_get_an_event_loop
@@ -0,0 +1,110 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, List
+
+import numpy as np
+from loguru import logger
+
+
+class MicroBatcher:
+    """Merge concurrent single-item calls into one batched call.
+
+    Callers block on `__call__`, a worker thread collects pending items
+    until `max_batch` items or `max_wait_ms` passed since the first one,
+    runs `batch_fn` once and resolves every caller with its own row.
+
+    Args:
+        batch_fn: Map a list of N items to np.ndarray with N rows.
+        max_batch: Max items in one call.
+        max_wait_ms: Max time the first item waits for others.
+
+    Example:
+
+        .. code-block:: python
+
+            batcher = MicroBatcher(lambda texts: model.encode(texts), max_batch=32, max_wait_ms=5)
+            # called from many threads
+            feature = batcher('how to install mmpose ?')
+    """
+
+    def __init__(self, batch_fn: Callable[[List[Any]], np.ndarray], max_batch: int = 32, max_wait_ms: float = 5):
+        self.batch_fn = batch_fn
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0, max_wait_ms) / 1000
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.closed = False
+        self.batches = 0
+        self.items = 0
+
+    def __call__(self, item: Any) -> np.ndarray:
+        return self.submit(item).result()
+
+    def submit(self, item: Any) -> Future:
+        future = Future()
+        # enqueue under the lock, the stop marker of `close` always comes last
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('micro batcher is closed')
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, name='micro_batcher', daemon=True)
+                self.thread.start()
+            self.queue.put((item, future))
+        return future
+
+    def close(self):
+        """Stop worker after pending items are processed, later submits raise."""
+        with self.lock:
+            self.closed = True
+            if self.thread is None:
+                return
+            self.queue.put(None)
+            thread = self.thread
+            self.thread = None
+        thread.join()
+
+    def _collect(self, first) -> List:
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    item = self.queue.get(timeout=timeout)
+                else:
+                    # take items already queued, never wait
+                    item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # stop after this batch
+                self.queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _loop(self):
+        while True:
+            first = self.queue.get()
+            if first is None:
+                return
+            batch = self._collect(first)
+            try:
+                outputs = self.batch_fn([item for item, _ in batch])
+            except Exception as e:
+                logger.error('micro batch of {} failed, {}'.format(len(batch), str(e)))
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.items += len(batch)
+            for i, (_, future) in enumerate(batch):
+                future.set_result(outputs[i:i + 1])
+
+    def summary(self) -> str:
+        return 'micro batcher {} items in {} batches, avg batch size {:.2f}'.format(
+            self.items, self.batches, self.items / max(1, self.batches))
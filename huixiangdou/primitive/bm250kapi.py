@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 # heavily modified from https://github.com/dorianbrown/rank_bm25/blob/master/rank_bm25.py
+import json
 import math
 import numpy as np
 import pickle as pkl
@@ -7,140 +8,272 @@ import os
 import jieba.analyse
 
 from loguru import logger
-from typing import List, Union
+from typing import Callable, Dict, List, Union
 from .chunk import Chunk
+from .chunk_store import ChunkStore
 
 """
 All of these algorithms have been taken from the paper:
 Trotmam et al, Improvements to BM25 and Language Models Examined
 
-Here we implement all the BM25 variations mentioned. 
+Here we implement all the BM25 variations mentioned.
 """
 
+
+def split_space(text: str) -> List[str]:
+    return text.split(' ')
+
+
+# tokenizer is saved by name, query must be tokenized same as corpus
+TOKENIZERS: Dict[str, Callable[[str], List[str]]] = {
+    'jieba_tags': jieba.analyse.extract_tags,
+    'split': split_space
+}
+
+
 class BM25Okapi:
-    def __init__(self, k1=1.5, b=0.75, epsilon=0.25):
+    """BM25 on CSR matrices.
+
+    Term frequency is kept document-major (`doc_indptr`, `doc_terms`,
+    `doc_tfs`) for incremental update. Precomputed BM25 weights are kept
+    term-major (`term_indptr`, `term_docs`, `term_weights`), so a query only
+    touches postings of its terms and scoring is one `np.bincount`.
+
+    Files in `filedir`:
+        bm25.json     parameters, tokenizer name and vocabulary
+        bm25.npz      CSR arrays and document length
+        chunks.*      `ChunkStore`
+    """
+
+    def __init__(self, k1=1.5, b=0.75, epsilon=0.25, tokenizer: str = 'jieba_tags'):
         # BM25Okapi parameters
         self.k1 = k1
         self.b = b
         self.epsilon = epsilon
 
-        # dump to pickle
         self.corpus_size = 0
         self.avgdl = 0
-        self.doc_freqs = []
-        self.idf = {}
-        self.doc_len = []
         self.average_idf = 0.0
         self.chunks = []
 
+        # term id is the index in `vocab`
+        self.vocab = []
+        self.term2id = dict()
+        self.idf = np.zeros(0, dtype=np.float64)
+        self.doc_len = np.zeros(0, dtype=np.int64)
+        self.doc_indptr = np.zeros(1, dtype=np.int64)
+        self.doc_terms = np.zeros(0, dtype=np.int64)
+        self.doc_tfs = np.zeros(0, dtype=np.float64)
+        self.term_indptr = np.zeros(1, dtype=np.int64)
+        self.term_docs = np.zeros(0, dtype=np.int64)
+        self.term_weights = np.zeros(0, dtype=np.float64)
+
         # option
-        self.tokenizer = jieba.analyse.extract_tags
+        self.tokenizer_name = tokenizer
+        self.tokenizer = TOKENIZERS[tokenizer]
 
-    def _initialize(self, corpus):
-        nd = {}  # word -> number of documents with word
-        num_doc = 0
-        for document in corpus:
-            self.doc_len.append(len(document))
-            num_doc += len(document)
+    def _tokenize_chunks(self, chunks: List[Chunk]):
+        filtered_corpus = []
+        for c in chunks:
+            content = c.content_or_path
+            # input str, output list of str
+            corpus = list(self.tokenizer(content))
+            if content not in corpus:
+                corpus.append(content)
+            filtered_corpus.append(corpus)
+        return filtered_corpus
 
+    def _append(self, corpus: List[List[str]]):
+        """Append tokenized documents as document-major term frequency rows."""
+        indptr = [len(self.doc_terms)]
+        terms = []
+        tfs = []
+        doc_len = []
+        for document in corpus:
             frequencies = {}
             for word in document:
-                if word not in frequencies:
-                    frequencies[word] = 0
-                frequencies[word] += 1
-            self.doc_freqs.append(frequencies)
+                term_id = self.term2id.get(word)
+                if term_id is None:
+                    term_id = len(self.vocab)
+                    self.term2id[word] = term_id
+                    self.vocab.append(word)
+                frequencies[term_id] = frequencies.get(term_id, 0) + 1
+            terms += frequencies.keys()
+            tfs += frequencies.values()
+            indptr.append(indptr[-1] + len(frequencies))
+            doc_len.append(len(document))
 
-            for word, freq in frequencies.items():
-                try:
-                    nd[word]+=1
-                except KeyError:
-                    nd[word] = 1
+        self.doc_terms = np.concatenate([self.doc_terms, np.array(terms, dtype=np.int64)])
+        self.doc_tfs = np.concatenate([self.doc_tfs, np.array(tfs, dtype=np.float64)])
+        self.doc_indptr = np.concatenate([self.doc_indptr, np.array(indptr[1:], dtype=np.int64)])
+        self.doc_len = np.concatenate([self.doc_len, np.array(doc_len, dtype=np.int64)])
 
-            self.corpus_size += 1
+    def _keep_docs(self, keep: np.ndarray):
+        """Drop document rows not in `keep`, then drop unused terms."""
+        counts = np.diff(self.doc_indptr)[keep]
+        mask = np.repeat(np.isin(np.arange(len(self.doc_len)), keep), np.diff(self.doc_indptr))
+        self.doc_terms = self.doc_terms[mask]
+        self.doc_tfs = self.doc_tfs[mask]
+        self.doc_indptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self.doc_len = self.doc_len[keep]
+
+        used = np.unique(self.doc_terms)
+        remap = np.full(len(self.vocab), -1, dtype=np.int64)
+        remap[used] = np.arange(len(used), dtype=np.int64)
+        self.doc_terms = remap[self.doc_terms]
+        self.vocab = [self.vocab[i] for i in used]
+        self.term2id = {word: i for i, word in enumerate(self.vocab)}
+
+    def _build(self):
+        """Calculate idf and term-major BM25 weights from term frequency."""
+        self.corpus_size = len(self.doc_len)
+        if self.corpus_size < 1:
+            self.avgdl = 0
+            self.average_idf = 0.0
+            self.idf = np.zeros(0, dtype=np.float64)
+            self.term_indptr = np.zeros(1, dtype=np.int64)
+            self.term_docs = np.zeros(0, dtype=np.int64)
+            self.term_weights = np.zeros(0, dtype=np.float64)
+            return
+        self.avgdl = float(self.doc_len.sum()) / self.corpus_size
+        self._calc_idf(np.bincount(self.doc_terms, minlength=len(self.vocab)))
 
-        self.avgdl = num_doc / self.corpus_size
-        return nd
+        doc_ids = np.repeat(np.arange(self.corpus_size, dtype=np.int64), np.diff(self.doc_indptr))
+        norm = self.k1 * (1 - self.b + self.b * self.doc_len / self.avgdl)
+        tf = self.doc_tfs
+        weights = self.idf[self.doc_terms] * (tf * (self.k1 + 1) / (tf + norm[doc_ids]))
 
-    def _tokenize_corpus(self, corpus):
-        tokenized_corpus = self.tokenizer(corpus)
-        return tokenized_corpus
+        order = np.argsort(self.doc_terms, kind='stable')
+        self.term_docs = doc_ids[order]
+        self.term_weights = weights[order]
+        self.term_indptr = np.concatenate([[0], np.cumsum(np.bincount(self.doc_terms, minlength=len(self.vocab)))]).astype(np.int64)
 
     def save(self, chunks:List[Chunk], filedir:str):
         # generate idf with corpus
         if len(chunks) < 1:
             return
         self.chunks = chunks
+        self._append(self._tokenize_chunks(chunks))
+        self._build()
+        self.dump(filedir)
 
-        filtered_corpus = []
-        for c in chunks:
-            content = c.content_or_path
-            if self.tokenizer is not None:
-                # input str, output list of str
-                corpus = self.tokenizer(content)
-                if content not in corpus:
-                    corpus.append(content)
-            else:
-                logger.warning('No tokenizer, use naive split')
-                corpus = content.split(' ')
-            filtered_corpus.append(corpus)
+    def update(self, chunks: List[Chunk], remove_sources: List[str] = []):
+        """Incremental update, remove chunks whose `metadata['source']` in
+        `remove_sources`, then add new chunks.
 
-        nd = self._initialize(filtered_corpus)
-        self._calc_idf(nd)
-        
-        # dump to `filepath`
-        data = {
+        Only new chunks are tokenized, idf is recalculated with saved
+        term frequency.
+        """
+        remove_sources = set(remove_sources)
+        if type(self.chunks) is ChunkStore:
+            sources = [self.chunks.source(i) for i in range(len(self.chunks))]
+        else:
+            sources = [c.metadata.get('source') for c in self.chunks]
+        keep = [i for i, source in enumerate(sources) if source not in remove_sources]
+        self.chunks = [self.chunks[i] for i in keep] + chunks
+        self._keep_docs(np.array(keep, dtype=np.int64))
+        self._append(self._tokenize_chunks(chunks))
+        self._build()
+
+    def dump(self, filedir: str):
+        logger.info('bm250kpi dump..')
+        if not os.path.exists(filedir):
+            os.makedirs(filedir)
+
+        # chunks are saved columnar, only top_n hits are loaded
+        ChunkStore.write(folder_path=filedir, chunks=self.chunks)
+        with open(os.path.join(filedir, 'bm25.npz.tmp'), 'wb') as f:
+            np.savez(f,
+                     idf=self.idf,
+                     doc_len=self.doc_len,
+                     doc_indptr=self.doc_indptr,
+                     doc_terms=self.doc_terms,
+                     doc_tfs=self.doc_tfs,
+                     term_indptr=self.term_indptr,
+                     term_docs=self.term_docs,
+                     term_weights=self.term_weights)
+        meta = {
+            'k1': self.k1,
+            'b': self.b,
+            'epsilon': self.epsilon,
+            'tokenizer': self.tokenizer_name,
             'corpus_size': self.corpus_size,
             'avgdl': self.avgdl,
-            'doc_freqs': self.doc_freqs,
-            'idf': self.idf,
-            'doc_len': self.doc_len,
             'average_idf': self.average_idf,
-            'chunks': chunks
+            'vocab': self.vocab
         }
-        logger.info('bm250kpi dump..')
-        # logger.info(data)
+        with open(os.path.join(filedir, 'bm25.json.tmp'), 'w', encoding='utf8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(os.path.join(filedir, 'bm25.npz.tmp'), os.path.join(filedir, 'bm25.npz'))
+        os.replace(os.path.join(filedir, 'bm25.json.tmp'), os.path.join(filedir, 'bm25.json'))
 
-        if not os.path.exists(filedir):
-            os.makedirs(filedir)
-        
-        filepath = os.path.join(filedir, 'bm25.pkl')
-        with open(filepath, 'wb') as f:
-            pkl.dump(data, f)
-
-    def load(self, filedir: str, tokenizer=None):
-        self.tokenizer = tokenizer
-        filepath = os.path.join(filedir, 'bm25.pkl')
-        with open(filepath, 'rb') as f:
+        legacy_path = os.path.join(filedir, 'bm25.pkl')
+        if os.path.exists(legacy_path):
+            os.remove(legacy_path)
+
+    @classmethod
+    def exists(cls, filedir: str) -> bool:
+        return os.path.exists(os.path.join(filedir, 'bm25.json')) or os.path.exists(os.path.join(filedir, 'bm25.pkl'))
+
+    def load(self, filedir: str, tokenizer: str = None):
+        """Load from `filedir`.
+
+        Args:
+            tokenizer: Override tokenizer name, default is the one used to
+                build the corpus.
+        """
+        json_path = os.path.join(filedir, 'bm25.json')
+        if not os.path.exists(json_path):
+            self._load_legacy(filedir)
+        else:
+            with open(json_path, encoding='utf8') as f:
+                meta = json.load(f)
+            self.k1 = meta['k1']
+            self.b = meta['b']
+            self.epsilon = meta['epsilon']
+            self.tokenizer_name = meta['tokenizer']
+            self.corpus_size = meta['corpus_size']
+            self.avgdl = meta['avgdl']
+            self.average_idf = meta['average_idf']
+            self.vocab = meta['vocab']
+            self.term2id = {word: i for i, word in enumerate(self.vocab)}
+            with np.load(os.path.join(filedir, 'bm25.npz')) as data:
+                for key in ['idf', 'doc_len', 'doc_indptr', 'doc_terms', 'doc_tfs',
+                            'term_indptr', 'term_docs', 'term_weights']:
+                    setattr(self, key, data[key])
+            self.chunks = ChunkStore(filedir)
+
+        if tokenizer is not None:
+            self.tokenizer_name = tokenizer
+        self.tokenizer = TOKENIZERS[self.tokenizer_name]
+
+    def _load_legacy(self, filedir: str):
+        """Convert old `bm25.pkl` with per-document dict, it was always built with jieba."""
+        with open(os.path.join(filedir, 'bm25.pkl'), 'rb') as f:
             data = pkl.load(f)
-        self.corpus_size = data['corpus_size']
-        self.avgdl = data['avgdl']
-        self.doc_freqs = data['doc_freqs']
-        self.idf = data['idf']
-        self.doc_len = data['doc_len']
-        self.average_idf = data['average_idf']
-        self.chunks = data['chunks']
-
-    def _calc_idf(self, nd):
+        if 'chunks' in data:
+            # old version pickles chunks
+            self.chunks = data['chunks']
+        else:
+            self.chunks = ChunkStore(filedir)
+        self.tokenizer_name = 'jieba_tags'
+        self._append([[word for word, freq in doc.items() for _ in range(freq)] for doc in data['doc_freqs']])
+        # legacy doc_len counts tokens of document
+        self.doc_len = np.array(data['doc_len'], dtype=np.int64)
+        self._build()
+
+    def _calc_idf(self, nd: np.ndarray):
         """
         Calculates frequencies of terms in documents and in corpus.
         This algorithm sets a floor on the idf values to eps * average_idf
         """
-        # collect idf sum to calculate an average idf for epsilon value
-        idf_sum = 0
-        # collect words with negative idf to set them a special epsilon value.
-        # idf can be negative if word is contained in more than half of documents
-        negative_idfs = []
-        for word, freq in nd.items():
-            idf = math.log(self.corpus_size - freq + 0.5) - math.log(freq + 0.5)
-            self.idf[word] = idf
-            idf_sum += idf
-            if idf < 0:
-                negative_idfs.append(word)
-        self.average_idf = idf_sum / len(self.idf)
-
+        # idf can be negative if word is contained in more than half of documents,
+        # set them a special epsilon value.
+        idf = np.log(self.corpus_size - nd + 0.5) - np.log(nd + 0.5)
+        self.average_idf = float(idf.mean()) if len(idf) > 0 else 0.0
         eps = self.epsilon * self.average_idf
-        for word in negative_idfs:
-            self.idf[word] = eps
+        idf[idf < 0] = eps
+        self.idf = idf
 
     def get_scores(self, query: List):
         """
@@ -152,39 +285,41 @@ class BM25Okapi:
         """
         if type(query) is not list:
             raise ValueError('query must be list, tokenize it byself.')
-        score = np.zeros(self.corpus_size)
-        doc_len = np.array(self.doc_len)
-        for q in query:
-            q_freq = np.array([(doc.get(q) or 0) for doc in self.doc_freqs])
-            score += (self.idf.get(q) or 0) * (q_freq * (self.k1 + 1) /
-                                               (q_freq + self.k1 * (1 - self.b + self.b * doc_len / self.avgdl)))
-        return score
+        term_ids = [self.term2id[q] for q in query if q in self.term2id]
+        if len(term_ids) < 1 or self.corpus_size < 1:
+            return np.zeros(self.corpus_size)
+
+        # gather postings of query terms, repeated term counts repeatedly
+        starts = self.term_indptr[term_ids]
+        ends = self.term_indptr[np.array(term_ids) + 1]
+        lengths = ends - starts
+        positions = np.repeat(ends - np.cumsum(lengths), lengths) + np.arange(lengths.sum())
+        return np.bincount(self.term_docs[positions], weights=self.term_weights[positions],
+                           minlength=self.corpus_size)
 
     def get_batch_scores(self, query, doc_ids):
         """
         Calculate bm25 scores between query and subset of all docs
         """
-        assert all(di < len(self.doc_freqs) for di in doc_ids)
-        score = np.zeros(len(doc_ids))
-        doc_len = np.array(self.doc_len)[doc_ids]
-        for q in query:
-            q_freq = np.array([(self.doc_freqs[di].get(q) or 0) for di in doc_ids])
-            score += (self.idf.get(q) or 0) * (q_freq * (self.k1 + 1) /
-                                               (q_freq + self.k1 * (1 - self.b + self.b * doc_len / self.avgdl)))
-        return score.tolist()
+        assert all(di < self.corpus_size for di in doc_ids)
+        return self.get_scores(query)[np.array(doc_ids, dtype=np.int64)].tolist()
+
+    def tokenize_query(self, query: str) -> List[str]:
+        return list(self.tokenizer(query))
 
     def get_top_n(self, query: Union[List,str], n=5):
         if type(query) is str:
-            if self.tokenizer is not None:
-                queries = self.tokenizer(query)
-            else:
-                queries = query.split(' ')
+            queries = self.tokenize_query(query)
         else:
             queries = query
 
         scores = self.get_scores(queries)
-        top_n = np.argsort(scores)[::-1][:n]
-        logger.info('{} {}'.format(scores, top_n))
+        if len(scores) < 1:
+            return []
+        n = min(n, len(scores))
+        top_n = np.argpartition(-scores, n - 1)[:n]
+        top_n = top_n[np.argsort(-scores[top_n], kind='stable')]
+        logger.info('bm25 top {} {} {}'.format(n, top_n, scores[top_n]))
         if abs(scores[top_n[0]]) < 1e-5:
             # not match, quit
             return []
@@ -0,0 +1,140 @@
+import json
+import os
+from typing import Iterable, List
+
+import numpy as np
+
+from .chunk import Chunk
+
+
+class ChunkStore:
+    """Columnar on-disk chunks, opened memory-mapped and materialized by id.
+
+    Files of a store named `chunks`:
+        chunks.npy     one fixed-size record per chunk, offsets into blob and columns
+        chunks.bin     UTF-8 content, followed by json of extra metadata if any
+        chunks.json    interned `source` and `read` paths
+
+    `metadata['source']` and `metadata['read']` are interned, other keys are
+    saved as json. Loaded metadata always starts with `source` and `read`.
+
+    Chunks appended by `extend` stay in memory until `write`, so the store
+    works as an append-only list for incremental update.
+
+    Example:
+
+        .. code-block:: python
+
+            ChunkStore.write('workdir/db_dense', chunks)
+            store = ChunkStore('workdir/db_dense')
+            chunk = store[42]
+    """
+    MODALS = ['text', 'image', 'audio', 'qa']
+    NONE = 0xFFFFFFFF
+    DTYPE = np.dtype([('offset', '<u8'), ('length', '<u4'), ('meta_length', '<u4'),
+                      ('modal', 'u1'), ('source', '<u4'), ('read', '<u4')])
+
+    def __init__(self, folder_path: str, name: str = 'chunks'):
+        index_path, blob_path, json_path = self.paths_of(folder_path, name)
+        self.index = np.load(index_path, mmap_mode='r')
+        self.blob = np.zeros(0, dtype=np.uint8)
+        if os.path.getsize(blob_path) > 0:
+            self.blob = np.memmap(blob_path, dtype=np.uint8, mode='r')
+        with open(json_path, encoding='utf8') as f:
+            self.paths = json.load(f)['paths']
+        self.pending = []
+
+    @staticmethod
+    def paths_of(folder_path: str, name: str):
+        return (os.path.join(folder_path, name + '.npy'),
+                os.path.join(folder_path, name + '.bin'),
+                os.path.join(folder_path, name + '.json'))
+
+    @classmethod
+    def exists(cls, folder_path: str, name: str = 'chunks') -> bool:
+        for path in cls.paths_of(folder_path, name):
+            if not os.path.exists(path):
+                return False
+        return True
+
+    @classmethod
+    def write(cls, folder_path: str, chunks: Iterable[Chunk], name: str = 'chunks'):
+        """Stream chunks to disk.
+
+        Write to temporary files then rename, a store opened on the old
+        files keeps working.
+        """
+        index_path, blob_path, json_path = cls.paths_of(folder_path, name)
+        path2id = dict()
+        paths = []
+
+        def intern(path: str):
+            if path is None:
+                return cls.NONE
+            if path not in path2id:
+                path2id[path] = len(paths)
+                paths.append(path)
+            return path2id[path]
+
+        records = []
+        offset = 0
+        with open(blob_path + '.tmp', 'wb') as f:
+            for chunk in chunks:
+                content = chunk.content_or_path.encode('utf8')
+                extra = {k: v for k, v in chunk.metadata.items() if k not in ['source', 'read']}
+                meta = json.dumps(extra, ensure_ascii=False).encode('utf8') if extra else b''
+                f.write(content)
+                f.write(meta)
+                records.append((offset, len(content), len(meta), cls.MODALS.index(chunk.modal),
+                                intern(chunk.metadata.get('source')), intern(chunk.metadata.get('read'))))
+                offset += len(content) + len(meta)
+
+        with open(index_path + '.tmp', 'wb') as f:
+            np.save(f, np.array(records, dtype=cls.DTYPE))
+        with open(json_path + '.tmp', 'w', encoding='utf8') as f:
+            json.dump({'paths': paths}, f, ensure_ascii=False)
+
+        os.replace(blob_path + '.tmp', blob_path)
+        os.replace(index_path + '.tmp', index_path)
+        os.replace(json_path + '.tmp', json_path)
+
+    def __len__(self):
+        return len(self.index) + len(self.pending)
+
+    def __getitem__(self, chunk_id: int) -> Chunk:
+        chunk_id = int(chunk_id)
+        if chunk_id < 0:
+            chunk_id += len(self)
+        if chunk_id >= len(self.index):
+            return self.pending[chunk_id - len(self.index)]
+
+        offset, length, meta_length, modal, source, read = self.index[chunk_id].tolist()
+        content = self.blob[offset:offset + length].tobytes().decode('utf8')
+        metadata = dict()
+        if source != self.NONE:
+            metadata['source'] = self.paths[source]
+        if read != self.NONE:
+            metadata['read'] = self.paths[read]
+        if meta_length > 0:
+            start = offset + length
+            metadata.update(json.loads(self.blob[start:start + meta_length].tobytes().decode('utf8')))
+        return Chunk(content_or_path=content, metadata=metadata, modal=self.MODALS[modal])
+
+    def __iter__(self):
+        for chunk_id in range(len(self)):
+            yield self[chunk_id]
+
+    def extend(self, chunks: List[Chunk]):
+        self.pending.extend(chunks)
+
+    def __iadd__(self, chunks: List[Chunk]):
+        self.extend(chunks)
+        return self
+
+    def source(self, chunk_id: int) -> str:
+        """Get `metadata['source']` without reading content."""
+        chunk_id = int(chunk_id)
+        if chunk_id >= len(self.index):
+            return self.pending[chunk_id - len(self.index)].metadata.get('source')
+        source = int(self.index[chunk_id]['source'])
+        return None if source == self.NONE else self.paths[source]
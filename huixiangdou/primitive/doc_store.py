@@ -0,0 +1,159 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from .file_operation import FileOperation
+
+
+class DocStore:
+    """Normalized document text saved at build time, so answering a query
+    slices context from memory instead of reading and parsing files.
+
+    Files in `folder_path`:
+        docs.npy     (offset, length) of each document in docs.bin
+        docs.bin     UTF-8 text as returned by `FileOperation.read`
+        docs.json    `metadata['read']` path of each document
+
+    Text is memory-mapped, recently used documents are kept decoded in a
+    bounded LRU. Chunk position in its document is `metadata['offset']`,
+    set when splitting.
+
+    Example:
+
+        .. code-block:: python
+
+            DocStore.build('workdir/db_doc', paths=['workdir/preprocess/a.text'])
+            store = DocStore.load('workdir/db_doc')
+            text = store.get('workdir/preprocess/a.text')
+    """
+    DTYPE = np.dtype([('offset', '<u8'), ('length', '<u8')])
+
+    def __init__(self, folder_path: str, capacity: int = 64):
+        index_path, blob_path, json_path = self.paths_of(folder_path)
+        self.index = np.load(index_path, mmap_mode='r')
+        self.blob = np.zeros(0, dtype=np.uint8)
+        if os.path.getsize(blob_path) > 0:
+            self.blob = np.memmap(blob_path, dtype=np.uint8, mode='r')
+        with open(json_path, encoding='utf8') as f:
+            self.path2id = {path: i for i, path in enumerate(json.load(f)['paths'])}
+        self.capacity = capacity
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def paths_of(folder_path: str) -> Tuple[str, str, str]:
+        return (os.path.join(folder_path, 'docs.npy'),
+                os.path.join(folder_path, 'docs.bin'),
+                os.path.join(folder_path, 'docs.json'))
+
+    @classmethod
+    def exists(cls, folder_path: str) -> bool:
+        for path in cls.paths_of(folder_path):
+            if not os.path.exists(path):
+                return False
+        return True
+
+    @classmethod
+    def load(cls, folder_path: str, capacity: int = 64) -> Optional['DocStore']:
+        """Return None if not built, callers fallback to read files."""
+        if not cls.exists(folder_path):
+            return None
+        return cls(folder_path, capacity=capacity)
+
+    def __contains__(self, path: str) -> bool:
+        return path in self.path2id
+
+    def __len__(self):
+        return len(self.path2id)
+
+    def get(self, path: str) -> Optional[str]:
+        """Text of document read from `path`, None if not in store."""
+        with self.lock:
+            text = self.lru.get(path)
+            if text is not None:
+                self.lru.move_to_end(path)
+                return text
+
+        doc_id = self.path2id.get(path)
+        if doc_id is None:
+            return None
+        offset, length = self.index[doc_id].tolist()
+        text = self.blob[offset:offset + length].tobytes().decode('utf8')
+        with self.lock:
+            self.lru[path] = text
+            while len(self.lru) > self.capacity:
+                self.lru.popitem(last=False)
+        return text
+
+    @classmethod
+    def write(cls, folder_path: str, docs: Iterable[Tuple[str, str]]):
+        """Stream (path, text) to disk, write temporary files then rename."""
+        os.makedirs(folder_path, exist_ok=True)
+        index_path, blob_path, json_path = cls.paths_of(folder_path)
+        records = []
+        paths = []
+        offset = 0
+        with open(blob_path + '.tmp', 'wb') as f:
+            for path, text in docs:
+                data = text.encode('utf8')
+                f.write(data)
+                records.append((offset, len(data)))
+                paths.append(path)
+                offset += len(data)
+
+        with open(index_path + '.tmp', 'wb') as f:
+            np.save(f, np.array(records, dtype=cls.DTYPE))
+        with open(json_path + '.tmp', 'w', encoding='utf8') as f:
+            json.dump({'paths': paths}, f, ensure_ascii=False)
+
+        os.replace(blob_path + '.tmp', blob_path)
+        os.replace(index_path + '.tmp', index_path)
+        os.replace(json_path + '.tmp', json_path)
+
+    @classmethod
+    def build(cls, folder_path: str, paths: Iterable[str], refresh: Iterable[str] = ()) -> Dict[str, int]:
+        """Save text of `paths`, reuse text of the old store unless in `refresh`.
+
+        Returns:
+            Dict[str, int]: path to text length, unreadable paths are skipped.
+        """
+        old = cls.load(folder_path)
+        refresh = set(refresh)
+        lengths = dict()
+        file_opr = FileOperation()
+
+        def docs():
+            for path in paths:
+                if path in lengths:
+                    continue
+                if old is not None and path in old and path not in refresh:
+                    text = old.get(path)
+                elif os.path.exists(path):
+                    text, error = file_opr.read(path)
+                    if error is not None:
+                        continue
+                else:
+                    continue
+                lengths[path] = len(text)
+                yield path, text
+
+        cls.write(folder_path, docs())
+        return lengths
+
+    @staticmethod
+    def locate(text: str, contents: List[str]) -> List[int]:
+        """Offsets of chunk `contents` in document `text` in order, -1 if not found."""
+        offsets = []
+        cursor = 0
+        for content in contents:
+            offset = text.find(content, cursor)
+            if offset == -1:
+                offset = text.find(content)
+            if offset != -1:
+                cursor = offset + 1
+            offsets.append(offset)
+        return offsets
@@ -12,6 +12,10 @@ from loguru import logger
 from .query import DistanceStrategy
 from .limitter import RPM, TPM
 from .chunk import Chunk
+from .embedding_cache import QueryEmbeddingCache
+from .batcher import MicroBatcher
+from .inference_client import InferenceClient
+from .onnx_encoder import OnnxEncoder
 from .utils import always_get_an_event_loop
 
 class Embedder:
@@ -25,8 +29,27 @@ class Embedder:
         self.distance_strategy = DistanceStrategy.EUCLIDEAN_DISTANCE
         
         model_path = model_config['embedding_model_path']
+        # features of different model are not comparable, used as cache key
+        self.model_id = model_path
         self._type = self.model_type(model_path=model_path)
-        if 'bce' in self._type:
+        if self._type == 'bce' and model_config.get('model_backend', 'torch') == 'onnx':
+            self._type = 'onnx'
+            # quantized features drift from torch, never share cache
+            self.model_id = '{}@onnx{}'.format(model_path, '-int8' if model_config.get('onnx_quantize', True) else '')
+
+        # local model served by `huixiangdou.services.inference_server`, shared by worker processes
+        self.inference = None
+        inference_socket = model_config.get('inference_socket', '')
+        if inference_socket and self._type in ['bce', 'bge', 'onnx']:
+            self.inference = InferenceClient(socket_path=inference_socket)
+            info = self.inference.info()
+            self.support_image = info['support_image']
+            self.distance_strategy = DistanceStrategy(info['distance_strategy'])
+            logger.info('embedder {} use inference service {}'.format(model_path, inference_socket))
+        elif 'onnx' in self._type:
+            self.client = OnnxEncoder(**OnnxEncoder.options(model_path=model_path, model_config=model_config),
+                                      task='embedding')
+        elif 'bce' in self._type:
             from sentence_transformers import SentenceTransformer
             self.client = SentenceTransformer(model_name_or_path=model_path).half()
         elif 'bge' in self._type:
@@ -50,13 +73,47 @@ class Embedder:
 
             self.client = {
                 'api_token': api_token,
-                'api_rpm': RPM(api_rpm),
-                'api_tpm': TPM(api_tpm)
+                'api_rpm': RPM(api_rpm, store=model_config.get('rate_limit_store', ''), key='embedder:siliconcloud:rpm'),
+                'api_tpm': TPM(api_tpm, store=model_config.get('rate_limit_store', ''), key='embedder:siliconcloud:tpm')
             }
 
         else:
             raise ValueError('Unknown type {}'.format(self._type))
 
+        # repeated queries skip model forward or API round-trip
+        self.query_cache = None
+        query_cache_size = int(model_config.get('query_cache_size', 1024))
+        query_cache_dir = model_config.get('query_cache_dir', '')
+        embedding_cache_dir = model_config.get('embedding_cache_dir', '')
+        if query_cache_dir and embedding_cache_dir and os.path.abspath(query_cache_dir) == os.path.abspath(
+                embedding_cache_dir):
+            # the disk tier rotates, it would wipe document features of the build cache
+            raise ValueError('query_cache_dir must differ from embedding_cache_dir {}'.format(embedding_cache_dir))
+        if query_cache_size > 0 or query_cache_dir:
+            self.query_cache = QueryEmbeddingCache(model_id=self.model_id,
+                                                   capacity=query_cache_size,
+                                                   cache_dir=query_cache_dir,
+                                                   disk_capacity=int(model_config.get('query_cache_disk_size', 100000)))
+        # merge concurrent text queries, see `enable_batching`
+        self.batcher = None
+
+    def enable_batching(self, max_batch: int = 32, max_wait_ms: float = 5):
+        """Run concurrent `embed_query` text calls as one batched forward.
+
+        Only local bce and onnx models encode a batch in one call, other
+        types keep one call per query."""
+        if self._type not in ['bce', 'onnx'] or max_batch < 2 or self.inference is not None:
+            # inference service batches on server side
+            return
+        # swap before close, new calls go to the new batcher
+        old, self.batcher = self.batcher, MicroBatcher(
+            batch_fn=lambda texts: self.embed_query_batch_text(chunks=[Chunk(content_or_path=t) for t in texts]),
+            max_batch=max_batch,
+            max_wait_ms=max_wait_ms)
+        if old is not None:
+            old.close()
+        logger.info('embedding micro batching enabled, max_batch {} max_wait_ms {}'.format(max_batch, max_wait_ms))
+
     @classmethod
     def model_type(self, model_path):
         """Check text2vec model using multimodal or not."""
@@ -74,6 +131,10 @@ class Embedder:
         return 'bge'
 
     def token_length(self, text: str) -> int:
+        if self.inference is not None:
+            return self.inference.token_length(text)
+        if 'onnx' in self._type:
+            return self.client.token_length(text)
         if 'bge' in self._type or 'bce' in self._type:
             return len(self.client.tokenizer(text, padding=False, truncation=False)['input_ids'])
         else:
@@ -89,7 +150,33 @@ class Embedder:
         raise ValueError('Unsupported distance strategy')
 
     def embed_query(self, text: str = None, path: str = None) -> np.ndarray:
-        """Embed input text or image as feature, output np.ndarray with np.float32"""
+        """Embed input text or image as feature, output np.ndarray with np.float32
+
+        Features are looked up in `query_cache` first."""
+        if self.query_cache is None:
+            return self._embed_query(text=text, path=path)
+
+        # embed the text the key is built from, so the cached feature does not depend on query order
+        text = self.query_cache.normalize(text)
+        key = self.query_cache.key(text=text, path=path)
+        feature = self.query_cache.get(key)
+        if feature is None:
+            feature = self._embed_query(text=text, path=path)
+            self.query_cache.put(key, feature)
+        return feature
+
+    def _embed_query(self, text: str = None, path: str = None) -> np.ndarray:
+        if self.batcher is not None and text and path is None:
+            return self.batcher(text)
+        return self._encode(text=text, path=path)
+
+    def _encode(self, text: str = None, path: str = None) -> np.ndarray:
+        if self.inference is not None:
+            return self.inference.embed(text=text, path=path)
+        if 'onnx' in self._type:
+            if not text:
+                raise ValueError('This model only support text')
+            return self.client.encode([text])
         if 'bge' in self._type:
             import torch
             with torch.no_grad():
@@ -133,6 +220,10 @@ class Embedder:
 
     def embed_query_batch_text(self, chunks: List[Chunk] = []) -> np.ndarray:
         """Embed input text or image as feature, output np.ndarray with np.float32"""
+        if self.inference is not None:
+            return self.inference.embed_batch([c.content_or_path for c in chunks])
+        if 'onnx' in self._type:
+            return self.client.encode([c.content_or_path for c in chunks])
         if 'bge' in self._type:
             import torch
             with torch.no_grad():
@@ -152,6 +243,6 @@ class Embedder:
         else:
             features = []
             for c in chunks:
-                feature = self.embed_query(text=c.content_or_path)
+                feature = self._encode(text=c.content_or_path)
                 features.append(feature)
             return np.concatenate(features).reshape(len(chunks), -1).astype(np.float32)
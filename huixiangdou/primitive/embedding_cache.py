@@ -0,0 +1,343 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+from loguru import logger
+
+try:
+    import fcntl
+except ImportError:
+    # windows, no inter-process lock
+    fcntl = None
+
+
+def file_lock(f, exclusive: bool):
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+
+def file_unlock(f):
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class EmbeddingCache:
+    """Content-addressed persistent embedding cache, keyed by (model id, text hash).
+
+    Each model has its own directory:
+        meta.json      model id and feature dimension
+        vectors.f32    float32 features, one row per record, memory-mapped for read
+        keys.u64       16 bytes blake2b digest of text per record, same row order
+
+    Records are only appended, vectors are written before keys, so a crashed
+    build leaves at most one partial row which is truncated on next write.
+    Finished batches survive the crash, rebuilding the same corpus with
+    another chunk size or config only embeds the changed chunks.
+
+    Records appended by other processes are read on the next `get`. With
+    `max_rows` > 0 the files are replaced by empty ones when full, readers
+    notice the new files and reload.
+
+    Example:
+
+        .. code-block:: python
+
+            cache = EmbeddingCache(cache_dir='embedding_cache', model_id='maidalun1020/bce-embedding-base_v1')
+            features = cache.get(['hello world'])
+            if features[0] is None:
+                cache.put(['hello world'], embedder.embed_query(text='hello world'))
+    """
+    # records read after `load` are merged into the sorted index at this size
+    FOLD_SIZE = 4096
+
+    def __init__(self, cache_dir: str, model_id: str, max_rows: int = 0):
+        self.model_id = model_id
+        self.max_rows = max_rows
+        model_key = hashlib.md5(model_id.encode('utf8')).hexdigest()[0:16]
+        self.dir = os.path.join(cache_dir, model_key)
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir, exist_ok=True)
+
+        self.meta_path = os.path.join(self.dir, 'meta.json')
+        self.vector_path = os.path.join(self.dir, 'vectors.f32')
+        self.key_path = os.path.join(self.dir, 'keys.u64')
+        self.lock_path = os.path.join(self.dir, 'lock')
+
+        self.dim = None
+        self.vector_file = None
+        self.key_file = None
+        self.lock = threading.Lock()
+        self.hit = 0
+        self.miss = 0
+        with self.lock:
+            self.load()
+
+    @staticmethod
+    def digest(text: str) -> np.ndarray:
+        return np.frombuffer(hashlib.blake2b(text.encode('utf8'), digest_size=16).digest(), dtype=np.uint64)
+
+    def row_bytes(self) -> int:
+        return self.dim * 4
+
+    def load(self):
+        """Open current files and load key index sorted by the high 64 bits,
+        vectors stay on disk. Called with `self.lock` held."""
+        for f in [self.vector_file, self.key_file]:
+            if f is not None:
+                f.close()
+        self.vector_file = None
+        self.key_file = None
+        self.sorted_hi = np.zeros(0, dtype=np.uint64)
+        self.sorted_lo = np.zeros(0, dtype=np.uint64)
+        self.sorted_row = np.zeros(0, dtype=np.int64)
+        # records read after the sorted index was built
+        self.recent = dict()
+        self.rows = 0
+        self.vectors = None
+        self.mapped_rows = 0
+
+        if self.dim is None and os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                self.dim = json.load(f)['dim']
+        if self.dim is None:
+            return
+
+        # a shared lock keeps vectors and keys of the same generation
+        with open(self.lock_path, 'a') as lock:
+            file_lock(lock, exclusive=False)
+            try:
+                if not os.path.exists(self.key_path) or not os.path.exists(self.vector_path):
+                    return
+                self.vector_file = open(self.vector_path, 'rb')
+                self.key_file = open(self.key_path, 'rb')
+            finally:
+                file_unlock(lock)
+
+        keys = self._read_keys(0)
+        order = np.argsort(keys[:, 0], kind='stable')
+        self.sorted_hi = keys[order, 0]
+        self.sorted_lo = keys[order, 1]
+        self.sorted_row = order
+        self.rows = len(keys)
+
+    def _read_keys(self, start: int) -> np.ndarray:
+        """Complete records from row `start` of the opened files."""
+        rows = min(os.fstat(self.key_file.fileno()).st_size // 16,
+                   os.fstat(self.vector_file.fileno()).st_size // self.row_bytes())
+        if rows <= start:
+            return np.zeros((0, 2), dtype=np.uint64)
+        self.key_file.seek(start * 16)
+        keys = np.frombuffer(self.key_file.read((rows - start) * 16), dtype=np.uint64)
+        return keys[0:len(keys) // 2 * 2].reshape(-1, 2)
+
+    def _replaced(self) -> bool:
+        """Whether files were created or rotated since `load`."""
+        if self.key_file is None:
+            return os.path.exists(self.key_path)
+        try:
+            return os.stat(self.key_path).st_ino != os.fstat(self.key_file.fileno()).st_ino or \
+                os.stat(self.vector_path).st_ino != os.fstat(self.vector_file.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def refresh(self):
+        """Read records appended by any process since last refresh. Called
+        with `self.lock` held."""
+        if self._replaced():
+            self.load()
+            return
+        if self.key_file is None:
+            return
+        keys = self._read_keys(self.rows)
+        for i in range(len(keys)):
+            self.recent[keys[i].tobytes()] = self.rows + i
+        self.rows += len(keys)
+
+        if len(self.recent) >= self.FOLD_SIZE:
+            digests = np.frombuffer(b''.join(self.recent.keys()), dtype=np.uint64).reshape(-1, 2)
+            hi = np.concatenate([self.sorted_hi, digests[:, 0]])
+            lo = np.concatenate([self.sorted_lo, digests[:, 1]])
+            row = np.concatenate([self.sorted_row, np.array(list(self.recent.values()), dtype=np.int64)])
+            order = np.argsort(hi, kind='stable')
+            self.sorted_hi, self.sorted_lo, self.sorted_row = hi[order], lo[order], row[order]
+            self.recent = dict()
+
+    def __len__(self):
+        return self.rows
+
+    def _mmap(self):
+        if self.rows > self.mapped_rows:
+            self.vectors = np.memmap(self.vector_file, dtype=np.float32, mode='r', shape=(self.rows, self.dim))
+            self.mapped_rows = self.rows
+        return self.vectors
+
+    def get(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """Return feature with shape (1, dim) for each text, None if miss."""
+        digests = np.stack([self.digest(text) for text in texts]) if len(texts) > 0 else None
+        with self.lock:
+            self.refresh()
+            if len(texts) < 1 or self.dim is None:
+                self.miss += len(texts)
+                return [None] * len(texts)
+
+            rows = np.full(len(texts), -1, dtype=np.int64)
+            if len(self.sorted_hi) > 0:
+                pos = np.searchsorted(self.sorted_hi, digests[:, 0])
+                pos = np.minimum(pos, len(self.sorted_hi) - 1)
+                match = (self.sorted_hi[pos] == digests[:, 0]) & (self.sorted_lo[pos] == digests[:, 1])
+                rows[match] = self.sorted_row[pos[match]]
+            for i in np.where(rows < 0)[0]:
+                rows[i] = self.recent.get(digests[i].tobytes(), -1)
+
+            ret = [None] * len(texts)
+            hit_indexes = np.where(rows >= 0)[0]
+            if len(hit_indexes) > 0:
+                vectors = self._mmap()
+                for i in hit_indexes:
+                    ret[i] = np.array(vectors[rows[i]]).reshape(1, -1)
+            self.hit += len(hit_indexes)
+            self.miss += len(texts) - len(hit_indexes)
+            return ret
+
+    def put(self, texts: List[str], features: np.ndarray):
+        """Append features of texts, readers see them on their next `get`."""
+        if len(texts) < 1:
+            return
+        features = np.ascontiguousarray(features, dtype=np.float32).reshape(len(texts), -1)
+        if self.dim is None:
+            self.dim = features.shape[1]
+            with open(self.meta_path, 'w') as f:
+                json.dump({'model': self.model_id, 'dim': self.dim}, f)
+        elif features.shape[1] != self.dim:
+            raise ValueError('feature dim {} mismatch cache dim {}'.format(features.shape[1], self.dim))
+
+        digests = np.stack([self.digest(text) for text in texts])
+        # no thread lock, readers are not blocked by a slow append
+        with open(self.lock_path, 'a') as lock:
+            file_lock(lock, exclusive=True)
+            try:
+                # other processes may append, drop partial rows of a crashed writer
+                rows = 0
+                if os.path.exists(self.vector_path) and os.path.exists(self.key_path):
+                    rows = min(os.path.getsize(self.vector_path) // self.row_bytes(),
+                               os.path.getsize(self.key_path) // 16)
+                if self.max_rows > 0 and rows + len(texts) > self.max_rows:
+                    self.rotate()
+                    rows = 0
+                with open(self.vector_path, 'ab') as f:
+                    f.truncate(rows * self.row_bytes())
+                    f.write(features.tobytes())
+                with open(self.key_path, 'ab') as f:
+                    f.truncate(rows * 16)
+                    f.write(digests.tobytes())
+            finally:
+                file_unlock(lock)
+
+    def rotate(self):
+        """Replace full files with empty ones, called with the file lock
+        held. Readers keep their opened files until they reload."""
+        logger.info('embedding cache {} reach {} records, rotate'.format(self.dir, self.max_rows))
+        for path in [self.key_path, self.vector_path]:
+            tmp_path = path + '.tmp'
+            open(tmp_path, 'wb').close()
+            os.replace(tmp_path, path)
+
+    def summary(self) -> str:
+        total = max(1, self.hit + self.miss)
+        return 'embedding cache {} records, hit {}, miss {}, hit rate {:.2f}%'.format(
+            self.rows, self.hit, self.miss, 100.0 * self.hit / total)
+
+
+class QueryEmbeddingCache:
+    """Bounded LRU of query features, optionally backed by `EmbeddingCache`.
+
+    Key is normalized text, with md5 of the image for multimodal query.
+    Only text queries go to the disk tier, so worker processes sharing
+    `cache_dir` reuse each other's features, the disk tier keeps at most
+    `disk_capacity` records before it rotates. Thread-safe, queries are
+    embedded in `asyncio.to_thread` workers, disk reads and writes run
+    outside the LRU lock.
+
+    Example:
+
+        .. code-block:: python
+
+            cache = QueryEmbeddingCache(model_id='maidalun1020/bce-embedding-base_v1', capacity=1024)
+            text = cache.normalize('how to  install mmpose ?')
+            key = cache.key(text=text)
+            feature = cache.get(key)
+            if feature is None:
+                feature = model.encode([text])
+                cache.put(key, feature)
+    """
+
+    def __init__(self, model_id: str, capacity: int = 1024, cache_dir: str = '', disk_capacity: int = 100000):
+        self.model_id = model_id
+        self.capacity = capacity
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+        self.disk = None
+        if cache_dir:
+            self.disk = EmbeddingCache(cache_dir=cache_dir, model_id=model_id, max_rows=disk_capacity)
+        self.hit = 0
+        self.disk_hit = 0
+        self.miss = 0
+
+    @staticmethod
+    def normalize(text: str = None) -> str:
+        """Collapse whitespace, callers embed the normalized text."""
+        return ' '.join(text.split()) if text else text
+
+    @staticmethod
+    def key(text: str = None, path: str = None) -> str:
+        """Whitespace-normalized text, plus image content hash."""
+        key = QueryEmbeddingCache.normalize(text) or ''
+        if path is not None:
+            with open(path, 'rb') as f:
+                key += '\0image:' + hashlib.md5(f.read()).hexdigest()
+        return key
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self.lock:
+            feature = self.lru.get(key)
+            if feature is not None:
+                self.lru.move_to_end(key)
+                self.hit += 1
+                return feature.copy()
+
+        feature = None
+        if self.disk is not None and '\0image:' not in key:
+            feature = self.disk.get([key])[0]
+        with self.lock:
+            if feature is None:
+                self.miss += 1
+                return None
+            self.disk_hit += 1
+            self._insert(key, feature)
+            return feature.copy()
+
+    def put(self, key: str, feature: np.ndarray):
+        if self.disk is not None and '\0image:' not in key:
+            self.disk.put([key], feature)
+        with self.lock:
+            self._insert(key, np.array(feature, dtype=np.float32))
+
+    def _insert(self, key: str, feature: np.ndarray):
+        if self.capacity < 1:
+            return
+        self.lru[key] = feature
+        self.lru.move_to_end(key)
+        while len(self.lru) > self.capacity:
+            self.lru.popitem(last=False)
+
+    def __len__(self):
+        return len(self.lru)
+
+    def summary(self) -> str:
+        total = max(1, self.hit + self.disk_hit + self.miss)
+        return 'query embedding cache {} records, hit {}, disk hit {}, miss {}, hit rate {:.2f}%'.format(
+            len(self.lru), self.hit, self.disk_hit, self.miss, 100.0 * (self.hit + self.disk_hit) / total)
@@ -1,10 +1,169 @@
 import sqlite3
 import os
 import json
-from typing import List, Union, Set
+import hashlib
+from collections import deque
+from typing import Dict, List, Union, Set, Tuple
+
+import numpy as np
+
+
+class EntityAutomaton:
+    """Aho-Corasick automaton, find all entities in one pass over the text.
+
+    Overlapped and nested entities are all reported. Transitions are kept in
+    one dict keyed by `state << 21 | codepoint`, outputs of suffix states are
+    merged at build time, so matching is one dict lookup per character.
+    The automaton is saved as flat numpy arrays and loads without rebuilding
+    the trie.
+    """
+    SHIFT = 21
+
+    def __init__(self, ignore_case: bool = True):
+        self.ignore_case = ignore_case
+        self.goto = dict()
+        self.fail = [0]
+        # state -> matched entity ids, only states with output
+        self.outputs = dict()
+        self.digest = ''
+
+    def fold(self, text: str) -> str:
+        return text.casefold() if self.ignore_case else text
+
+    def build(self, entities: List[str], digest: str = ''):
+        """Build trie, failure links and merged outputs, entity id is the list index."""
+        shift = self.SHIFT
+        goto = dict()
+        children = [[]]
+        outputs = [[]]
+        for eid, entity in enumerate(entities):
+            entity = self.fold(entity)
+            # empty entity matches everything, skip it
+            if not entity:
+                continue
+            state = 0
+            for char in entity:
+                key = state << shift | ord(char)
+                target = goto.get(key)
+                if target is None:
+                    target = len(children)
+                    goto[key] = target
+                    children[state].append((ord(char), target))
+                    children.append([])
+                    outputs.append([])
+                state = target
+            outputs[state].append(eid)
+
+        # BFS, the failure state is always shallower than current state
+        fail = [0] * len(children)
+        queue = deque(target for _, target in children[0])
+        while queue:
+            state = queue.popleft()
+            for code, child in children[state]:
+                link = fail[state]
+                while link and (link << shift | code) not in goto:
+                    link = fail[link]
+                target = goto.get(link << shift | code, 0)
+                fail[child] = target if target != child else 0
+                outputs[child] += outputs[fail[child]]
+                queue.append(child)
+
+        self.goto = goto
+        self.fail = fail
+        self.outputs = {state: tuple(out) for state, out in enumerate(outputs) if out}
+        self.digest = digest
+        return self
+
+    def match(self, text: str) -> List[int]:
+        """Return sorted ids of entities occurring in `text`."""
+        goto = self.goto
+        fail = self.fail
+        outputs = self.outputs
+        shift = self.SHIFT
+
+        hits = set()
+        state = 0
+        for char in self.fold(text):
+            code = ord(char)
+            while True:
+                target = goto.get(state << shift | code)
+                if target is not None:
+                    state = target
+                    break
+                if state == 0:
+                    break
+                state = fail[state]
+            out = outputs.get(state)
+            if out:
+                hits.update(out)
+        return sorted(hits)
+
+    def save(self, path: str):
+        keys = np.fromiter(self.goto.keys(), dtype=np.int64, count=len(self.goto))
+        targets = np.fromiter(self.goto.values(), dtype=np.int32, count=len(self.goto))
+        out_states = np.array(sorted(self.outputs.keys()), dtype=np.int32)
+        out_lens = [len(self.outputs[s]) for s in out_states]
+        out_indptr = np.zeros(len(out_states) + 1, dtype=np.int64)
+        out_indptr[1:] = np.cumsum(out_lens)
+        out_ids = np.array([eid for s in out_states for eid in self.outputs[s]], dtype=np.int32)
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f,
+                     keys=keys,
+                     targets=targets,
+                     fail=np.array(self.fail, dtype=np.int32),
+                     out_states=out_states,
+                     out_indptr=out_indptr,
+                     out_ids=out_ids,
+                     ignore_case=np.array(self.ignore_case),
+                     digest=np.array(self.digest))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as data:
+            automaton = cls(ignore_case=bool(data['ignore_case']))
+            automaton.goto = dict(zip(data['keys'].tolist(), data['targets'].tolist()))
+            automaton.fail = data['fail'].tolist()
+            indptr = data['out_indptr'].tolist()
+            out_ids = data['out_ids'].tolist()
+            automaton.outputs = {
+                state: tuple(out_ids[indptr[i]:indptr[i + 1]])
+                for i, state in enumerate(data['out_states'].tolist())
+            }
+            automaton.digest = str(data['digest'])
+        return automaton
+
+
+def pack_ids(chunk_ids: List[int]) -> bytes:
+    return np.asarray(chunk_ids, dtype=np.int32).tobytes()
+
+
+def unpack_ids(value: Union[bytes, str]) -> np.ndarray:
+    """Postings are packed int32, comma-joined TEXT of old databases also works."""
+    if isinstance(value, str):
+        return np.array([int(i) for i in value.split(',') if i], dtype=np.int32)
+    return np.frombuffer(value, dtype=np.int32)
+
+
+def count_postings(indptr: np.ndarray, ids: np.ndarray, entity_ids: List[int]) -> List[Tuple[int, int]]:
+    """Merge postings of `entity_ids` in CSR, return [(chunk_id, match count)] sorted by count."""
+    entity_ids = [eid for eid in entity_ids if 0 <= eid < len(indptr) - 1]
+    if len(entity_ids) < 1:
+        return []
+    postings = np.concatenate([ids[indptr[eid]:indptr[eid + 1]] for eid in entity_ids])
+    chunk_ids, counts = np.unique(postings, return_counts=True)
+    order = np.argsort(-counts, kind='stable')
+    return list(zip(chunk_ids[order].tolist(), counts[order].tolist()))
+
 
 class NamedEntity2Chunk:
-    """Save the relationship between Named Entity and Chunk to sqlite"""
+    """Save the relationship between Named Entity and Chunk to sqlite.
+
+    Postings of each entity are packed int32 BLOB. Use `EntityIndex` for
+    read-only query in serving.
+    """
     def __init__(self, file_dir:str, ignore_case=True):
         self.file_dir = file_dir
         # case sensitive
@@ -16,81 +175,157 @@ class NamedEntity2Chunk:
         self.cursor.execute('''
         CREATE TABLE IF NOT EXISTS entities (
             eid INTEGER PRIMARY KEY,
-            chunk_ids TEXT
+            chunk_ids BLOB
         )
         ''')
         self.conn.commit()
         self.entities = []
+        self.automaton = None
         self.entity_path = os.path.join(self.file_dir, 'entities.json') 
+        self.automaton_path = os.path.join(self.file_dir, 'entities.ac.npz')
         if os.path.exists(self.entity_path):
             with open(self.entity_path) as f:
-                self.entities = json.load(f)
-                if self.ignore_case:
-                    for id, value in enumerate(self.entities):
-                        self.entities[id] = value.lower()
+                json_str = f.read()
+            self.entities = json.loads(json_str)
+            if self.ignore_case:
+                for id, value in enumerate(self.entities):
+                    self.entities[id] = value.casefold()
+            self.load_automaton(digest=hashlib.md5(json_str.encode('utf8')).hexdigest())
+
+    def load_automaton(self, digest: str):
+        """Load persisted automaton, rebuild it if `entities.json` changed."""
+        if os.path.exists(self.automaton_path):
+            automaton = EntityAutomaton.load(self.automaton_path)
+            if automaton.digest == digest and automaton.ignore_case == self.ignore_case:
+                self.automaton = automaton
+                return
+        self.automaton = EntityAutomaton(ignore_case=self.ignore_case).build(self.entities, digest=digest)
+        self.automaton.save(self.automaton_path)
 
     def clean(self):
         self.cursor.execute('''DROP TABLE entities;''')
         self.cursor.execute('''
         CREATE TABLE IF NOT EXISTS entities (
             eid INTEGER PRIMARY KEY,
-            chunk_ids TEXT
+            chunk_ids BLOB
         )
         ''')
         self.conn.commit()
 
     def insert_relation(self, eid: int, chunk_ids: List[int]):
-        """Insert the relationship between keywords id and List of chunk_id"""
-        chunk_ids_str = ','.join(map(str, chunk_ids)) 
-        self.cursor.execute('INSERT INTO entities (eid, chunk_ids) VALUES (?, ?)', (eid, chunk_ids_str))
-        self.conn.commit()
+        """Insert the relationship between keywords id and List of chunk_id,
+        committed with `set_relations` or on close."""
+        self.cursor.execute('INSERT INTO entities (eid, chunk_ids) VALUES (?, ?)', (eid, pack_ids(chunk_ids)))
     
+    def get_relations(self) -> Dict[int, List[int]]:
+        """Load all relationships, {eid: [chunk_id]}"""
+        self.cursor.execute('SELECT eid, chunk_ids FROM entities')
+        relations = dict()
+        for eid, value in self.cursor.fetchall():
+            if not value:
+                continue
+            relations[eid] = unpack_ids(value).tolist()
+        return relations
+
+    def set_relations(self, relations: Dict[int, List[int]]):
+        """Replace all relationships in one transaction."""
+        self.cursor.execute('DELETE FROM entities')
+        rows = []
+        for eid, chunk_ids in relations.items():
+            if len(chunk_ids) < 1:
+                continue
+            rows.append((eid, pack_ids(chunk_ids)))
+        self.cursor.executemany('INSERT INTO entities (eid, chunk_ids) VALUES (?, ?)', rows)
+        self.conn.commit()
+
+    def get_postings(self) -> Tuple[np.ndarray, np.ndarray]:
+        """All relationships as CSR (indptr, chunk_ids), indexed by entity id."""
+        relations = self.get_relations()
+        lengths = np.zeros(len(self.entities) + 1, dtype=np.int64)
+        for eid, chunk_ids in relations.items():
+            if eid < len(self.entities):
+                lengths[eid + 1] = len(chunk_ids)
+        indptr = np.cumsum(lengths)
+        ids = np.zeros(indptr[-1], dtype=np.int32)
+        for eid, chunk_ids in relations.items():
+            if eid < len(self.entities):
+                ids[indptr[eid]:indptr[eid + 1]] = chunk_ids
+        return indptr, ids
+
     def parse(self, text:str) -> List[int]:
-        if self.ignore_case:
-            text = text.lower()
-        
+        """Return ids of entities occurring in `text`, overlapped ones included."""
         if len(self.entities) < 1:
             raise ValueError('entity list empty, please check feature_store init')
-        ret = []
-        for index, entity in enumerate(self.entities):
-            if entity in text:
-                ret.append(index)
-        return ret
+        return self.automaton.match(text)
 
     def set_entity(self, entities: List[str]):
         json_str = json.dumps(entities, ensure_ascii=False)
         with open(self.entity_path, 'w') as f:
             f.write(json_str)
             
-        self.entities = entities
+        self.entities = list(entities)
         if self.ignore_case:
             for id, value in enumerate(self.entities):
-                self.entities[id] = value.lower()
+                self.entities[id] = value.casefold()
+        # compile once at build time, queries load it from disk
+        self.automaton = EntityAutomaton(ignore_case=self.ignore_case).build(
+            self.entities, digest=hashlib.md5(json_str.encode('utf8')).hexdigest())
+        self.automaton.save(self.automaton_path)
 
-    def get_chunk_ids(self, entity_ids: Union[List, int]) -> Set:
-        """Query by keywords ids"""
+    def get_chunk_ids(self, entity_ids: Union[List, int]) -> List[Tuple[int, int]]:
+        """Query by keywords ids, return [(chunk_id, match count)]"""
         if type(entity_ids) is int:
             entity_ids = [entity_ids]
-        
-        counter = dict()
-        for eid in entity_ids:
-            self.cursor.execute('SELECT chunk_ids FROM entities WHERE eid = ?', (eid,))
-            result = self.cursor.fetchone()
-            if result:
-                chunk_ids = result[0].split(',')
-                for chunk_id_str in chunk_ids:
-                    chunk_id = int(chunk_id_str)
-                    if chunk_id not in counter:
-                        counter[chunk_id] = 1
-                    else:
-                        counter[chunk_id] += 1
-        
-        counter_list = []
-        for k,v in counter.items():
-            counter_list.append((k,v))
-        counter_list.sort(key=lambda item: item[1], reverse=True)
-        return counter_list
+        if len(entity_ids) < 1:
+            return []
+
+        marks = ','.join('?' * len(entity_ids))
+        self.cursor.execute('SELECT eid, chunk_ids FROM entities WHERE eid IN ({})'.format(marks), list(entity_ids))
+        postings = dict((eid, unpack_ids(value)) for eid, value in self.cursor.fetchall() if value)
+        lengths = [len(postings[eid]) if eid in postings else 0 for eid in entity_ids]
+        indptr = np.zeros(len(entity_ids) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(lengths)
+        ids = np.concatenate([postings[eid] for eid in entity_ids if eid in postings] + [np.zeros(0, dtype=np.int32)])
+        return count_postings(indptr, ids, list(range(len(entity_ids))))
     
     def __del__(self):
+        self.conn.commit()
         self.cursor.close()
         self.conn.close()
+
+
+class EntityIndex:
+    """Read-only entity inverted index for serving.
+
+    Entities automaton and CSR postings are loaded once, sqlite is closed
+    right after, so one instance is shared by all threads and coroutines.
+    """
+
+    def __init__(self, automaton: EntityAutomaton, indptr: np.ndarray, ids: np.ndarray):
+        self.automaton = automaton
+        self.indptr = indptr
+        self.ids = ids
+
+    @classmethod
+    def load(cls, file_dir: str):
+        """Return None if the index is not built."""
+        if not os.path.exists(os.path.join(file_dir, 'entities.json')):
+            return None
+        indexer = NamedEntity2Chunk(file_dir=file_dir)
+        try:
+            if len(indexer.entities) < 1:
+                return None
+            indptr, ids = indexer.get_postings()
+            return cls(automaton=indexer.automaton, indptr=indptr, ids=ids)
+        finally:
+            del indexer
+
+    def parse(self, text: str) -> List[int]:
+        return self.automaton.match(text)
+
+    def get_chunk_ids(self, entity_ids: List[int]) -> List[Tuple[int, int]]:
+        """[(chunk_id, match count)] sorted by count."""
+        return count_postings(self.indptr, self.ids, entity_ids)
+
+    def retrieve(self, text: str) -> List[Tuple[int, int]]:
+        return self.get_chunk_ids(self.parse(text))
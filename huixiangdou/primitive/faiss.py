@@ -2,21 +2,30 @@
 from __future__ import annotations
 
 import time
+import json
 import logging
 import os
 import pdb
 import pickle
+import hashlib
+import shutil
+from bisect import bisect_right
+from dataclasses import asdict, dataclass, fields
 from pathlib import Path
 from typing import (Any, Callable, Dict, Iterable, List, Optional, Sized,
                     Tuple, Union)
 
+from collections.abc import Sequence
+
 import numpy as np
 from loguru import logger
 from tqdm import tqdm
 
 from .embedder import Embedder
+from .embedding_cache import EmbeddingCache
 from .query import Query, DistanceStrategy
 from .chunk import Chunk
+from .chunk_store import ChunkStore
 
 try:
     import faiss
@@ -26,58 +35,184 @@ except ImportError:
         'Please install it with `pip install faiss-gpu` (for CUDA supported GPU) '
         'or `pip install faiss-cpu` (depending on Python version).')
 
+
+@dataclass
+class IndexConfig:
+    """ANN index options, read from `[feature_store]`.
+
+    index_type:
+        flat        exact search, 4*dim bytes per vector
+        hnsw        HNSW graph on float32 vectors, the default
+        hnsw_sq8    HNSW on 8-bit scalar quantized vectors, 1/4 memory
+        hnsw_fp16   HNSW on float16 vectors, 1/2 memory
+        ivf_flat    inverted lists of float32 vectors
+        ivf_pq      inverted lists of product quantized codes, `pq_m` bytes per vector
+
+    `hnsw_sq8`, `ivf_flat` and `ivf_pq` are trained on the first
+    `train_size` vectors. `ef_search` and `nprobe` are search time
+    defaults, they can be overridden per query.
+    """
+    index_type: str = 'hnsw'
+    hnsw_m: int = 16
+    ef_search: int = 128
+    nlist: int = 1024
+    nprobe: int = 16
+    pq_m: int = 64
+    train_size: int = 65536
+
+    TYPES = ['flat', 'hnsw', 'hnsw_sq8', 'hnsw_fp16', 'ivf_flat', 'ivf_pq']
+
+    def __post_init__(self):
+        if self.index_type not in self.TYPES:
+            raise ValueError('Unknown index_type {}, support {}'.format(self.index_type, self.TYPES))
+
+    @classmethod
+    def from_config(cls, config: Dict) -> IndexConfig:
+        """Pick known keys from config dict, missing keys use default."""
+        names = [f.name for f in fields(cls)]
+        return cls(**{k: v for k, v in config.items() if k in names})
+
+    def need_train(self) -> bool:
+        return self.index_type in ['hnsw_sq8', 'ivf_flat', 'ivf_pq']
+
+
 class Faiss():
 
-    def __init__(self, index: Any, chunks: List[Chunk], strategy:DistanceStrategy, k: int = 30):
-        """Initialize with necessary components."""
+    def __init__(self, index: Any, chunks: List[Chunk], strategy:DistanceStrategy, k: int = 30, deleted: Iterable[int] = [], index_config: IndexConfig = None):
+        """Initialize with necessary components.
+
+        `chunks[i]` is the chunk with id `i`. Chunk ids are stable across
+        incremental update, removed chunks are kept as tombstones in
+        `deleted` until `compact`.
+        """
         self.index = index
         self.chunks = chunks
         self.strategy = strategy
         self.k = k
+        self.deleted = set(deleted)
+        self.index_config = index_config if index_config is not None else IndexConfig()
+        # memory-mapped index can not be modified
+        self.readonly = False
+        # (chunk_ids, features) waiting for trained index build
+        self.pending = []
+
+    @property
+    def deleted(self) -> set:
+        return self._deleted
+
+    @deleted.setter
+    def deleted(self, value: Iterable[int]):
+        self._deleted = set(value)
+        self._selector = None
+
+    def deleted_selector(self):
+        """faiss selector skipping tombstones, None if nothing removed.
+
+        Tombstones only grow between assignments of `deleted`, the selector
+        is rebuilt when their count changes instead of per query.
+        """
+        if len(self._deleted) < 1:
+            return None
+        if self._selector is None or self._selector[0] != len(self._deleted):
+            ids = np.fromiter(self._deleted, dtype=np.int64, count=len(self._deleted))
+            batch = faiss.IDSelectorBatch(ids)
+            # `IDSelectorNot` keeps a raw pointer, hold `batch` with it
+            self._selector = (len(self._deleted), batch, faiss.IDSelectorNot(batch))
+        return self._selector[2]
+
+    def search_params(self, ef_search: int = None, nprobe: int = None):
+        """Build faiss search parameters of current index, None if index has
+        no knob and nothing removed."""
+        sel = self.deleted_selector()
+        index = self.index
+        if isinstance(index, faiss.IndexIDMap2):
+            index = index.index
+        index = faiss.downcast_index(index)
+        if isinstance(index, faiss.IndexHNSW):
+            params = faiss.SearchParametersHNSW(efSearch=ef_search or self.index_config.ef_search)
+        elif isinstance(index, faiss.IndexIVF):
+            params = faiss.SearchParametersIVF(nprobe=nprobe or self.index_config.nprobe)
+        elif sel is not None:
+            params = faiss.SearchParameters()
+        else:
+            return None
+        if sel is not None:
+            params.sel = sel
+        return params
+
+    def relevance(self, scores: np.ndarray) -> np.ndarray:
+        """Convert faiss distances to relevance scores, higher is more similar."""
+        if self.strategy == DistanceStrategy.EUCLIDEAN_DISTANCE:
+            return DistanceStrategy.euclidean_relevance_score_fn(scores)
+        elif self.strategy == DistanceStrategy.MAX_INNER_PRODUCT:
+            return DistanceStrategy.max_inner_product_relevance_score_fn(scores)
+        raise ValueError('self.strategy unset')
+
+    def similarity_search_batch(self,
+                                embeddings: np.ndarray,
+                                ef_search: int = None,
+                                nprobe: int = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Search N queries in one faiss call.
+
+        Args:
+            embeddings: Query features with shape (N, dim).
+            ef_search: HNSW search depth, default `index_config.ef_search`.
+            nprobe: IVF lists to visit, default `index_config.nprobe`.
+
+        Returns:
+            np.ndarray: relevance scores with shape (N, k), descending.
+            np.ndarray: chunk ids with shape (N, k). Empty slots have id -1
+                and score -inf.
+        """
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32).reshape(-1, self.index.d)
+        # tombstones are filtered inside faiss, k does not grow with them
+        params = self.search_params(ef_search=ef_search, nprobe=nprobe)
+        if params is None:
+            scores, indices = self.index.search(embeddings, self.k)
+        else:
+            scores, indices = self.index.search(embeddings, self.k, params=params)
+
+        invalid = indices < 0
+        scores = self.relevance(scores).astype(np.float32)
+        scores[invalid] = -np.inf
+        return scores, indices
 
     def similarity_search(self,
-                          embedding: np.ndarray) -> List[Tuple[Chunk, float]]:
+                          embedding: np.ndarray,
+                          ef_search: int = None,
+                          nprobe: int = None) -> List[Tuple[Chunk, float]]:
         """Return chunks most similar to query.
 
         Args:
             embedding: Embedding vector to look up chunk similar to.
-            k: Number of Documents to return. Defaults to 30.
+            ef_search: HNSW search depth, default `index_config.ef_search`.
+            nprobe: IVF lists to visit, default `index_config.nprobe`.
 
         Returns:
             List of chunks most similar to the query text and L2 distance
             in float for each. High score represents more similarity.
         """
-        embedding = embedding.astype(np.float32)
-        scores, indices = self.index.search(embedding, self.k)
+        scores, indices = self.similarity_search_batch(embeddings=embedding.reshape(1, -1), ef_search=ef_search, nprobe=nprobe)
         pairs = []
-        for j, i in enumerate(indices[0]):
-            if i == -1:
-                # no enough chunks are returned.
-                continue
-            chunk = self.chunks[i]
-            score = scores[0][j]
-
-            if self.strategy == DistanceStrategy.EUCLIDEAN_DISTANCE:
-                rel_score = DistanceStrategy.euclidean_relevance_score_fn(score)
-            elif self.strategy == DistanceStrategy.MAX_INNER_PRODUCT:
-                rel_score = DistanceStrategy.max_inner_product_relevance_score_fn(score)
-            else:
-                raise ValueError('self.strategy unset')
-            pairs.append((chunk, rel_score))
-        
-        if len(pairs) >= 2:
-            assert pairs[0][1] >= pairs[1][1]
+        for chunk_id, score in zip(indices[0], scores[0]):
+            if chunk_id < 0:
+                break
+            pairs.append((self.chunks[chunk_id], score))
         return pairs
 
     def similarity_search_with_query(self,
                                      embedder: Embedder,
                                      query: Query,
-                                     threshold: float = -1):
+                                     threshold: float = -1,
+                                     ef_search: int = None,
+                                     nprobe: int = None):
         """Return chunks most similar to query.
 
         Args:
             query: Multimodal query.
-            k: Number of Documents to return. Defaults to 30.
+            threshold: Drop chunks with score lower than it.
+            ef_search: HNSW search depth, default `index_config.ef_search`.
+            nprobe: IVF lists to visit, default `index_config.nprobe`.
 
         Returns:
             List of chunks most similar to the query text and L2 distance
@@ -92,7 +227,7 @@ class Faiss():
                 return []
 
         np_feature = embedder.embed_query(text=query.text, path=query.image)
-        pairs = self.similarity_search(embedding=np_feature)
+        pairs = self.similarity_search(embedding=np_feature, ef_search=ef_search, nprobe=nprobe)
         # ret = list(filter(lambda x: x[1] >= threshold, pairs))
 
         highest_score = -1.0
@@ -108,51 +243,66 @@ class Faiss():
         return ret
 
     @classmethod
-    def split_by_batchsize(self, chunks: List[Chunk] = [], batchsize:int = 4):
-        texts = [c for c in chunks if c.modal == 'text']
-        images = [c for c in chunks if c.modal == 'image']
+    def build_index(self, np_feature: np.ndarray, distance_strategy: DistanceStrategy, index_config: IndexConfig = None):
+        """Build an empty index wrapped by `IndexIDMap2`.
 
-        block_text = []
-        for i in range(0, len(texts), batchsize):
-            block_text.append(texts[i:i+batchsize])
+        `np_feature` gives the dimension, trained index types are trained
+        on it. IVF and PQ parameters shrink to fit a small sample, a sample
+        too small for PQ falls back to IVF-Flat.
+        """
+        config = index_config if index_config is not None else IndexConfig()
+        dimension = np_feature.shape[-1]
+        ntrain = len(np_feature)
+        if distance_strategy == DistanceStrategy.EUCLIDEAN_DISTANCE:
+            metric = faiss.METRIC_L2
+        elif distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT:
+            metric = faiss.METRIC_INNER_PRODUCT
+        else:
+            raise ValueError('Unknown distance {}'.format(distance_strategy))
 
-        block_image = []
-        for i in range(0, len(images), batchsize):
-            block_image.append(images[i:i+batchsize])
-        return block_text, block_image
+        index_type = config.index_type
+        if index_type == 'ivf_pq' and ntrain < 256:
+            # 8 bits PQ has 256 centroids per sub-quantizer
+            logger.warning('{} vectors not enough to train PQ, use ivf_flat'.format(ntrain))
+            index_type = 'ivf_flat'
 
-    @classmethod
-    def build_index(self, np_feature: np.ndarray, distance_strategy: DistanceStrategy):
-            dimension = np_feature.shape[-1]
-            M = 16
-            # max neighours for each node 
-            # see https://github.com/facebookresearch/faiss/wiki/Indexing-1M-vectors
-            if distance_strategy == DistanceStrategy.EUCLIDEAN_DISTANCE:
-                # index = faiss.IndexFlatL2(dimension)
-                index = faiss.IndexHNSWFlat(dimension, M, faiss.METRIC_L2)
-            elif distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT:
-                # index = faiss.IndexFlatIP(dimension)
-                index = faiss.IndexHNSWFlat(dimension, M, faiss.METRIC_IP)
+        # max neighours for each node
+        # see https://github.com/facebookresearch/faiss/wiki/Indexing-1M-vectors
+        M = config.hnsw_m
+        if index_type == 'flat':
+            index = faiss.IndexFlat(dimension, metric)
+        elif index_type == 'hnsw':
+            index = faiss.IndexHNSWFlat(dimension, M, metric)
+        elif index_type == 'hnsw_sq8':
+            index = faiss.IndexHNSWSQ(dimension, faiss.ScalarQuantizer.QT_8bit, M, metric)
+        elif index_type == 'hnsw_fp16':
+            index = faiss.IndexHNSWSQ(dimension, faiss.ScalarQuantizer.QT_fp16, M, metric)
+        else:
+            # faiss suggests at least 39 training vectors per list
+            nlist = max(1, min(config.nlist, ntrain // 39))
+            quantizer = faiss.IndexFlat(dimension, metric)
+            if index_type == 'ivf_flat':
+                index = faiss.IndexIVFFlat(quantizer, dimension, nlist, metric)
             else:
-                raise ValueError('Unknown distance {}'.format(distance_strategy))
-            index.hnsw.efSearch = 128
-            return index
+                pq_m = max(m for m in range(1, min(config.pq_m, dimension) + 1) if dimension % m == 0)
+                index = faiss.IndexIVFPQ(quantizer, dimension, nlist, pq_m, 8, metric)
 
-    @classmethod
-    def save_local(self, folder_path: str, chunks: List[Chunk],
-                   embedder: Embedder) -> None:
-        """Save FAISS index and store to disk.
+        if isinstance(index, faiss.IndexHNSW):
+            index.hnsw.efSearch = config.ef_search
+        if isinstance(index, faiss.IndexIVF):
+            index.nprobe = config.nprobe
+            # `compact` reconstructs vectors by id
+            index.make_direct_map()
+        if not index.is_trained:
+            logger.info('train {} index with {} vectors'.format(index_type, ntrain))
+            index.train(np.ascontiguousarray(np_feature, dtype=np.float32))
 
-        Args:
-            folder_path: folder path to save.
-            chunks: chunks to save.
-            embedder: embedding function.
-        """
+        # search result is chunk id instead of row number
+        return faiss.IndexIDMap2(index)
 
-        index = None
+    @classmethod
+    def get_batchsize(self) -> int:
         batchsize = 1
-        # max neighbours for each node
-
         try:
             batchsize_str = os.getenv('HUIXIANGDOU_BATCHSIZE')
             if batchsize_str is None:
@@ -162,91 +312,747 @@ class Faiss():
         except Exception as e:
             logger.error(str(e))
             batchsize = 1
+        return max(1, batchsize)
 
-        if batchsize == 1:
-            for chunk in tqdm(chunks, 'chunks'):
-                np_feature = None
-                try:
-                    if chunk.modal == 'text' or chunk.modal == 'qa':
-                        np_feature = embedder.embed_query(text=chunk.content_or_path)
-                    elif chunk.modal == 'image':
-                        np_feature = embedder.embed_query(path=chunk.content_or_path)
-                    else:
-                        raise ValueError(f'Unimplement chunk type: {chunk.modal}')
-                except Exception as e:
-                    logger.error('{}'.format(e))
-
-                if np_feature is None:
-                    logger.error('np_feature is None')
-                    continue
+    @classmethod
+    def embed_chunks(self, chunks: List[Chunk], ids: List[int],
+                     embedder: Embedder, cache: EmbeddingCache = None,
+                     batchsize: int = None, progress: bool = True) -> Iterable[Tuple[np.ndarray, np.ndarray]]:
+        """Embed chunks, yield (chunk_ids, features) block by block.
 
-                if index is None:
-                    index = self.build_index(np_feature=np_feature, distance_strategy=embedder.distance_strategy)
-                index.add(np_feature)
-        else:
-            # batching
-            block_text, block_image = self.split_by_batchsize(chunks=chunks, batchsize=batchsize)
-            for subchunks in tqdm(block_text, 'build_text'):
-                np_features = embedder.embed_query_batch_text(chunks=subchunks)
-                
-                if index is None:
-                    index = self.build_index(np_feature=np_features, distance_strategy=embedder.distance_strategy)
-                index.add(np_features)
-
-            for subchunks in tqdm(block_image, 'build_image'):
-                for chunk in subchunks:
+        Chunks failed to embed are skipped. If `cache` given, text features
+        are read from cache and only the misses are embedded. `batchsize`
+        defaults to env `HUIXIANGDOU_BATCHSIZE`.
+        """
+        if not batchsize:
+            batchsize = self.get_batchsize()
+        texts = [(i, c) for i, c in zip(ids, chunks) if c.modal != 'image']
+        images = [(i, c) for i, c in zip(ids, chunks) if c.modal == 'image']
+
+        if cache is not None and len(texts) > 0:
+            misses = []
+            block_size = 4096
+            for start in tqdm(range(0, len(texts), block_size), 'embedding_cache', disable=not progress):
+                block = texts[start:start + block_size]
+                features = cache.get([c.content_or_path for _, c in block])
+                hits = [k for k, feature in enumerate(features) if feature is not None]
+                misses += [block[k] for k, feature in enumerate(features) if feature is None]
+                if len(hits) > 0:
+                    yield np.array([block[k][0] for k in hits], dtype=np.int64), np.concatenate([features[k] for k in hits])
+            texts = misses
+            if progress:
+                logger.info(cache.summary())
+
+        if batchsize > 1:
+            for start in tqdm(range(0, len(texts), batchsize), 'build_text', disable=not progress):
+                block = texts[start:start + batchsize]
+                np_features = embedder.embed_query_batch_text(chunks=[c for _, c in block])
+                if cache is not None:
+                    cache.put([c.content_or_path for _, c in block], np_features)
+                yield np.array([i for i, _ in block], dtype=np.int64), np_features
+            texts = []
+
+        for i, chunk in tqdm(texts + images, 'chunks', disable=not progress):
+            np_feature = None
+            try:
+                if chunk.modal == 'text' or chunk.modal == 'qa':
+                    np_feature = embedder.embed_query(text=chunk.content_or_path)
+                elif chunk.modal == 'image':
                     np_feature = embedder.embed_query(path=chunk.content_or_path)
-                    if np_feature is None:
-                        logger.error('np_feature is None')
-                        continue
+                else:
+                    raise ValueError(f'Unimplement chunk type: {chunk.modal}')
+            except Exception as e:
+                logger.error('{}'.format(e))
+
+            if np_feature is None:
+                logger.error('np_feature is None')
+                continue
+            if cache is not None and chunk.modal != 'image':
+                cache.put([chunk.content_or_path], np_feature)
+            yield np.array([i], dtype=np.int64), np_feature
+
+    def is_updatable(self) -> bool:
+        """Old version index maps row number to chunk, not support incremental update."""
+        return self.index is None or isinstance(self.index, faiss.IndexIDMap2)
+
+    def add(self, chunks: List[Chunk], embedder: Embedder, cache: EmbeddingCache = None,
+            batchsize: int = None, flush: bool = True, progress: bool = True) -> List[int]:
+        """Embed and append chunks to index, return their chunk ids.
+
+        Streaming callers add small batches with `flush=False`, trained
+        index types keep buffering until `train_size` vectors, call
+        `flush_pending` after the last batch.
+        """
+        if not self.is_updatable():
+            raise ValueError('index type {} not support add, rebuild it'.format(type(self.index)))
+        if self.readonly:
+            raise ValueError('memory-mapped index is read-only')
+        if self.strategy == DistanceStrategy.UNKNOWN:
+            self.strategy = embedder.distance_strategy
+
+        ids = list(range(len(self.chunks), len(self.chunks) + len(chunks)))
+        self.chunks += chunks
+        missing = set(ids)
+        for block_ids, np_features in self.embed_chunks(chunks=chunks, ids=ids, embedder=embedder, cache=cache,
+                                                        batchsize=batchsize, progress=progress):
+            missing.difference_update(block_ids.tolist())
+            # trained index types wait for `train_size` vectors before build
+            if self.index is None and self.index_config.need_train():
+                self.pending.append((block_ids, np_features))
+                if sum(len(i) for i, _ in self.pending) >= self.index_config.train_size:
+                    self.flush_pending()
+                continue
+            if self.index is None:
+                self.index = self.build_index(np_feature=np_features, distance_strategy=self.strategy,
+                                              index_config=self.index_config)
+            self.index.add_with_ids(np_features, block_ids)
+        if flush:
+            self.flush_pending()
+
+        # chunks without feature can never be searched, mark them as removed
+        self.deleted.update(missing)
+        return ids
 
-                    if index is None:
-                        index = self.build_index(np_feature=np_feature, distance_strategy=embedder.distance_strategy)
-                    index.add(np_feature)
+    def flush_pending(self):
+        if len(self.pending) > 0:
+            self.add_pending(self.pending)
+            self.pending = []
 
+    def add_pending(self, pending: List[Tuple[np.ndarray, np.ndarray]]):
+        """Build index trained on pending features, then add them."""
+        block_ids = np.concatenate([ids for ids, _ in pending])
+        np_features = np.concatenate([features for _, features in pending]).astype(np.float32)
+        self.index = self.build_index(np_feature=np_features, distance_strategy=self.strategy,
+                                      index_config=self.index_config)
+        self.index.add_with_ids(np_features, block_ids)
+
+    def remove(self, chunk_ids: Iterable[int]):
+        """Tombstone chunks, HNSW does not support remove vectors in place."""
+        self.deleted.update(chunk_ids)
+
+    def live_chunks(self) -> Iterable[Tuple[int, Chunk]]:
+        """Yield (chunk_id, chunk) not removed."""
+        for chunk_id, chunk in enumerate(self.chunks):
+            if chunk_id not in self.deleted:
+                yield chunk_id, chunk
+
+    def tombstone_ratio(self) -> float:
+        if len(self.chunks) < 1:
+            return 0.0
+        return len(self.deleted) / len(self.chunks)
+
+    def compact(self) -> Dict[int, int]:
+        """Drop tombstones and rebuild index with continuous chunk ids.
+
+        Vectors are reconstructed from index, nothing is re-embedded. The
+        trained quantizer is reused, so lossy codes are not trained twice.
+
+        Returns:
+            Dict[int, int]: old chunk id to new chunk id.
+        """
+        if not self.is_updatable():
+            raise ValueError('index type {} not support compact, rebuild it'.format(type(self.index)))
+        if self.readonly:
+            raise ValueError('memory-mapped index is read-only')
+
+        live_ids = [chunk_id for chunk_id, _ in self.live_chunks()]
+        mapping = {old: new for new, old in enumerate(live_ids)}
+        remap = np.full(len(self.chunks), -1, dtype=np.int64)
+        remap[live_ids] = np.arange(len(live_ids), dtype=np.int64)
+
+        index = None
+        if self.index is not None and self.index.ntotal > 0:
+            row_ids = faiss.vector_to_array(self.index.id_map)
+            vectors = self.index.index.reconstruct_n(0, self.index.ntotal)
+            new_ids = remap[row_ids]
+            keep = new_ids >= 0
+            if np.any(keep):
+                # empty copy keeps trained quantizer and search parameters
+                inner = faiss.clone_index(self.index.index)
+                inner.reset()
+                if isinstance(faiss.downcast_index(inner), faiss.IndexIVF):
+                    faiss.extract_index_ivf(inner).make_direct_map()
+                index = faiss.IndexIDMap2(inner)
+                index.add_with_ids(vectors[keep], new_ids[keep])
+
+        logger.info('compact {} chunks to {}'.format(len(self.chunks), len(live_ids)))
+        self.index = index
+        self.chunks = [self.chunks[i] for i in live_ids]
+        self.deleted = set()
+        return mapping
+
+    def save(self, folder_path: str) -> None:
+        """Save FAISS index and store to disk."""
+        self.flush_pending()
+        if self.index is None:
+            logger.error('index is None, nothing to save')
+            return
         path = Path(folder_path)
         path.mkdir(exist_ok=True, parents=True)
 
         # save index separately since it is not picklable
-        faiss.write_index(index, str(path / 'embedding.faiss'))
+        faiss.write_index(self.index, str(path / 'embedding.faiss'))
 
-        # save chunks
+        # save chunks, columnar format for lazy load
+        ChunkStore.write(folder_path=folder_path, chunks=self.chunks)
         data = {
-            'chunks': chunks,
-            'strategy': str(embedder.distance_strategy)
+            'strategy': str(self.strategy),
+            'deleted': sorted(self.deleted),
+            'index_config': asdict(self.index_config)
         }
-        with open(path / 'chunks_and_strategy.pkl', 'wb') as f:
-            pickle.dump(data, f)
+        with open(path / 'strategy.json', 'w') as f:
+            json.dump(data, f)
+
+        legacy_path = path / 'chunks_and_strategy.pkl'
+        if legacy_path.exists():
+            legacy_path.unlink()
 
     @classmethod
-    def load_local(cls, folder_path: str) -> FAISS:
+    def save_local(cls, folder_path: str, chunks: List[Chunk],
+                   embedder: Embedder, cache: EmbeddingCache = None,
+                   index_config: IndexConfig = None) -> None:
+        """Save FAISS index and store to disk.
+
+        Args:
+            folder_path: folder path to save.
+            chunks: chunks to save.
+            embedder: embedding function.
+            cache: optional embedding cache, only embed missed chunks.
+            index_config: ANN index type and parameters, default HNSW.
+        """
+        store = cls(index=None, chunks=[], strategy=embedder.distance_strategy, index_config=index_config)
+        store.add(chunks=chunks, embedder=embedder, cache=cache)
+        store.save(folder_path)
+
+    @staticmethod
+    def parse_strategy(strategy_str: str) -> DistanceStrategy:
+        if 'EUCLIDEAN_DISTANCE' in strategy_str:
+            return DistanceStrategy.EUCLIDEAN_DISTANCE
+        elif 'MAX_INNER_PRODUCT' in strategy_str:
+            return DistanceStrategy.MAX_INNER_PRODUCT
+        raise ValueError('Unknown strategy type {}'.format(strategy_str))
+
+    @classmethod
+    def load_local(cls, folder_path: str, mmap: bool = False) -> Faiss:
         """Load FAISS index and chunks from disk.
 
+        Sharded database is loaded as `ShardedFaiss`, callers need not
+        know about shards.
+
         Args:
             folder_path: folder path to load index and chunks from index.faiss
-            index_name: for saving with a specific index file name
+            mmap: memory-map index and chunks for serving, the loaded
+                instance is read-only.
         """
+        if cls is Faiss and ShardedFaiss.exists(folder_path):
+            return ShardedFaiss.load_local(folder_path, mmap=mmap)
         path = Path(folder_path)
         # load index separately since it is not picklable
         
         t1 = time.time()
-        index = faiss.read_index(str(path / f'embedding.faiss'))
+        if mmap:
+            # `IO_FLAG_MMAP_IFC` maps flat codes of HNSW, old faiss only maps IVF lists
+            flag = getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP)
+            index = faiss.read_index(str(path / f'embedding.faiss'), flag)
+        else:
+            index = faiss.read_index(str(path / f'embedding.faiss'))
         strategy = DistanceStrategy.UNKNOWN
         t2 = time.time()
         
         # load docstore
-        with open(path / f'chunks_and_strategy.pkl', 'rb') as f:
-            data = pickle.load(f)
-            chunks = data['chunks']
-            strategy_str = data['strategy']
-
-            if 'EUCLIDEAN_DISTANCE' in strategy_str:
-                strategy = DistanceStrategy.EUCLIDEAN_DISTANCE
-            elif 'MAX_INNER_PRODUCT' in strategy_str:
-                strategy = DistanceStrategy.MAX_INNER_PRODUCT
-            else:
-                raise ValueError('Unknown strategy type {}'.format(strategy_str))
+        if ChunkStore.exists(folder_path):
+            chunks = ChunkStore(folder_path)
+            with open(path / 'strategy.json') as f:
+                data = json.load(f)
+        else:
+            with open(path / f'chunks_and_strategy.pkl', 'rb') as f:
+                data = pickle.load(f)
+                chunks = data['chunks']
+
+        strategy = cls.parse_strategy(data['strategy'])
+        deleted = data.get('deleted', [])
+        # old version index is HNSW built with default parameters
+        index_config = IndexConfig.from_config(data.get('index_config', {}))
 
         t3 = time.time()
         logger.info('Timecost for load dense, load faiss {} seconds, load chunk {} seconds'.format(int(t2-t1), int(t3-t2)))
-        return cls(index, chunks, strategy)
+        instance = cls(index, chunks, strategy, deleted=deleted, index_config=index_config)
+        instance.readonly = mmap
+        return instance
+
+
+def merge_topk(scores: List[np.ndarray], ids: List[np.ndarray], k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Merge per-partition (N, k_i) results into global top-k by relevance score, descending."""
+    scores = np.concatenate(scores, axis=1)
+    ids = np.concatenate(ids, axis=1)
+    order = np.argsort(-scores, axis=1, kind='stable')[:, 0:k]
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+
+class ShardedChunks(Sequence):
+    """Chunks of all shards as one read-only list, indexed by global chunk id."""
+
+    def __init__(self, owner: ShardedFaiss):
+        self.owner = owner
+
+    def __len__(self):
+        return self.owner.total()
+
+    def __getitem__(self, chunk_id: int) -> Chunk:
+        if chunk_id < 0:
+            chunk_id += len(self)
+        shard, local_id = self.owner.locate(chunk_id)
+        return shard.chunks[local_id]
+
+    def __iter__(self):
+        for shard, _ in self.owner.iter_shards():
+            yield from shard.chunks
+
+
+class ShardedFaiss(Faiss):
+    """Dense database split into fixed-size shards, for bounded-memory build.
+
+    Every `shard_size` chunks are sealed as a normal `Faiss` folder
+    `shard_xxxxx` (index plus chunk segment) and the manifest `shards.json`
+    is rewritten, so a crashed build keeps all sealed shards and `create`
+    resumes from them. Sealed shards are memory-mapped on demand, search
+    runs on each shard and merges top-k. Chunk ids are global, shard i
+    holds ids `[offset, offset + count)`.
+
+    Shards built by different processes or machines are combined with
+    `merge`, which only renumbers offsets and moves folders.
+    """
+    MANIFEST = 'shards.json'
+
+    def __init__(self, folder_path: str, strategy: DistanceStrategy, shard_size: int, k: int = 30,
+                 deleted: Iterable[int] = [], index_config: IndexConfig = None, shards: List[Dict] = None):
+        super().__init__(index=None, chunks=[], strategy=strategy, k=k, deleted=deleted, index_config=index_config)
+        self.folder_path = folder_path
+        self.shard_size = max(1, shard_size)
+        # manifest entries of sealed shards, {name, offset, count, digest, empty}
+        self.shards = shards if shards is not None else []
+        self.offsets = [s['offset'] for s in self.shards]
+        self.opened = dict()
+        # shard being built, not sealed yet
+        self.current = None
+        # sealed shards of a crashed build to verify, and chunks waiting for verify
+        self.resume_from = len(self.shards)
+        self.resume_buffer = []
+        # folder of the sealed shard reopened for append
+        self.reopened = None
+        # (embedder, cache, batchsize) of last `add`
+        self.last_add = (None, None, None)
+        self.chunks = ShardedChunks(self)
+
+    @classmethod
+    def exists(cls, folder_path: str) -> bool:
+        return os.path.exists(os.path.join(folder_path, cls.MANIFEST))
+
+    @classmethod
+    def clear(cls, folder_path: str):
+        """Remove shards and manifest in `folder_path`."""
+        if not os.path.exists(folder_path):
+            return
+        for name in os.listdir(folder_path):
+            if name.startswith('shard_'):
+                shutil.rmtree(os.path.join(folder_path, name), ignore_errors=True)
+        manifest_path = os.path.join(folder_path, cls.MANIFEST)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+
+    @staticmethod
+    def digest(chunks: Iterable[Chunk]) -> str:
+        md5 = hashlib.md5()
+        for chunk in chunks:
+            md5.update(chunk.content_or_path.encode('utf8', errors='ignore'))
+            md5.update(b'\0')
+        return md5.hexdigest()
+
+    @classmethod
+    def read_manifest(cls, folder_path: str) -> Dict:
+        with open(os.path.join(folder_path, cls.MANIFEST)) as f:
+            return json.load(f)
+
+    def write_manifest(self, complete: bool):
+        data = {
+            'strategy': str(self.strategy),
+            'index_config': asdict(self.index_config),
+            'shard_size': self.shard_size,
+            'shards': self.shards,
+            'deleted': sorted(self.deleted),
+            'complete': complete
+        }
+        path = os.path.join(self.folder_path, self.MANIFEST)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def create(cls, folder_path: str, strategy: DistanceStrategy, shard_size: int,
+               index_config: IndexConfig = None) -> ShardedFaiss:
+        """Start an empty sharded build in `folder_path`.
+
+        If an unfinished build with the same settings is there, its sealed
+        shards are kept. Chunks added again are compared with them shard by
+        shard, matched shards are not embedded twice; on the first mismatch
+        the rest of old shards are dropped.
+        """
+        index_config = index_config if index_config is not None else IndexConfig()
+        if cls.exists(folder_path):
+            data = cls.read_manifest(folder_path)
+            if not data['complete'] and data['shard_size'] == shard_size and \
+                    data['index_config'] == asdict(index_config) and len(data['shards']) > 0:
+                logger.info('resume sharded build in {}, {} shards sealed'.format(folder_path, len(data['shards'])))
+                instance = cls(folder_path=folder_path, strategy=strategy, shard_size=shard_size,
+                               deleted=data['deleted'], index_config=index_config, shards=data['shards'])
+                instance.resume_from = 0
+                return instance
+
+        cls.clear(folder_path)
+        os.makedirs(folder_path, exist_ok=True)
+        instance = cls(folder_path=folder_path, strategy=strategy, shard_size=shard_size, index_config=index_config)
+        instance.write_manifest(complete=False)
+        return instance
+
+    @classmethod
+    def load_local(cls, folder_path: str, mmap: bool = False) -> ShardedFaiss:
+        """Load manifest, shards are memory-mapped when first used.
+
+        Sealed shards are always memory-mapped, `mmap` only marks the
+        instance read-only.
+        """
+        data = cls.read_manifest(folder_path)
+        if not data['complete']:
+            logger.warning('sharded build in {} not finished, load {} sealed shards'.format(
+                folder_path, len(data['shards'])))
+        instance = cls(folder_path=folder_path, strategy=cls.parse_strategy(data['strategy']),
+                       shard_size=data['shard_size'], deleted=data['deleted'],
+                       index_config=IndexConfig.from_config(data['index_config']), shards=data['shards'])
+        instance.readonly = mmap
+        return instance
+
+    def sealed_total(self) -> int:
+        if len(self.shards) < 1:
+            return 0
+        return self.shards[-1]['offset'] + self.shards[-1]['count']
+
+    def total(self) -> int:
+        count = self.sealed_total()
+        if self.current is not None:
+            count += len(self.current.chunks)
+        return count
+
+    def shard(self, i: int) -> Faiss:
+        """Open sealed shard `i` memory-mapped, tombstones come from the manifest."""
+        if i in self.opened:
+            return self.opened[i]
+        entry = self.shards[i]
+        shard_dir = os.path.join(self.folder_path, entry['name'])
+        if entry.get('empty', False):
+            shard = Faiss(index=None, chunks=ChunkStore(shard_dir), strategy=self.strategy,
+                          index_config=self.index_config)
+        else:
+            shard = Faiss.load_local(shard_dir, mmap=True)
+            # search knobs set on the owner apply to all shards
+            shard.index_config = self.index_config
+        offset = entry['offset']
+        shard.deleted = set(i - offset for i in self.deleted if offset <= i < offset + entry['count'])
+        self.opened[i] = shard
+        return shard
+
+    def iter_shards(self) -> Iterable[Tuple[Faiss, int]]:
+        """Yield (shard, offset), sealed shards then the one being built."""
+        for i, entry in enumerate(self.shards):
+            yield self.shard(i), entry['offset']
+        if self.current is not None:
+            yield self.current, self.sealed_total()
+
+    def locate(self, chunk_id: int) -> Tuple[Faiss, int]:
+        """Return (shard, local chunk id) of global `chunk_id`."""
+        if chunk_id < 0 or chunk_id >= self.total():
+            raise IndexError('chunk id {} out of range'.format(chunk_id))
+        if chunk_id >= self.sealed_total():
+            return self.current, chunk_id - self.sealed_total()
+        i = bisect_right(self.offsets, chunk_id) - 1
+        return self.shard(i), chunk_id - self.offsets[i]
+
+    def is_updatable(self) -> bool:
+        return True
+
+    def search_params(self, ef_search: int = None, nprobe: int = None):
+        return None
+
+    def similarity_search_batch(self,
+                                embeddings: np.ndarray,
+                                ef_search: int = None,
+                                nprobe: int = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Search every shard and merge their top-k, see `Faiss.similarity_search_batch`."""
+        embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        all_scores = [np.full((len(embeddings), self.k), -np.inf, dtype=np.float32)]
+        all_ids = [np.full((len(embeddings), self.k), -1, dtype=np.int64)]
+        for shard, offset in self.iter_shards():
+            if shard.index is None or shard.index.ntotal < 1:
+                continue
+            shard.k = self.k
+            scores, ids = shard.similarity_search_batch(embeddings, ef_search=ef_search, nprobe=nprobe)
+            all_scores.append(scores)
+            all_ids.append(np.where(ids >= 0, ids + offset, -1))
+
+        return merge_topk(all_scores, all_ids, self.k)
+
+    def add(self, chunks: List[Chunk], embedder: Embedder, cache: EmbeddingCache = None,
+            batchsize: int = None, flush: bool = True, progress: bool = True) -> List[int]:
+        """Embed and append chunks, seal a shard every `shard_size` chunks."""
+        if self.readonly:
+            raise ValueError('memory-mapped index is read-only')
+        if self.strategy == DistanceStrategy.UNKNOWN:
+            self.strategy = embedder.distance_strategy
+
+        self.last_add = (embedder, cache, batchsize)
+        ids = []
+        chunks = self.resume(chunks, ids)
+        while len(chunks) > 0:
+            if self.current is None:
+                self.current = self.reopen()
+            offset = self.sealed_total()
+            room = self.shard_size - len(self.current.chunks)
+            local_ids = self.current.add(chunks=chunks[0:room], embedder=embedder, cache=cache,
+                                         batchsize=batchsize, flush=flush, progress=progress)
+            ids += [offset + i for i in local_ids]
+            chunks = chunks[room:]
+            if len(self.current.chunks) >= self.shard_size:
+                self.seal()
+        return ids
+
+    def resume(self, chunks: List[Chunk], ids: List[int]) -> List[Chunk]:
+        """Skip chunks already sealed by a crashed build, return the rest."""
+        while len(chunks) > 0 and self.resume_from < len(self.shards):
+            entry = self.shards[self.resume_from]
+            need = entry['count'] - len(self.resume_buffer)
+            self.resume_buffer += chunks[0:need]
+            chunks = chunks[need:]
+            if len(self.resume_buffer) < entry['count']:
+                break
+            if self.digest(self.resume_buffer) == entry['digest']:
+                ids += range(entry['offset'], entry['offset'] + entry['count'])
+                self.resume_buffer = []
+                self.resume_from += 1
+                continue
+            chunks = self.truncate() + chunks
+        return chunks
+
+    def truncate(self) -> List[Chunk]:
+        """Drop sealed shards not verified by `resume`, return chunks waiting for verify."""
+        if self.resume_from < len(self.shards):
+            logger.info('drop {} sealed shards from shard {}'.format(len(self.shards) - self.resume_from,
+                                                                        self.resume_from))
+            for entry in self.shards[self.resume_from:]:
+                shutil.rmtree(os.path.join(self.folder_path, entry['name']), ignore_errors=True)
+            self.shards = self.shards[0:self.resume_from]
+            self.offsets = self.offsets[0:self.resume_from]
+            total = self.sealed_total()
+            self.deleted = set(i for i in self.deleted if i < total)
+            for i in list(self.opened.keys()):
+                if i >= self.resume_from:
+                    self.opened.pop(i)
+            self.write_manifest(complete=False)
+
+        chunks = self.resume_buffer
+        self.resume_buffer = []
+        return chunks
+
+    def reopen(self) -> Faiss:
+        """Shard to append to, the last sealed shard if not full, so updates do not pile up tiny shards."""
+        if len(self.shards) > 0 and self.resume_from == len(self.shards):
+            entry = self.shards[-1]
+            if entry['count'] < self.shard_size and not entry.get('empty', False):
+                shard = Faiss.load_local(os.path.join(self.folder_path, entry['name']))
+                shard.index_config = self.index_config
+                shard.deleted = set(self.shard(len(self.shards) - 1).deleted)
+                self.opened.pop(len(self.shards) - 1)
+                self.shards.pop()
+                self.offsets.pop()
+                self.resume_from = len(self.shards)
+                # manifest keeps the old folder until the shard is sealed again under a new name
+                self.reopened = entry['name']
+                return shard
+        return Faiss(index=None, chunks=[], strategy=self.strategy, k=self.k, index_config=self.index_config)
+
+    def new_shard_name(self) -> str:
+        """Folder name not used by manifest, the reopened shard or leftovers of a crash."""
+        names = [s['name'] for s in self.shards]
+        if self.reopened is not None:
+            names.append(self.reopened)
+        names += [name for name in os.listdir(self.folder_path) if name.startswith('shard_')]
+        used = [int(name.split('_')[-1]) for name in names if name.split('_')[-1].isdigit()]
+        return 'shard_{:05d}'.format(max(used) + 1 if len(used) > 0 else 0)
+
+    def seal(self):
+        """Save the shard being built and record it in manifest."""
+        shard = self.current
+        if shard is None or len(shard.chunks) < 1:
+            self.current = None
+            return
+        shard.flush_pending()
+        name = self.new_shard_name()
+        shard_dir = os.path.join(self.folder_path, name)
+        offset = self.sealed_total()
+        entry = {'name': name, 'offset': offset, 'count': len(shard.chunks), 'digest': self.digest(shard.chunks)}
+        if shard.index is None:
+            # no chunk could be embedded, keep the segment for stable chunk ids
+            entry['empty'] = True
+            os.makedirs(shard_dir, exist_ok=True)
+            ChunkStore.write(folder_path=shard_dir, chunks=shard.chunks)
+        else:
+            shard.save(shard_dir)
+
+        self.deleted.update(offset + i for i in shard.deleted)
+        self.shards.append(entry)
+        self.offsets.append(offset)
+        self.resume_from = len(self.shards)
+        self.current = None
+        self.write_manifest(complete=False)
+        if self.reopened is not None:
+            shutil.rmtree(os.path.join(self.folder_path, self.reopened), ignore_errors=True)
+            self.reopened = None
+        logger.info('sealed {} with {} chunks'.format(name, entry['count']))
+
+    def flush_pending(self):
+        if len(self.resume_buffer) > 0:
+            # last chunks differ from the crashed build, embed them now
+            chunks = self.truncate()
+            embedder, cache, batchsize = self.last_add
+            self.add(chunks=chunks, embedder=embedder, cache=cache, batchsize=batchsize, flush=False, progress=False)
+        if self.current is not None:
+            self.current.flush_pending()
+
+    def remove(self, chunk_ids: Iterable[int]):
+        chunk_ids = set(chunk_ids)
+        self.deleted.update(chunk_ids)
+        for chunk_id in chunk_ids:
+            if 0 <= chunk_id < self.total():
+                shard, local_id = self.locate(chunk_id)
+                shard.deleted.add(local_id)
+
+    def live_chunks(self) -> Iterable[Tuple[int, Chunk]]:
+        for shard, offset in self.iter_shards():
+            for local_id, chunk in shard.live_chunks():
+                yield offset + local_id, chunk
+
+    def tombstone_ratio(self) -> float:
+        total = self.total()
+        if total < 1:
+            return 0.0
+        return len(self.deleted) / total
+
+    def compact(self) -> Dict[int, int]:
+        """Compact shards with tombstones one by one, drop emptied shards.
+
+        Compacted shards are written to new folders and old folders are
+        removed after the manifest points to the new ones, a crash at any
+        step leaves a loadable database.
+
+        Returns:
+            Dict[int, int]: old chunk id to new chunk id.
+        """
+        if self.readonly:
+            raise ValueError('memory-mapped index is read-only')
+        self.seal()
+        # folders of a crashed compact that never reached the manifest
+        names = set(entry['name'] for entry in self.shards)
+        obsolete = [os.path.join(self.folder_path, name) for name in os.listdir(self.folder_path)
+                    if name.startswith('shard_') and name not in names]
+        mapping = dict()
+        shards = []
+        offset = 0
+        for i, entry in enumerate(self.shards):
+            entry = dict(entry)
+            shard_dir = os.path.join(self.folder_path, entry['name'])
+            local_deleted = self.shard(i).deleted
+            if len(local_deleted) < 1:
+                local_mapping = {k: k for k in range(entry['count'])}
+            elif entry.get('empty', False) or len(local_deleted) >= entry['count']:
+                local_mapping = dict()
+                shard = Faiss(index=None, chunks=[], strategy=self.strategy, index_config=self.index_config)
+            else:
+                shard = Faiss.load_local(shard_dir)
+                shard.index_config = self.index_config
+                shard.deleted = set(local_deleted)
+                local_mapping = shard.compact()
+
+            for old, new in local_mapping.items():
+                mapping[entry['offset'] + old] = offset + new
+            if len(local_deleted) > 0:
+                obsolete.append(shard_dir)
+                if len(local_mapping) < 1:
+                    continue
+                entry['name'] = self.new_shard_name()
+                new_dir = os.path.join(self.folder_path, entry['name'])
+                if shard.index is None:
+                    entry['empty'] = True
+                    os.makedirs(new_dir, exist_ok=True)
+                    ChunkStore.write(folder_path=new_dir, chunks=shard.chunks)
+                else:
+                    shard.save(new_dir)
+                entry['count'] = len(shard.chunks)
+                entry['digest'] = self.digest(shard.chunks)
+            entry['offset'] = offset
+            offset += entry['count']
+            shards.append(entry)
+
+        logger.info('compact {} shards to {}'.format(len(self.shards), len(shards)))
+        self.shards = shards
+        self.offsets = [s['offset'] for s in shards]
+        self.opened = dict()
+        self.deleted = set()
+        self.resume_from = len(shards)
+        self.write_manifest(complete=False)
+        for shard_dir in obsolete:
+            shutil.rmtree(shard_dir, ignore_errors=True)
+        return mapping
+
+    def save(self, folder_path: str) -> None:
+        """Seal the last shard and mark the build complete."""
+        if os.path.abspath(folder_path) != os.path.abspath(self.folder_path):
+            raise ValueError('sharded index lives in {}, can not save to {}'.format(self.folder_path, folder_path))
+        self.flush_pending()
+        # sealed shards of a crashed build that were not added again
+        self.truncate()
+        self.seal()
+        self.write_manifest(complete=True)
+
+    @classmethod
+    def merge(cls, parts: List[str], folder_path: str) -> ShardedFaiss:
+        """Move shards of finished builds in `parts` into one database.
+
+        Chunk ids of part j follow the ids of part j-1.
+        """
+        cls.clear(folder_path)
+        os.makedirs(folder_path, exist_ok=True)
+        merged = None
+        for part in parts:
+            data = cls.read_manifest(part)
+            if not data['complete']:
+                raise ValueError('sharded build in {} not finished'.format(part))
+            if merged is None:
+                merged = cls(folder_path=folder_path, strategy=cls.parse_strategy(data['strategy']),
+                             shard_size=data['shard_size'], index_config=IndexConfig.from_config(data['index_config']))
+            elif data['index_config'] != asdict(merged.index_config):
+                raise ValueError('index_config of {} differs from other parts'.format(part))
+
+            base = merged.sealed_total()
+            for entry in data['shards']:
+                name = 'shard_{:05d}'.format(len(merged.shards))
+                shutil.move(os.path.join(part, entry['name']), os.path.join(folder_path, name))
+                merged.shards.append(dict(entry, name=name, offset=base + entry['offset']))
+                merged.offsets.append(base + entry['offset'])
+            merged.deleted.update(base + i for i in data['deleted'])
+            os.remove(os.path.join(part, cls.MANIFEST))
+
+        if merged is None:
+            raise ValueError('no part to merge')
+        merged.resume_from = len(merged.shards)
+        merged.write_manifest(complete=True)
+        logger.info('merged {} parts into {} shards'.format(len(parts), len(merged.shards)))
+        return merged
@@ -0,0 +1,120 @@
+"""Thin client of the local embedding and rerank inference service."""
+import json
+import socket
+import struct
+import threading
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+from loguru import logger
+
+
+def send_message(sock: socket.socket, header: Dict, payload: bytes = b''):
+    """Frame is 4 bytes header length, json header, then `header['payload']` bytes."""
+    header = dict(header)
+    header['payload'] = len(payload)
+    data = json.dumps(header, ensure_ascii=False).encode('utf8')
+    sock.sendall(struct.pack('>I', len(data)) + data + payload)
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < size:
+        part = sock.recv(size - len(buf))
+        if not part:
+            raise ConnectionError('inference socket closed')
+        buf += part
+    return bytes(buf)
+
+
+def recv_message(sock: socket.socket) -> Tuple[Dict, bytes]:
+    size = struct.unpack('>I', _recv_exact(sock, 4))[0]
+    header = json.loads(_recv_exact(sock, size).decode('utf8'))
+    payload = b''
+    if header.get('payload', 0) > 0:
+        payload = _recv_exact(sock, header['payload'])
+    return header, payload
+
+
+def pack_array(array: np.ndarray) -> Tuple[Dict, bytes]:
+    array = np.ascontiguousarray(array, dtype=np.float32)
+    return {'shape': list(array.shape)}, array.tobytes()
+
+
+def unpack_array(header: Dict, payload: bytes) -> np.ndarray:
+    return np.frombuffer(payload, dtype=np.float32).reshape(header['shape']).copy()
+
+
+class InferenceClient:
+    """Call `Embedder` and `LLMReranker` loaded once by `inference_server`.
+
+    Each thread keeps its own connection to the unix socket, the server
+    batches concurrent embed requests from all worker processes.
+
+    Example:
+
+        .. code-block:: python
+
+            client = InferenceClient('/tmp/huixiangdou_inference.sock')
+            feature = client.embed(text='how to install mmpose ?')
+    """
+
+    def __init__(self, socket_path: str, timeout: float = 120):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _connect(self) -> socket.socket:
+        sock = getattr(self.local, 'sock', None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            self.local.sock = sock
+        return sock
+
+    def close(self):
+        sock = getattr(self.local, 'sock', None)
+        if sock is not None:
+            sock.close()
+            self.local.sock = None
+
+    def call(self, header: Dict, payload: bytes = b'') -> Tuple[Dict, bytes]:
+        """Send one request, reconnect once if the server restarted."""
+        for retry in range(2):
+            try:
+                sock = self._connect()
+                send_message(sock, header, payload)
+                ret_header, ret_payload = recv_message(sock)
+                break
+            except (ConnectionError, BrokenPipeError, socket.timeout) as e:
+                self.close()
+                if retry > 0:
+                    raise e
+                logger.warning('inference service {} disconnected, retry'.format(self.socket_path))
+
+        if ret_header.get('error'):
+            raise ValueError('inference service error: {}'.format(ret_header['error']))
+        return ret_header, ret_payload
+
+    def info(self) -> Dict[str, Any]:
+        """Model type and properties of server side embedder."""
+        header, _ = self.call({'method': 'info'})
+        return header
+
+    def embed(self, text: str = None, path: str = None) -> np.ndarray:
+        header, payload = self.call({'method': 'embed', 'text': text, 'path': path})
+        return unpack_array(header, payload)
+
+    def embed_batch(self, texts: List[str]) -> np.ndarray:
+        header, payload = self.call({'method': 'embed_batch', 'texts': texts})
+        return unpack_array(header, payload)
+
+    def token_length(self, text: str) -> int:
+        header, _ = self.call({'method': 'token_length', 'text': text})
+        return header['length']
+
+    def rerank(self, query: str, texts: List[str]) -> List[int]:
+        """Return indexes of `texts`, descending by relevance."""
+        header, _ = self.call({'method': 'rerank', 'query': query, 'texts': texts})
+        return header['indexes']
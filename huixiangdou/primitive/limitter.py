@@ -1,121 +1,211 @@
-import time
+"""Rate limit of remote API, requests and tokens per minute.
+
+Limits are GCRA token buckets. A caller reserves its cost first and then
+sleeps until the reserved time, so waiters are served in arrival order and
+a bucket allows about `rate + burst` in any 60 seconds at most. The
+bucket state is a single timestamp, it can live in a file or Redis to
+share one budget among all worker processes.
+"""
 import asyncio
-from datetime import datetime, timedelta
+import os
+import re
+import threading
+import time
+from typing import Optional
+
 from loguru import logger
 
+
+class LocalState:
+    """Bucket state of this process."""
+
+    def __init__(self):
+        self.tat = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self, increment: float, tolerance: float) -> float:
+        """Move theoretical arrival time by `increment`, return seconds to wait."""
+        with self.lock:
+            now = time.time()
+            start = max(self.tat, now)
+            self.tat = start + increment
+            return start + min(increment, tolerance) - tolerance - now
+
+    def peek(self) -> float:
+        return self.tat
+
+
+class FileState:
+    """Bucket state in a locked file, shared by processes on one node.
+
+    Put it under /dev/shm to keep it in memory.
+    """
+
+    def __init__(self, path: str):
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+
+    def reserve(self, increment: float, tolerance: float) -> float:
+        import fcntl
+        with self.lock, open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                text = f.read().strip()
+                now = time.time()
+                start = max(float(text) if text else 0.0, now)
+                f.seek(0)
+                f.truncate()
+                f.write(repr(start + increment))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return start + min(increment, tolerance) - tolerance - now
+
+    def peek(self) -> float:
+        if not os.path.exists(self.path):
+            return 0.0
+        with open(self.path) as f:
+            text = f.read().strip()
+        try:
+            return float(text) if text else 0.0
+        except ValueError:
+            # partially written by another process
+            return 0.0
+
+
+class RedisState:
+    """Bucket state in Redis, shared by all nodes.
+
+    The reservation is one Lua script on Redis server time, so clock skew
+    of nodes does not matter.
+    """
+    SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local start = tonumber(redis.call('GET', KEYS[1]) or '0')
+if start < now then start = now end
+local increment = tonumber(ARGV[1])
+local tolerance = tonumber(ARGV[2])
+local tat = start + increment
+redis.call('SET', KEYS[1], tostring(tat), 'PX', math.ceil((tat - now) * 1000) + 1000)
+return tostring(start + math.min(increment, tolerance) - tolerance - now)
+"""
+
+    def __init__(self, url: str, key: str):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.key = 'HuixiangDou:rate_limit:{}'.format(key)
+        self.script = self.client.register_script(self.SCRIPT)
+
+    def reserve(self, increment: float, tolerance: float) -> float:
+        return float(self.script(keys=[self.key], args=[increment, tolerance]))
+
+    def peek(self) -> float:
+        # server time, compared with local clock it is an estimate for routing
+        value = self.client.get(self.key)
+        return float(value) if value is not None else 0.0
+
+
+def build_state(store: str = '', key: str = 'default'):
+    """Build bucket state from `rate_limit_store` config.
+
+    Args:
+        store: "" for this process, "file:/dev/shm/huixiangdou" for processes on
+            one node, "redis://:password@host:6379/0" for all nodes.
+        key: Budget name, callers with the same key share one budget.
+    """
+    if not store:
+        return LocalState()
+    if store.startswith('file:'):
+        filename = re.sub(r'[^A-Za-z0-9_.-]', '_', key)
+        return FileState(os.path.join(store[len('file:'):], filename))
+    if store.startswith('redis://') or store.startswith('rediss://') or store.startswith('unix://'):
+        return RedisState(store, key)
+    raise ValueError('Unknown rate limit store {}'.format(store))
+
+
+class TokenBucket:
+    """GCRA token bucket, `rate` tokens per `period` seconds with `burst`
+    tokens allowed at once.
+
+    A cost larger than `burst` waits for a full bucket and then runs,
+    later callers wait for the overdraft.
+    """
+
+    def __init__(self, rate: float, period: float = 60.0, burst: Optional[float] = None, state=None):
+        if rate <= 0:
+            raise ValueError('rate {} should be positive'.format(rate))
+        self.rate = rate
+        self.interval = period / rate
+        if burst is None:
+            # a tenth of the period, no 2x burst at minute boundary
+            burst = max(1.0, rate / 10)
+        self.burst = burst
+        self.state = state if state is not None else LocalState()
+
+    def reserve(self, cost: float = 1) -> float:
+        """Take `cost` tokens, return seconds to wait before using them."""
+        return max(0.0, self.state.reserve(cost * self.interval, self.burst * self.interval))
+
+    def delay(self, cost: float = 1) -> float:
+        """Seconds `cost` would wait now, without taking tokens."""
+        now = time.time()
+        increment = cost * self.interval
+        tolerance = self.burst * self.interval
+        return max(0.0, max(self.state.peek(), now) + min(increment, tolerance) - tolerance - now)
+
+    def wait_sync(self, cost: float = 1) -> float:
+        delay = self.reserve(cost)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    async def wait(self, cost: float = 1) -> float:
+        delay = self.reserve(cost)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return delay
+
+
 class RPM:
+    """Requests per minute."""
 
-    def __init__(self, rpm: int = 1000):
+    def __init__(self, rpm: int = 1000, store: str = '', key: str = 'rpm'):
         self.rpm = rpm
-        self.record = {'slot': self.get_minute_slot(), 'counter': 0}
-
-    def get_minute_slot(self):
-        current_time = time.time()
-        dt_object = datetime.fromtimestamp(current_time)
-        total_minutes_since_midnight = dt_object.hour * 60 + dt_object.minute
-        return total_minutes_since_midnight
+        self.bucket = TokenBucket(rate=rpm, state=build_state(store, key))
 
     def wait_sync(self, silent=False):
-        current = time.time()
-        dt_object = datetime.fromtimestamp(current)
-        minute_slot = self.get_minute_slot()
-
-        if self.record['slot'] == minute_slot:
-            # check RPM exceed
-            if self.record['counter'] >= self.rpm:
-                # wait until next minute
-                next_minute = dt_object.replace(
-                    second=0, microsecond=0) + timedelta(minutes=1)
-                _next = next_minute.timestamp()
-                sleep_time = abs(_next - current)
-                time.sleep(sleep_time)
-
-                self.record = {'slot': self.get_minute_slot(), 'counter': 0}
-        else:
-            self.record = {'slot': self.get_minute_slot(), 'counter': 0}
-        self.record['counter'] += 1
-
-        if not silent:
-            logger.debug(self.record)
+        delay = self.bucket.wait_sync(1)
+        if not silent and delay > 0:
+            logger.debug('rpm {} exceeded, waited {:.2f}s'.format(self.rpm, delay))
 
     async def wait(self, silent=False):
-        current = time.time()
-        dt_object = datetime.fromtimestamp(current)
-        minute_slot = self.get_minute_slot()
-
-        if self.record['slot'] == minute_slot:
-            # check RPM exceed
-            if self.record['counter'] >= self.rpm:
-                # wait until next minute
-                next_minute = dt_object.replace(
-                    second=0, microsecond=0) + timedelta(minutes=1)
-                _next = next_minute.timestamp()
-                sleep_time = abs(_next - current)
-                asyncio.sleep(sleep_time)
-
-                self.record = {'slot': self.get_minute_slot(), 'counter': 0}
-        else:
-            self.record = {'slot': self.get_minute_slot(), 'counter': 0}
-        self.record['counter'] += 1
-
-        if not silent:
-            logger.debug(self.record)
+        delay = await self.bucket.wait(1)
+        if not silent and delay > 0:
+            logger.debug('rpm {} exceeded, waited {:.2f}s'.format(self.rpm, delay))
+
 
 class TPM:
+    """Tokens per minute."""
 
-    def __init__(self, tpm: int = 20000):
+    def __init__(self, tpm: int = 20000, store: str = '', key: str = 'tpm'):
         self.tpm = tpm
-        self.record = {'slot': self.get_minute_slot(), 'counter': 0}
-
-    def get_minute_slot(self):
-        current_time = time.time()
-        dt_object = datetime.fromtimestamp(current_time)
-        total_minutes_since_midnight = dt_object.hour * 60 + dt_object.minute
-        return total_minutes_since_midnight
-
+        self.bucket = TokenBucket(rate=tpm, state=build_state(store, key))
 
     def wait_sync(self, token_count, silent=False):
-            current = time.time()
-            dt_object = datetime.fromtimestamp(current)
-            minute_slot = self.get_minute_slot()
-            self.record['counter'] += token_count
-
-            if self.record['slot'] == minute_slot:
-                # check RPM exceed
-                if self.record['counter'] >= self.tpm:
-                    # wait until next minute
-                    next_minute = dt_object.replace(
-                        second=0, microsecond=0) + timedelta(minutes=1)
-                    _next = next_minute.timestamp()
-                    sleep_time = abs(_next - current)
-                    time.sleep(sleep_time)
-
-                    self.record = {'slot': self.get_minute_slot(), 'counter': 0}
-            else:
-                self.record = {'slot': self.get_minute_slot(), 'counter': 0}
-
-            if not silent:
-                logger.debug(self.record)
+        delay = self.bucket.wait_sync(token_count)
+        if not silent and delay > 0:
+            logger.debug('tpm {} exceeded, waited {:.2f}s'.format(self.tpm, delay))
 
     async def wait(self, token_count, silent=False):
-        current = time.time()
-        dt_object = datetime.fromtimestamp(current)
-        minute_slot = self.get_minute_slot()
-        self.record['counter'] += token_count
-
-        if self.record['slot'] == minute_slot:
-            # check RPM exceed
-            if self.record['counter'] >= self.tpm:
-                # wait until next minute
-                next_minute = dt_object.replace(
-                    second=0, microsecond=0) + timedelta(minutes=1)
-                _next = next_minute.timestamp()
-                sleep_time = abs(_next - current)
-                asyncio.sleep(sleep_time)
-
-                self.record = {'slot': self.get_minute_slot(), 'counter': 0}
-        else:
-            self.record = {'slot': self.get_minute_slot(), 'counter': 0}
-
-        if not silent:
-            logger.debug(self.record)
+        delay = await self.bucket.wait(token_count)
+        if not silent and delay > 0:
+            logger.debug('tpm {} exceeded, waited {:.2f}s'.format(self.tpm, delay))
+
+    def charge(self, token_count):
+        """Count tokens already used, e.g. LLM output, later callers wait for them."""
+        self.bucket.reserve(token_count)
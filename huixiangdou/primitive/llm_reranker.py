@@ -9,6 +9,8 @@ import numpy as np
 
 from .chunk import Chunk
 from .embedder import Embedder
+from .inference_client import InferenceClient
+from .onnx_encoder import OnnxEncoder
 from .limitter import RPM
 from .utils import always_get_an_event_loop
 from loguru import logger
@@ -24,9 +26,20 @@ class LLMReranker:
 
         model_name_or_path = model_config['reranker_model_path']
         self._type = self.model_type(model_path=model_name_or_path)
+        if self._type == 'bce' and model_config.get('model_backend', 'torch') == 'onnx':
+            self._type = 'onnx'
         self.topn = topn
 
-        if 'bge' in self._type:
+        # local model served by `huixiangdou.services.inference_server`, shared by worker processes
+        self.inference = None
+        inference_socket = model_config.get('inference_socket', '')
+        if inference_socket and self._type in ['bce', 'bge', 'onnx']:
+            self.inference = InferenceClient(socket_path=inference_socket)
+            logger.info('reranker {} use inference service {}'.format(model_name_or_path, inference_socket))
+        elif 'onnx' in self._type:
+            self.onnx_client = OnnxEncoder(**OnnxEncoder.options(model_path=model_name_or_path, model_config=model_config),
+                                           task='rerank')
+        elif 'bge' in self._type:
             import torch
             from transformers import AutoModelForCausalLM, AutoTokenizer
 
@@ -51,7 +64,7 @@ class LLMReranker:
             api_rpm = max(1, int(model_config['api_rpm']))
             self.client = {
                 'api_token': api_token,
-                'api_rpm': RPM(api_rpm)
+                'api_rpm': RPM(api_rpm, store=model_config.get('rate_limit_store', ''), key='reranker:siliconcloud:rpm')
             }
 
         else:
@@ -123,6 +136,9 @@ class LLMReranker:
     def _sort(self, texts: List[str], query: str):
         """Rerank input texts, return descending indexes, indexes[0] is the
         nearest chunk."""
+        if self.inference is not None:
+            return self.inference.rerank(query=query, texts=texts)[0:self.topn]
+
         pairs = []
         for text in texts:
             pairs.append([query, text])
@@ -139,6 +155,8 @@ class LLMReranker:
                     for scores in all_scores[0]
                 ]
                 scores = scores[0].cpu().numpy()
+        elif 'onnx' in self._type:
+            scores = self.onnx_client.score(pairs)
         elif 'bce' in self._type:
             scores_list = self.bce_client.compute_score(pairs)
             scores = np.array(scores_list)
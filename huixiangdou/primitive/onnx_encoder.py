@@ -0,0 +1,206 @@
+"""ONNX Runtime CPU backend of local bce text2vec and reranker models."""
+import hashlib
+import json
+import os
+from typing import Iterable, List, Tuple
+
+import numpy as np
+from loguru import logger
+
+
+class OnnxEncoder:
+    """Run exported transformer encoder with onnxruntime.
+
+    The graph is exported from `model_path` once and cached in
+    `cache_dir/<model hash>/<task>`:
+        model.onnx          fp32 graph
+        model.int8.onnx     dynamic int8 quantized graph, if `quantize`
+        meta.json           task, pooling and max length
+        tokenizer files
+
+    Inputs are sorted by token length and padded per batch, short texts
+    never pay for the longest one.
+
+    Args:
+        model_path: Local dir or huggingface repo id.
+        cache_dir: Where exported graph is cached, usually `work_dir/onnx`.
+        task: `embedding` outputs normalized sentence features, `rerank`
+            outputs sigmoid relevance scores of (query, passage) pairs.
+        quantize: Use dynamic int8 quantized graph.
+        intra_threads: Threads inside one operator, 0 for onnxruntime default.
+        inter_threads: Threads across operators.
+        batch_size: Max texts per forward.
+        max_length: Truncate tokens.
+    """
+
+    def __init__(self,
+                 model_path: str,
+                 cache_dir: str,
+                 task: str = 'embedding',
+                 quantize: bool = True,
+                 intra_threads: int = 0,
+                 inter_threads: int = 1,
+                 batch_size: int = 32,
+                 max_length: int = 512):
+        if task not in ['embedding', 'rerank']:
+            raise ValueError('Unknown onnx task {}'.format(task))
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        model_key = hashlib.md5(model_path.encode('utf8')).hexdigest()[0:16]
+        self.dir = os.path.join(cache_dir, model_key, task)
+        self.task = task
+        self.batch_size = max(1, batch_size)
+
+        onnx_path = os.path.join(self.dir, 'model.onnx')
+        if not os.path.exists(onnx_path):
+            self.export(model_path=model_path, onnx_dir=self.dir, task=task, max_length=max_length)
+        if quantize:
+            onnx_path = self.quantize(onnx_path)
+
+        with open(os.path.join(self.dir, 'meta.json')) as f:
+            meta = json.load(f)
+        self.pooling = meta.get('pooling', 'cls')
+        self.max_length = min(max_length, meta.get('max_length', max_length))
+
+        self.tokenizer = AutoTokenizer.from_pretrained(self.dir)
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_threads
+        options.inter_op_num_threads = inter_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        logger.info('onnx {} loaded from {}'.format(task, onnx_path))
+
+    @staticmethod
+    def options(model_path: str, model_config: dict) -> dict:
+        """Constructor kwargs from `[feature_store]` config."""
+        cache_dir = model_config.get('onnx_dir', '')
+        if not cache_dir:
+            cache_dir = os.path.join(model_config.get('work_dir', 'workdir'), 'onnx')
+        return {
+            'model_path': model_path,
+            'cache_dir': cache_dir,
+            'quantize': bool(model_config.get('onnx_quantize', True)),
+            'intra_threads': int(model_config.get('onnx_intra_threads', 0)),
+            'inter_threads': int(model_config.get('onnx_inter_threads', 1)),
+            'batch_size': int(model_config.get('onnx_batch_size', 32))
+        }
+
+    @staticmethod
+    def export(model_path: str, onnx_dir: str, task: str, max_length: int = 512):
+        """Export huggingface model to onnx, needs torch only this time."""
+        import torch
+        from transformers import (AutoModel, AutoModelForSequenceClassification,
+                                  AutoTokenizer)
+
+        logger.info('export {} to {}, it takes a while'.format(model_path, onnx_dir))
+        if not os.path.exists(onnx_dir):
+            os.makedirs(onnx_dir)
+        tokenizer = AutoTokenizer.from_pretrained(model_path)
+        if task == 'embedding':
+            model = AutoModel.from_pretrained(model_path)
+            output_name = 'last_hidden_state'
+        else:
+            model = AutoModelForSequenceClassification.from_pretrained(model_path)
+            output_name = 'logits'
+        model.eval()
+
+        class Wrapper(torch.nn.Module):
+            """Return plain tensor instead of `ModelOutput`."""
+
+            def __init__(self, model):
+                super().__init__()
+                self.model = model
+
+            def forward(self, input_ids, attention_mask):
+                return self.model(input_ids=input_ids, attention_mask=attention_mask, return_dict=False)[0]
+
+        inputs = tokenizer(['hello world'], return_tensors='pt')
+        dynamic_axes = {
+            'input_ids': {0: 'batch', 1: 'sequence'},
+            'attention_mask': {0: 'batch', 1: 'sequence'},
+            output_name: {0: 'batch', 1: 'sequence'} if task == 'embedding' else {0: 'batch'}
+        }
+        tmp_path = os.path.join(onnx_dir, 'model.onnx.tmp')
+        with torch.no_grad():
+            torch.onnx.export(Wrapper(model), (inputs['input_ids'], inputs['attention_mask']),
+                              tmp_path,
+                              input_names=['input_ids', 'attention_mask'],
+                              output_names=[output_name],
+                              dynamic_axes=dynamic_axes,
+                              opset_version=14)
+        tokenizer.save_pretrained(onnx_dir)
+
+        # sentence-transformers pooling, bce uses CLS
+        pooling = 'cls'
+        pooling_path = os.path.join(model_path, '1_Pooling', 'config.json')
+        if os.path.exists(pooling_path):
+            with open(pooling_path) as f:
+                if json.load(f).get('pooling_mode_mean_tokens'):
+                    pooling = 'mean'
+        with open(os.path.join(onnx_dir, 'meta.json'), 'w') as f:
+            json.dump({'model': model_path, 'task': task, 'pooling': pooling, 'max_length': max_length}, f)
+        # meta is ready before the graph becomes visible
+        os.replace(tmp_path, os.path.join(onnx_dir, 'model.onnx'))
+
+    @staticmethod
+    def quantize(onnx_path: str) -> str:
+        """Dynamic int8 quantize weights, return quantized graph path."""
+        int8_path = onnx_path.replace('.onnx', '.int8.onnx')
+        if not os.path.exists(int8_path):
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+            logger.info('quantize {} to int8'.format(onnx_path))
+            tmp_path = int8_path + '.tmp'
+            quantize_dynamic(onnx_path, tmp_path, weight_type=QuantType.QInt8)
+            os.replace(tmp_path, int8_path)
+        return int8_path
+
+    def token_length(self, text: str) -> int:
+        return len(self.tokenizer(text, padding=False, truncation=False)['input_ids'])
+
+    def _buckets(self, encodings: List[List[int]]) -> List[np.ndarray]:
+        """Group input indexes with similar length."""
+        order = np.argsort([len(e) for e in encodings], kind='stable')
+        return [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+
+    def _forward(self, encodings: List[List[int]]) -> Iterable[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """Yield (input indexes, output, attention mask) per length bucket."""
+        pad_id = self.tokenizer.pad_token_id or 0
+        for indexes in self._buckets(encodings):
+            length = max(len(encodings[i]) for i in indexes)
+            input_ids = np.full((len(indexes), length), pad_id, dtype=np.int64)
+            attention_mask = np.zeros((len(indexes), length), dtype=np.int64)
+            for row, i in enumerate(indexes):
+                input_ids[row, 0:len(encodings[i])] = encodings[i]
+                attention_mask[row, 0:len(encodings[i])] = 1
+            feeds = {'input_ids': input_ids, 'attention_mask': attention_mask}
+            if 'token_type_ids' in self.input_names:
+                feeds['token_type_ids'] = np.zeros_like(input_ids)
+            output = self.session.run(None, feeds)[0]
+            yield indexes, output, attention_mask
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Normalized features with shape (N, dim), np.float32."""
+        encodings = self.tokenizer(texts, padding=False, truncation=True, max_length=self.max_length)['input_ids']
+        features = None
+        for indexes, hidden, attention_mask in self._forward(encodings):
+            if self.pooling == 'mean':
+                mask = attention_mask[:, :, None].astype(np.float32)
+                pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+            else:
+                pooled = hidden[:, 0]
+            if features is None:
+                features = np.zeros((len(texts), pooled.shape[-1]), dtype=np.float32)
+            features[indexes] = pooled
+        norm = np.linalg.norm(features, axis=1, keepdims=True)
+        return features / np.maximum(norm, 1e-12)
+
+    def score(self, pairs: List[Tuple[str, str]]) -> np.ndarray:
+        """Relevance of (query, passage) pairs in [0, 1]."""
+        encodings = self.tokenizer([p[0] for p in pairs], [p[1] for p in pairs],
+                                   padding=False, truncation=True, max_length=self.max_length)['input_ids']
+        scores = np.zeros(len(pairs), dtype=np.float32)
+        for indexes, logits, _ in self._forward(encodings):
+            scores[indexes] = logits.reshape(len(indexes), -1)[:, 0]
+        return 1 / (1 + np.exp(-scores))
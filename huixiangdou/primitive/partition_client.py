@@ -0,0 +1,262 @@
+"""Scatter-gather dense search over partitions served by `partition_server`."""
+import socket
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import asdict
+from typing import Any, Dict, List, Tuple, Union
+
+import numpy as np
+from loguru import logger
+
+from .chunk import Chunk
+from .faiss import Faiss, IndexConfig, merge_topk
+from .inference_client import pack_array, recv_message, send_message, unpack_array
+from .query import DistanceStrategy
+
+
+def parse_address(address: str) -> Tuple[int, Union[str, Tuple[str, int]]]:
+    """`unix:/path` or `/path` is a unix socket, `host:port` is TCP.
+
+    Returns:
+        (socket family, address for `connect` or `bind`)
+    """
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    if address.startswith('/') or ':' not in address:
+        return socket.AF_UNIX, address
+    host, port = address.rsplit(':', 1)
+    return socket.AF_INET, (host, int(port))
+
+
+def chunk_to_dict(chunk: Chunk) -> Dict:
+    return asdict(chunk)
+
+
+def chunk_from_dict(data: Dict) -> Chunk:
+    return Chunk(**data)
+
+
+class PartitionClient:
+    """Connections to one partition server.
+
+    A connection is used by one request at a time. A request that times
+    out or fails closes its connection, so a late reply never reaches the
+    next request.
+    """
+
+    def __init__(self, address: str, timeout: float = 1.0):
+        self.address = address
+        self.family, self.sockaddr = parse_address(address)
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+        self.info = None
+
+    def _connect(self) -> socket.socket:
+        with self.lock:
+            if len(self.idle) > 0:
+                return self.idle.pop()
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.sockaddr)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def close(self):
+        with self.lock:
+            for sock in self.idle:
+                sock.close()
+            self.idle = []
+
+    def call(self, header: Dict, payload: bytes = b'') -> Tuple[Dict, bytes]:
+        sock = self._connect()
+        try:
+            send_message(sock, header, payload)
+            ret_header, ret_payload = recv_message(sock)
+        except Exception:
+            sock.close()
+            raise
+        with self.lock:
+            self.idle.append(sock)
+        if ret_header.get('error'):
+            raise ValueError('partition {} error: {}'.format(self.address, ret_header['error']))
+        return ret_header, ret_payload
+
+    def get_info(self) -> Dict[str, Any]:
+        """Chunk id ranges, tombstones and distance strategy, cached after first success."""
+        if self.info is None:
+            self.info, _ = self.call({'method': 'info'})
+        return self.info
+
+    def search(self, embeddings: np.ndarray, k: int, ef_search: int = None,
+               nprobe: int = None) -> Tuple[np.ndarray, np.ndarray, Dict[int, Chunk]]:
+        """Return (scores, global chunk ids, hit chunks by id) of this partition."""
+        header, payload = pack_array(embeddings)
+        header.update({'method': 'search', 'k': k, 'ef_search': ef_search, 'nprobe': nprobe})
+        ret_header, ret_payload = self.call(header, payload)
+        scores = unpack_array(ret_header, ret_payload)
+        ids = np.array(ret_header['ids'], dtype=np.int64).reshape(scores.shape)
+        chunks = {int(chunk_id): chunk_from_dict(data) for chunk_id, data in ret_header['chunks'].items()}
+        return scores, ids, chunks
+
+    def get_chunks(self, chunk_ids: List[int]) -> List[Chunk]:
+        header, _ = self.call({'method': 'chunks', 'ids': [int(i) for i in chunk_ids]})
+        return [chunk_from_dict(data) for data in header['chunks']]
+
+
+class PartitionedChunks(Sequence):
+    """Chunks of all partitions by global chunk id, fetched on demand and LRU cached."""
+
+    def __init__(self, owner: 'PartitionedFaiss', capacity: int = 4096):
+        self.owner = owner
+        self.capacity = capacity
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def put(self, chunks: Dict[int, Chunk]):
+        with self.lock:
+            for chunk_id, chunk in chunks.items():
+                self.cache[chunk_id] = chunk
+                self.cache.move_to_end(chunk_id)
+            while len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+
+    def __len__(self):
+        return sum(count for _, count, _ in self.owner.ranges())
+
+    def __getitem__(self, chunk_id: int) -> Chunk:
+        chunk_id = int(chunk_id)
+        with self.lock:
+            chunk = self.cache.get(chunk_id)
+            if chunk is not None:
+                self.cache.move_to_end(chunk_id)
+                return chunk
+        chunk = self.owner.locate(chunk_id).get_chunks([chunk_id])[0]
+        self.put({chunk_id: chunk})
+        return chunk
+
+
+class PartitionedFaiss(Faiss):
+    """Coordinator with the `Faiss` search interface, partitions live in
+    `partition_server` processes on this or other hosts.
+
+    Each query is sent to all partitions in parallel, their top-k are
+    merged by relevance score. Partitions not answering within `timeout`
+    seconds are skipped, the query is answered with partial results and
+    counted in `stats`.
+
+    Example:
+
+        .. code-block:: python
+
+            dense = PartitionedFaiss(['unix:/tmp/hxd_p0.sock', '10.1.1.2:9400'], timeout=0.5)
+            scores, ids = dense.similarity_search_batch(features)
+    """
+
+    def __init__(self, addresses: List[str], timeout: float = 1.0, k: int = 30, index_config: IndexConfig = None):
+        if len(addresses) < 1:
+            raise ValueError('no partition address')
+        super().__init__(index=None, chunks=[], strategy=DistanceStrategy.UNKNOWN, k=k,
+                         index_config=index_config)
+        self.timeout = timeout
+        self.clients = [PartitionClient(address, timeout=timeout) for address in addresses]
+        self.pool = ThreadPoolExecutor(max_workers=4 * len(self.clients))
+        self.chunks = PartitionedChunks(self)
+        self.readonly = True
+        self.stats = {'queries': 0, 'partial': 0, 'empty': 0}
+        self.missed = {client.address: 0 for client in self.clients}
+        self.stats_lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        """Fetch partition info, servers down now are asked again on next search."""
+        for client in self.clients:
+            try:
+                self.load_info(client)
+            except Exception as e:
+                logger.warning('partition {} unavailable, {}'.format(client.address, str(e)))
+
+    def load_info(self, client: PartitionClient):
+        info = client.get_info()
+        self.strategy = self.parse_strategy(info['strategy'])
+        self.deleted.update(info['deleted'])
+
+    def ranges(self) -> List[Tuple[int, int, PartitionClient]]:
+        """(offset, count, client) of known partitions, sorted by offset."""
+        items = []
+        for client in self.clients:
+            if client.info is not None:
+                items += [(offset, count, client) for offset, count in client.info['ranges']]
+        return sorted(items, key=lambda x: x[0])
+
+    def locate(self, chunk_id: int) -> PartitionClient:
+        items = self.ranges()
+        i = bisect_right([offset for offset, _, _ in items], chunk_id) - 1
+        if i < 0 or chunk_id >= items[i][0] + items[i][1]:
+            raise IndexError('chunk id {} not in any available partition'.format(chunk_id))
+        return items[i][2]
+
+    def is_updatable(self) -> bool:
+        return False
+
+    def search_params(self, ef_search: int = None, nprobe: int = None):
+        return None
+
+    def similarity_search_batch(self,
+                                embeddings: np.ndarray,
+                                ef_search: int = None,
+                                nprobe: int = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Scatter query features to partitions and gather top-k, see `Faiss.similarity_search_batch`."""
+        embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        ef_search = ef_search or self.index_config.ef_search
+        nprobe = nprobe or self.index_config.nprobe
+        futures = {
+            self.pool.submit(self._search, client, embeddings, ef_search, nprobe): client
+            for client in self.clients
+        }
+        done, _ = wait(futures, timeout=self.timeout)
+
+        all_scores = [np.full((len(embeddings), self.k), -np.inf, dtype=np.float32)]
+        all_ids = [np.full((len(embeddings), self.k), -1, dtype=np.int64)]
+        missed = []
+        for future, client in futures.items():
+            if future not in done:
+                missed.append((client.address, 'timeout'))
+                continue
+            try:
+                scores, ids, chunks = future.result()
+            except Exception as e:
+                missed.append((client.address, str(e)))
+                continue
+            self.chunks.put(chunks)
+            all_scores.append(scores)
+            all_ids.append(ids)
+
+        with self.stats_lock:
+            self.stats['queries'] += 1
+            if len(missed) > 0:
+                self.stats['partial'] += 1
+            if len(missed) == len(self.clients):
+                self.stats['empty'] += 1
+            for address, _ in missed:
+                self.missed[address] += 1
+        if len(missed) > 0:
+            logger.warning('partial dense result, {}/{} partitions missed: {}'.format(
+                len(missed), len(self.clients), '; '.join('{} {}'.format(a, r) for a, r in missed)))
+        return merge_topk(all_scores, all_ids, self.k)
+
+    def _search(self, client: PartitionClient, embeddings: np.ndarray, ef_search: int, nprobe: int):
+        if client.info is None:
+            self.load_info(client)
+        return client.search(embeddings, k=self.k, ef_search=ef_search, nprobe=nprobe)
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+        for client in self.clients:
+            client.close()
@@ -4,10 +4,16 @@ from .config import (feature_store_base_dir, redis_host, redis_passwd,
 from .helper import (ErrorCode, QueryTracker, Queue, TaskCode,
                      build_reply_text, check_str_useful, histogram, kimi_ocr,
                      multimodal, parse_json_str)
-from .kg import KnowledgeGraph  # noqa E401
+from .answer_cache import AnswerCache  # noqa E401
+from .kg import KnowledgeGraph, KnowledgeGraphIndex  # noqa E401
 from .llm import LLM
+from .llm_cache import ChatCache  # noqa E401
+from .llm_router import LLMRouter  # noqa E401
+from .llm_scheduler import AdmissionScheduler  # noqa E401
+from .llm_task import TaskTable  # noqa E401
 from .web_search import WebSearch  # noqa E401
 from .serial_pipeline import SerialPipeline
 from .parallel_pipeline import ParallelPipeline
 # Import FeatureStore at the end to avoid circular imports
 from .store import FeatureStore  # noqa E401
+from .ingest import IngestPipeline  # noqa E401
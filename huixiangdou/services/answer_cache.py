@@ -0,0 +1,301 @@
+"""Semantic answer cache, reuse answers of similar questions."""
+import base64
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+
+from huixiangdou.primitive import Query
+
+
+def encode_vector(vector: np.ndarray) -> str:
+    return base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes()).decode('ascii')
+
+
+def decode_vector(text: str) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(text), dtype=np.float32)
+
+
+class SQLiteAnswerStore:
+    """Answers in a SQLite file, shared by worker processes on one node."""
+
+    def __init__(self, path: str):
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS answers
+            (namespace TEXT, key TEXT, created REAL, entry TEXT, PRIMARY KEY (namespace, key))''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS answers_created ON answers (namespace, created)')
+        self.conn.commit()
+
+    def put(self, namespace: str, entry: Dict):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?)',
+                              (namespace, entry['key'], entry['created'], json.dumps(entry, ensure_ascii=False)))
+            self.conn.commit()
+
+    def since(self, namespace: str, created: float) -> List[Dict]:
+        """Entries created after `created`, oldest first."""
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT entry FROM answers WHERE namespace = ? AND created > ? ORDER BY created',
+                (namespace, created)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def trim(self, namespace: str, capacity: int, ttl: float):
+        """Drop expired entries and keep the newest `capacity`."""
+        with self.lock:
+            self.conn.execute('DELETE FROM answers WHERE namespace = ? AND created < ?',
+                              (namespace, time.time() - ttl))
+            self.conn.execute(
+                '''DELETE FROM answers WHERE namespace = ? AND key NOT IN
+                (SELECT key FROM answers WHERE namespace = ? ORDER BY created DESC LIMIT ?)''',
+                (namespace, namespace, capacity))
+            self.conn.commit()
+
+
+class RedisAnswerStore:
+    """Answers in Redis, shared by workers on all nodes.
+
+    Each namespace is a hash of entries plus a sorted set of created
+    time. Any client with the redis-py hash and sorted set API works.
+    """
+
+    def __init__(self, client: Any = None, prefix: str = 'HuixiangDou:answer_cache'):
+        if client is None:
+            import redis
+            from .config import redis_host, redis_passwd, redis_port
+            client = redis.Redis(host=redis_host(), port=redis_port(), password=redis_passwd(),
+                                 decode_responses=True)
+        self.client = client
+        self.prefix = prefix
+
+    def keys(self, namespace: str) -> Tuple[str, str]:
+        name = '{}:{}'.format(self.prefix, namespace)
+        return name, name + ':created'
+
+    def put(self, namespace: str, entry: Dict):
+        entries, created = self.keys(namespace)
+        self.client.hset(entries, entry['key'], json.dumps(entry, ensure_ascii=False))
+        self.client.zadd(created, {entry['key']: entry['created']})
+
+    def since(self, namespace: str, created: float) -> List[Dict]:
+        entries, created_key = self.keys(namespace)
+        keys = self.client.zrangebyscore(created_key, '({}'.format(created), '+inf')
+        if len(keys) < 1:
+            return []
+        return [json.loads(value) for value in self.client.hmget(entries, keys) if value is not None]
+
+    def trim(self, namespace: str, capacity: int, ttl: float):
+        entries, created = self.keys(namespace)
+        expired = self.client.zrangebyscore(created, '-inf', '({}'.format(time.time() - ttl))
+        overflow = self.client.zrange(created, 0, -capacity - 1)
+        keys = list(set(expired) | set(overflow))
+        if len(keys) > 0:
+            self.client.zrem(created, *keys)
+            self.client.hdel(entries, *keys)
+
+
+class AnswerCache:
+    """Reuse final answer and references of a similar question.
+
+    Entries are keyed by query embedding and tagged with the feature store
+    version, answers from an older knowledge base never hit. Matching runs
+    on an in-process LRU; the optional `store` persists entries and shares
+    them across workers, new entries of other workers are pulled every
+    `sync_interval` seconds. Only first-turn text queries are cached, the
+    answer of a follow-up depends on history.
+
+    Args:
+        embedder: `Embedder` of the retriever, query features are cached by it.
+        store: `SQLiteAnswerStore`, `RedisAnswerStore` or None for in-process only.
+        namespace: Tenant of the cache, entries never cross namespaces.
+        version: Feature store version, see `Retriever.version`.
+        threshold: Minimal cosine similarity to reuse an answer.
+        ttl: Seconds an answer lives.
+        capacity: Max entries per namespace.
+        sync_interval: Seconds between pulls from `store`.
+
+    Example:
+
+        .. code-block:: python
+
+            cache = AnswerCache(embedder=retriever.embedder, namespace='mmpose', version=retriever.version)
+            hit = cache.lookup(query)
+            if hit is None:
+                response, references = generate(query)
+                cache.put(query, response=response, references=references)
+    """
+
+    def __init__(self,
+                 embedder: Any,
+                 store: Any = None,
+                 namespace: str = 'default',
+                 version: str = '',
+                 threshold: float = 0.95,
+                 ttl: float = 86400,
+                 capacity: int = 1024,
+                 sync_interval: float = 5):
+        self.embedder = embedder
+        self.store = store
+        self.namespace = namespace
+        self.version = version
+        self.threshold = threshold
+        self.ttl = ttl
+        self.capacity = max(1, capacity)
+        self.sync_interval = sync_interval
+
+        self.entries = OrderedDict()
+        # stacked vectors of `entries`, rebuilt after change
+        self.matrix = None
+        self.lock = threading.Lock()
+        self.watermark = time.time() - ttl
+        self.next_sync = 0.0
+        self.hit = 0
+        self.miss = 0
+        self.put_count = 0
+
+    @classmethod
+    def from_config(cls, config: Dict, embedder: Any, namespace: str, version: str) -> Optional['AnswerCache']:
+        """Build from `[worker.answer_cache]`, None if disabled."""
+        if not config.get('enable', False):
+            return None
+        backend = config.get('backend', 'sqlite')
+        if backend == 'sqlite':
+            store = SQLiteAnswerStore(config.get('path', 'logs/answer_cache.db'))
+        elif backend == 'redis':
+            store = RedisAnswerStore()
+        elif backend == 'memory':
+            store = None
+        else:
+            raise ValueError('Unknown answer cache backend {}'.format(backend))
+        return cls(embedder=embedder,
+                   store=store,
+                   namespace=config.get('namespace', '') or namespace,
+                   version=version,
+                   threshold=float(config.get('threshold', 0.95)),
+                   ttl=float(config.get('ttl', 86400)),
+                   capacity=int(config.get('capacity', 1024)))
+
+    @staticmethod
+    def cacheable(query: Query, history: List = []) -> bool:
+        return query.image is None and query.text is not None and len(query.text.strip()) > 0 and len(history) < 1
+
+    @staticmethod
+    def key(text: str) -> str:
+        return hashlib.md5(' '.join(text.split()).encode('utf8')).hexdigest()
+
+    def embed(self, text: str) -> np.ndarray:
+        vector = np.asarray(self.embedder.embed_query(text=text), dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _add(self, entry: Dict):
+        """Add entry to LRU, caller holds the lock."""
+        if entry['version'] != self.version:
+            return
+        if not isinstance(entry['vector'], np.ndarray):
+            entry['vector'] = decode_vector(entry['vector'])
+        self.entries[entry['key']] = entry
+        self.entries.move_to_end(entry['key'])
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+        self.matrix = None
+
+    def _expire(self):
+        deadline = time.time() - self.ttl
+        expired = [key for key, entry in self.entries.items() if entry['created'] < deadline]
+        for key in expired:
+            self.entries.pop(key)
+        if len(expired) > 0:
+            self.matrix = None
+
+    def sync(self):
+        """Pull entries written by other workers."""
+        if self.store is None or time.time() < self.next_sync:
+            return
+        self.next_sync = time.time() + self.sync_interval
+        try:
+            entries = self.store.since(self.namespace, self.watermark)
+        except Exception as e:
+            logger.error('answer cache sync failed, {}'.format(str(e)))
+            return
+        with self.lock:
+            for entry in entries:
+                self.watermark = max(self.watermark, entry['created'])
+                self._add(entry)
+
+    def lookup(self, query: Query, history: List = []) -> Optional[Dict]:
+        """Return {'query', 'response', 'references', 'score'} of the most similar cached question, or None."""
+        if not self.cacheable(query, history):
+            return None
+        self.sync()
+        vector = self.embed(query.text)
+        with self.lock:
+            self._expire()
+            if len(self.entries) > 0:
+                if self.matrix is None:
+                    self.matrix = (list(self.entries.keys()), np.stack([e['vector'] for e in self.entries.values()]))
+                keys, matrix = self.matrix
+                scores = matrix @ vector
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    entry = self.entries[keys[best]]
+                    self.entries.move_to_end(keys[best])
+                    self.hit += 1
+                    logger.info('answer cache hit, score {:.4f}, cached query {}'.format(scores[best], entry['query']))
+                    return {
+                        'query': entry['query'],
+                        'response': entry['response'],
+                        'references': entry['references'],
+                        'score': float(scores[best])
+                    }
+            self.miss += 1
+        return None
+
+    def put(self, query: Query, response: str, references: List[str], history: List = []):
+        """Cache a successful answer."""
+        if not self.cacheable(query, history) or not response:
+            return
+        entry = {
+            'key': self.key(query.text),
+            'query': query.text,
+            'vector': self.embed(query.text),
+            'version': self.version,
+            'created': time.time(),
+            'response': response,
+            'references': list(references)
+        }
+        with self.lock:
+            self._add(dict(entry))
+            self.put_count += 1
+        if self.store is None:
+            return
+        entry['vector'] = encode_vector(entry['vector'])
+        try:
+            self.store.put(self.namespace, entry)
+            self.store.trim(self.namespace, capacity=self.capacity, ttl=self.ttl)
+        except Exception as e:
+            logger.error('answer cache put failed, {}'.format(str(e)))
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hit + self.miss
+        return {
+            'namespace': self.namespace,
+            'size': len(self.entries),
+            'hit': self.hit,
+            'miss': self.miss,
+            'put': self.put_count,
+            'hit_rate': self.hit / total if total > 0 else 0.0
+        }
@@ -355,7 +355,7 @@ async def is_truth(llm: LLM,
 
     score = default
     logs['default'] = default
-    relation = await llm.chat(prompt=prompt)
+    relation = await llm.chat(prompt=prompt, task='score')
     logs['relation'] = relation
     filtered_relation = ''.join([c for c in relation if c.isdigit()])
 
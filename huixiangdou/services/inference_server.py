@@ -0,0 +1,146 @@
+"""Local inference service, load embedding and rerank models once for all
+worker processes on a node."""
+import argparse
+import os
+import socketserver
+import time
+from multiprocessing import Process, Value, set_start_method
+
+import pytoml
+from loguru import logger
+
+from huixiangdou.primitive import Chunk, Embedder, LLMReranker
+from huixiangdou.primitive.inference_client import (pack_array, recv_message,
+                                                    send_message)
+
+
+class InferenceHandler(socketserver.BaseRequestHandler):
+    """Serve requests of one client connection until it closes."""
+
+    def handle(self):
+        server = self.server
+        while True:
+            try:
+                header, payload = recv_message(self.request)
+            except ConnectionError:
+                return
+
+            try:
+                ret_header, ret_payload = server.dispatch(header, payload)
+            except Exception as e:
+                logger.error('inference {} failed, {}'.format(header.get('method'), str(e)))
+                ret_header, ret_payload = {'error': str(e)}, b''
+            send_message(self.request, ret_header, ret_payload)
+
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server wraps `Embedder` and `LLMReranker`.
+
+    Concurrent `embed` requests are merged by `Embedder` micro batching.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, model_config: dict):
+        # the server side models must not be clients of itself
+        model_config = dict(model_config)
+        model_config['inference_socket'] = ''
+        self.embedder = Embedder(model_config=model_config)
+        self.embedder.enable_batching(max_batch=int(model_config.get('embed_batch_size', 32)),
+                                      max_wait_ms=float(model_config.get('embed_batch_wait_ms', 5)))
+        # client slices its own `topn`
+        self.reranker = LLMReranker(model_config=model_config, topn=1 << 30)
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, InferenceHandler)
+
+    def dispatch(self, header: dict, payload: bytes = b''):
+        method = header.get('method')
+        if method == 'embed':
+            return pack_array(self.embedder.embed_query(text=header.get('text'), path=header.get('path')))
+        elif method == 'embed_batch':
+            chunks = [Chunk(content_or_path=text) for text in header['texts']]
+            return pack_array(self.embedder.embed_query_batch_text(chunks=chunks))
+        elif method == 'token_length':
+            return {'length': self.embedder.token_length(header['text'])}, b''
+        elif method == 'rerank':
+            indexes = self.reranker._sort(texts=header['texts'], query=header['query'])
+            return {'indexes': [int(i) for i in indexes]}, b''
+        elif method == 'info':
+            return {
+                'embedder': self.embedder._type,
+                'reranker': self.reranker._type,
+                'support_image': self.embedder.support_image,
+                'distance_strategy': self.embedder.distance_strategy.value
+            }, b''
+        raise ValueError('Unknown method {}'.format(method))
+
+
+def parse_args():
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser(description='Local embedding and rerank inference service.')
+    parser.add_argument(
+        '--config_path',
+        default='config.ini',
+        help='Configuration path, `inference_socket` in `[feature_store]` is the listen path. Default value is config.ini'  # noqa E501
+    )
+    args = parser.parse_args()
+    return args
+
+
+def inference_serve(config_path: str, server_ready: Value):
+    """Start the inference server.
+
+    Args:
+        config_path (str): Path to the configuration file.
+        server_ready (multiprocessing.Value): Shared variable to indicate when the server is ready.  # noqa E501
+    """
+    with open(config_path, encoding='utf8') as f:
+        fs_config = pytoml.load(f)['feature_store']
+    socket_path = fs_config.get('inference_socket', '')
+    if not socket_path:
+        server_ready.value = -1
+        raise ValueError('`inference_socket` in `[feature_store]` is empty')
+
+    try:
+        server = InferenceServer(socket_path=socket_path, model_config=fs_config)
+        server_ready.value = 1
+    except Exception as e:
+        server_ready.value = -1
+        raise (e)
+
+    logger.info('inference service listen on {}'.format(socket_path))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def start_inference_server(config_path: str):
+    set_start_method('spawn', force=True)
+    server_ready = Value('i', 0)
+    server_process = Process(target=inference_serve,
+                             args=(config_path, server_ready))
+    server_process.daemon = True
+    server_process.start()
+    while True:
+        if server_ready.value == 0:
+            logger.info('waiting for inference server to be ready..')
+            time.sleep(2)
+        elif server_ready.value == 1:
+            break
+        else:
+            logger.error('start inference server failed, quit.')
+            raise Exception('inference server')
+    logger.info('Inference Server start.')
+
+
+def main():
+    args = parse_args()
+    inference_serve(args.config_path, Value('i', 0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+"""Streaming ingestion, overlap file parsing with embedding."""
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, List
+
+from loguru import logger
+
+from ..primitive import Chunk, Faiss, FileName
+
+
+def parse_file(file: FileName) -> float:
+    """Run `read_and_save` in parse process, return time cost."""
+    from .store import read_and_save
+    start = time.time()
+    read_and_save(file)
+    return time.time() - start
+
+
+class StageStats:
+    """Item count and busy seconds of one pipeline stage."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.busy = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, count: int, cost: float):
+        with self.lock:
+            self.count += count
+            self.busy += cost
+
+    def __str__(self):
+        speed = self.count / self.busy if self.busy > 0 else 0.0
+        return '{} {} items in {:.1f}s busy, {:.1f}/s'.format(self.name, self.count, self.busy, speed)
+
+
+class IngestPipeline:
+    """Build dense database as a stream: hash -> parse -> split -> embed -> index.
+
+    Stages run concurrently and are connected with bounded queues, so the
+    embedder starts with the first split file and in-flight files never
+    exceed `queue_size`:
+        hash    `hash_workers` threads hash and copy files to `preprocess`
+        parse   `parse_workers` processes read pdf/word/excel/ppt/html
+        split   one thread splits documents in input order
+        embed   caller thread embeds `batch_size` chunks per call and adds them to index
+
+    Args:
+        store: `FeatureStore` providing `prepare_file`, `split_file` and the embedder.
+        hash_workers: Hash and copy threads.
+        parse_workers: Parse processes.
+        queue_size: Capacity of queues between stages.
+        batch_size: Chunks per embedding call, 0 to use env `HUIXIANGDOU_BATCHSIZE`.
+        report_interval: Seconds between throughput logs.
+    """
+
+    def __init__(self,
+                 store: Any,
+                 hash_workers: int = 4,
+                 parse_workers: int = 8,
+                 queue_size: int = 64,
+                 batch_size: int = 32,
+                 report_interval: float = 30):
+        self.store = store
+        self.hash_workers = max(1, hash_workers)
+        self.parse_workers = max(1, parse_workers)
+        self.queue_size = max(1, queue_size)
+        self.batch_size = batch_size if batch_size > 0 else Faiss.get_batchsize()
+        self.report_interval = report_interval
+
+    @classmethod
+    def from_config(cls, store: Any, config: dict):
+        """Build from `[feature_store]` config."""
+        return cls(store=store,
+                   hash_workers=int(config.get('ingest_hash_workers', 4)),
+                   parse_workers=int(config.get('ingest_parse_workers', 8)),
+                   queue_size=int(config.get('ingest_queue_size', 64)),
+                   batch_size=int(config.get('ingest_batch_size', 32)))
+
+    @staticmethod
+    def put(q: queue.Queue, item: Any, stop: threading.Event) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    @staticmethod
+    def get(q: queue.Queue, stop: threading.Event) -> Any:
+        """Return None if stopped."""
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def run(self, files: List[FileName], work_dir: str, dense: Faiss, qa_pair_file: str = None) -> List[int]:
+        """Preprocess `files`, embed documents and QA pairs and append them to `dense`.
+
+        Code files are only preprocessed, they go to sparse database.
+
+        Returns:
+            List[int]: chunk ids added to `dense`.
+        """
+        preproc_dir = os.path.join(work_dir, 'preprocess')
+        if not os.path.exists(preproc_dir):
+            os.makedirs(preproc_dir)
+
+        stats = [StageStats(name) for name in ['hash', 'parse', 'split', 'embed']]
+        hash_stats, parse_stats, split_stats, embed_stats = stats
+        stop = threading.Event()
+        errors = []
+        prepared = queue.Queue(maxsize=self.queue_size)
+        splitted = queue.Queue(maxsize=self.queue_size)
+        hash_pool = ThreadPoolExecutor(max_workers=self.hash_workers)
+        # fork from a process holding threads and the embedding model may deadlock
+        parse_pool = ProcessPoolExecutor(max_workers=self.parse_workers,
+                                         mp_context=multiprocessing.get_context('spawn'))
+
+        def prepare(file: FileName):
+            start = time.time()
+            need_parse = self.store.prepare_file(file=file, preproc_dir=preproc_dir)
+            hash_stats.add(1, time.time() - start)
+            if need_parse:
+                return parse_pool.submit(parse_file, file)
+            return None
+
+        def produce():
+            try:
+                for file in files:
+                    if not self.put(prepared, (file, hash_pool.submit(prepare, file)), stop):
+                        return
+            finally:
+                self.put(prepared, None, stop)
+
+        def split():
+            try:
+                while True:
+                    item = self.get(prepared, stop)
+                    if item is None:
+                        break
+                    file, future = item
+                    parse_future = future.result()
+                    if parse_future is not None:
+                        parse_stats.add(1, parse_future.result())
+                        # state set in parse process is not sent back
+                        self.store.check_parsed(file)
+                    if file._type == 'code' or not file.state:
+                        continue
+
+                    start = time.time()
+                    chunks = self.store.split_file(file=file)
+                    split_stats.add(len(chunks), time.time() - start)
+                    if len(chunks) > 0 and not self.put(splitted, chunks, stop):
+                        break
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                self.put(splitted, None, stop)
+
+        threads = [threading.Thread(target=produce, daemon=True), threading.Thread(target=split, daemon=True)]
+        for thread in threads:
+            thread.start()
+
+        ids = []
+        buffer = []
+        if qa_pair_file is not None:
+            buffer = self.store.process_qa_pairs(qa_pair_file)
+            logger.info('Added {} chunks from QA pairs'.format(len(buffer)))
+
+        def embed(chunks: List[Chunk]):
+            start = time.time()
+            ids.extend(dense.add(chunks=chunks, embedder=self.store.embedder, cache=self.store.embedding_cache,
+                                 batchsize=self.batch_size, flush=False, progress=False))
+            embed_stats.add(len(chunks), time.time() - start)
+
+        begin = time.time()
+        last_report = begin
+        try:
+            while True:
+                item = self.get(splitted, stop)
+                if item is None:
+                    break
+                buffer += item
+                while len(buffer) >= self.batch_size:
+                    embed(buffer[0:self.batch_size])
+                    buffer = buffer[self.batch_size:]
+
+                if time.time() - last_report > self.report_interval:
+                    last_report = time.time()
+                    logger.info('ingest {}'.format('; '.join(str(s) for s in stats)))
+
+            if len(errors) > 0:
+                raise errors[0]
+            if len(buffer) > 0:
+                embed(buffer)
+            dense.flush_pending()
+        except BaseException:
+            stop.set()
+            raise
+        finally:
+            for thread in threads:
+                thread.join()
+            hash_pool.shutdown(wait=True, cancel_futures=True)
+            parse_pool.shutdown(wait=True, cancel_futures=True)
+
+        logger.info('ingest finished in {:.1f}s, {}'.format(time.time() - begin, '; '.join(str(s) for s in stats)))
+        return ids
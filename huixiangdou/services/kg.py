@@ -1,20 +1,26 @@
 
 import argparse
+import asyncio
+import hashlib
 import json
 import os
 import pdb
 import pickle
 import re
+import shutil
+import time
 from dataclasses import asdict, dataclass, field
 from enum import Enum, unique
+from typing import List, Set, Tuple
 from uuid import uuid4
 
 import networkx as nx
+import numpy as np
 import pytoml
 from loguru import logger
 from tqdm import tqdm
 
-from ..primitive import FileOperation
+from ..primitive import EntityAutomaton, FileOperation
 from .helper import build_reply_text, extract_json_from_str
 from .llm import LLM
 
@@ -55,15 +61,224 @@ def relation_to_jsonstr(instance):
     return json.dumps(dict_instance, ensure_ascii=False)
 
 
+def stable_uuid(key: str):
+    return hashlib.md5(key.encode('utf8')).hexdigest()[0:12]
+
+
+def chunk_key(abspath: str, pageid: int, text: str):
+    """Checkpoint key, modified chunk gets a new key."""
+    return '{}#page{}#{}'.format(abspath, pageid, stable_uuid(text))
+
+
+def read_lines(path: str) -> Set[str]:
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return set(line.strip() for line in f if line.strip())
+
+
+class KGWriter:
+    """Buffered jsonl writer of nodes, relations and chunk checkpoints.
+
+    Checkpoints are always flushed after the nodes and relations they
+    cover, a crash never marks an unsaved chunk as done.
+    """
+
+    def __init__(self, nodes_path: str, relations_path: str, checkpoint_path: str, flush_size: int = 256):
+        self.nodes_file = open(nodes_path, 'a')
+        self.relations_file = open(relations_path, 'a')
+        self.checkpoints_file = open(checkpoint_path, 'a')
+        self.flush_size = flush_size
+        self.nodes = []
+        self.relations = []
+        self.checkpoints = []
+        self.file_checkpoints = []
+
+    def write(self, nodes: List[Node], relations: List[Relation], checkpoint: str = None):
+        self.nodes += [node_to_jsonstr(node) for node in nodes]
+        self.relations += [relation_to_jsonstr(relation) for relation in relations]
+        if checkpoint is not None:
+            self.checkpoints.append(checkpoint)
+        if len(self.nodes) + len(self.relations) >= self.flush_size:
+            self.flush()
+
+    def mark_file(self, path: str, abspath: str):
+        self.file_checkpoints.append((path, abspath))
+        if len(self.file_checkpoints) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        for f, lines in [(self.nodes_file, self.nodes), (self.relations_file, self.relations)]:
+            if lines:
+                f.write('\n'.join(lines) + '\n')
+            f.flush()
+        if self.checkpoints:
+            self.checkpoints_file.write('\n'.join(self.checkpoints) + '\n')
+            self.checkpoints_file.flush()
+        for path, abspath in self.file_checkpoints:
+            with open(path, 'a') as f:
+                f.write(abspath + '\n')
+        self.nodes = []
+        self.relations = []
+        self.checkpoints = []
+        self.file_checkpoints = []
+
+    def close(self):
+        self.flush()
+        self.nodes_file.close()
+        self.relations_file.close()
+        self.checkpoints_file.close()
+
+
+class KnowledgeGraphIndex:
+    """Read-only serving format of knowledge graph, built by `dump_networkx`.
+
+    Files in `kg/serving`:
+        meta.json           keyword entity names and markdown file paths
+        entities.ac.npz     automaton of entity names, replaces LLM NER on query
+        entity_indptr.npy   CSR of entity -> (file id, chunk id) pairs
+        entity_files.npy
+        entity_chunks.npy
+        chunks.bin          utf8 chunk text, sliced by `chunk_offsets.npy`
+
+    Arrays are memory mapped, a query is one automaton pass and a few slices.
+    """
+    MIN_ENTITY_LENGTH = 2
+
+    def __init__(self, serving_dir: str):
+        with open(os.path.join(serving_dir, 'meta.json'), encoding='utf8') as f:
+            meta = json.load(f)
+        self.entities = meta['entities']
+        self.files = meta['files']
+        self.automaton = EntityAutomaton.load(os.path.join(serving_dir, 'entities.ac.npz'))
+        self.indptr = np.load(os.path.join(serving_dir, 'entity_indptr.npy'), mmap_mode='r')
+        self.entity_files = np.load(os.path.join(serving_dir, 'entity_files.npy'), mmap_mode='r')
+        self.entity_chunks = np.load(os.path.join(serving_dir, 'entity_chunks.npy'), mmap_mode='r')
+        self.chunk_offsets = np.load(os.path.join(serving_dir, 'chunk_offsets.npy'), mmap_mode='r')
+        self.chunk_path = os.path.join(serving_dir, 'chunks.bin')
+        self.chunk_bytes = None
+        if self.chunk_offsets[-1] > 0:
+            self.chunk_bytes = np.memmap(self.chunk_path, dtype=np.uint8, mode='r')
+
+    @classmethod
+    def load(cls, kg_work_dir: str):
+        """Return None if serving format not exist."""
+        serving_dir = os.path.join(kg_work_dir, 'serving')
+        if not os.path.exists(os.path.join(serving_dir, 'meta.json')):
+            if os.path.exists(os.path.join(kg_work_dir, 'kg.gpickle')):
+                logger.warning('{} has no serving format, run `python3 -m huixiangdou.services.kg --dump-networkx`'.format(kg_work_dir))  # noqa E501
+            return None
+        return cls(serving_dir)
+
+    @classmethod
+    def build(cls, G: nx.Graph, serving_dir: str):
+        """Convert networkx graph, edges are the same as
+        `KnowledgeGraph.query_file_chunk_map`."""
+        entities = []
+        files = []
+        file_ids = dict()
+        chunk_ids = dict()
+        chunk_texts = []
+        indptr = [0]
+        pairs = []
+
+        for node, attr in G.nodes(data=True):
+            if attr.get('type') != KGType.KEYWORD.value:
+                continue
+            entities.append(node)
+            for chunk in G.neighbors(node):
+                for nbr in G.neighbors(chunk):
+                    if 'page' not in G.edges[chunk, nbr].get('desc'):
+                        continue
+                    file_data = G.nodes[nbr].get('data')
+                    if file_data not in file_ids:
+                        file_ids[file_data] = len(files)
+                        files.append(file_data)
+                    if chunk not in chunk_ids:
+                        chunk_ids[chunk] = len(chunk_texts)
+                        chunk_texts.append(G.nodes[chunk].get('data') or '')
+                    pairs.append((file_ids[file_data], chunk_ids[chunk]))
+            indptr.append(len(pairs))
+
+        tmp_dir = serving_dir + '.tmp'
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf8') as f:
+            json.dump({'entities': entities, 'files': files}, f, ensure_ascii=False)
+        # too short names hit almost every query
+        names = [e if len(e) >= cls.MIN_ENTITY_LENGTH else '' for e in entities]
+        EntityAutomaton().build(names).save(os.path.join(tmp_dir, 'entities.ac.npz'))
+
+        pairs = np.array(pairs, dtype=np.int32).reshape(-1, 2)
+        np.save(os.path.join(tmp_dir, 'entity_indptr.npy'), np.array(indptr, dtype=np.int64))
+        np.save(os.path.join(tmp_dir, 'entity_files.npy'), pairs[:, 0].copy())
+        np.save(os.path.join(tmp_dir, 'entity_chunks.npy'), pairs[:, 1].copy())
+
+        encoded = [text.encode('utf8') for text in chunk_texts]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(e) for e in encoded])
+        np.save(os.path.join(tmp_dir, 'chunk_offsets.npy'), offsets)
+        with open(os.path.join(tmp_dir, 'chunks.bin'), 'wb') as f:
+            f.write(b''.join(encoded))
+
+        if os.path.exists(serving_dir):
+            shutil.rmtree(serving_dir)
+        os.replace(tmp_dir, serving_dir)
+        logger.info('knowledge graph serving format {} entities, {} files, {} chunks'.format(
+            len(entities), len(files), len(chunk_texts)))
+
+    def match(self, query: str):
+        """Entity ids and their (file id, chunk id) postings."""
+        entity_ids = self.automaton.match(query)
+        if len(entity_ids) < 1:
+            return entity_ids, np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+        slices = [slice(self.indptr[i], self.indptr[i + 1]) for i in entity_ids]
+        files = np.concatenate([self.entity_files[s] for s in slices])
+        chunks = np.concatenate([self.entity_chunks[s] for s in slices])
+        return entity_ids, files, chunks
+
+    def file_count(self, query: str) -> int:
+        """Number of files related to entities in query."""
+        _, files, _ = self.match(query)
+        return len(np.unique(files))
+
+    def chunk_text(self, chunk_id: int) -> str:
+        start, end = self.chunk_offsets[chunk_id], self.chunk_offsets[chunk_id + 1]
+        if start == end:
+            return ''
+        return self.chunk_bytes[start:end].tobytes().decode('utf8')
+
+    def retrieve(self, query: str):
+        """Same output as `KnowledgeGraph.retrieve` without LLM."""
+        _, files, chunks = self.match(query)
+        file_chunks = dict()
+        for file_id, chunk_id in zip(files.tolist(), chunks.tolist()):
+            path = self.files[file_id]
+            if path not in file_chunks:
+                file_chunks[path] = []
+            file_chunks[path].append(self.chunk_text(chunk_id))
+
+        candidates = [{'path': k, 'chunks': v} for k, v in file_chunks.items()]
+        candidates.sort(key=lambda x: len(x['chunks']))
+        return candidates
+
+
 class KnowledgeGraph:
 
     def __init__(self,
                  config_path: str,
                  override: bool = False,
-                 retry: int = 1):
+                 retry: int = 1,
+                 concurrency: int = 8,
+                 report_interval: int = 100):
 
         self.llm = LLM(config_path=config_path)
         self.retry = retry
+        # NER workers, `LLM.chat` applies RPM and TPM of the backend
+        self.concurrency = max(1, concurrency)
+        self.report_interval = max(1, report_interval)
         self.nodes = []
         self.relations = []
         self.chunksize = 2048
@@ -89,77 +304,157 @@ class KnowledgeGraph:
         self.relations_path = os.path.join(self.kg_work_dir,
                                            'kg_relations.jsonl')
         self.gpickle_path = os.path.join(self.kg_work_dir, 'kg.gpickle')
+        self.serving_dir = os.path.join(self.kg_work_dir, 'serving')
         self.graph = None
 
     def build(self, repodir: str):
-        logger.info(
-            'multi-modal knowledge graph retrieval is experimental, only support markdown format.'
-        )
-        proc_files = []
-
-        processed = []
-        processed_path = os.path.join(self.kg_work_dir, 'processed.txt')
-        if os.path.exists(processed_path):
-            with open(processed_path) as f:
-                for path in f:
-                    processed.append(path.strip())
+        """Build nodes and relations jsonl from markdown files in `repodir`."""
+        asyncio.run(self.build_async(repodir=repodir))
 
-        for root, dirs, files in os.walk(repodir):
-            for file in files:
-                if '.github' in root:
-                    continue
-                file_type = self.file_opr.get_type(file)
-                if file_type not in ['md']:
+    def scan(self, repodir: str, processed: Set[str]) -> List[str]:
+        files = []
+        for root, dirs, filenames in os.walk(repodir):
+            if '.github' in root:
+                continue
+            for filename in filenames:
+                if self.file_opr.get_type(filename) not in ['md']:
                     continue
-
-                abspath = os.path.join(root, file)
+                abspath = os.path.join(root, filename)
                 if abspath in processed:
                     logger.info(f'skip {abspath}')
                     continue
-                proc_files.append((abspath, file_type))
+                files.append(abspath)
+        return files
+
+    async def build_async(self, repodir: str):
+        """Run NER of all chunks with `concurrency` workers.
 
-        # save to jsonl and pickle
+        Nodes, relations and checkpoints are written by one `KGWriter`, a
+        chunk is checkpointed only after its nodes and relations are
+        flushed, so an interrupted build resumes from the unfinished chunks.
+        """
+        logger.info(
+            'multi-modal knowledge graph retrieval is experimental, only support markdown format.'
+        )
+        processed_path = os.path.join(self.kg_work_dir, 'processed.txt')
+        processed_chunks_path = os.path.join(self.kg_work_dir, 'processed_chunks.txt')
         if self.override:
-            if os.path.exists(self.nodes_path):
-                os.remove(self.nodes_path)
-            if os.path.exists(self.relations_path):
-                os.remove(self.relations_path)
-
-        for abspath, file_type in tqdm(proc_files):
-            if file_type == 'md':
-                self.build_md(abspath)
-            with open(processed_path, 'a') as f:
-                f.write(abspath)
-                f.write('\n')
-
-            # save jsonl format
-            with open(self.nodes_path, 'a') as f:
-                for node in self.nodes:
-                    f.write(node_to_jsonstr(node))
-                    f.write('\n')
-            self.nodes = []
-
-            with open(self.relations_path, 'a') as f:
-                for relation in self.relations:
-                    f.write(relation_to_jsonstr(relation))
-                    f.write('\n')
-            self.relations = []
-
-    async def build_md_chunk(self, md_node: Node, abspath: str):
+            for path in [self.nodes_path, self.relations_path, processed_path, processed_chunks_path]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+        processed = read_lines(processed_path)
+        processed_chunks = read_lines(processed_chunks_path)
+        files = self.scan(repodir=repodir, processed=processed)
+        logger.info('{} markdown files to process, {} chunks done before'.format(len(files), len(processed_chunks)))
+
+        writer = KGWriter(nodes_path=self.nodes_path,
+                          relations_path=self.relations_path,
+                          checkpoint_path=processed_chunks_path)
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        progress = tqdm(total=len(files))
+        # abspath -> [pending chunk count, all succeeded, markdown node not written]
+        file_states = dict()
+        stats = {'done': 0, 'failed': 0, 'start': time.time()}
+
+        def finish_chunk(abspath: str, success: bool):
+            state = file_states[abspath]
+            state[0] -= 1
+            state[1] = state[1] and success
+            if state[0] > 0:
+                return
+            if state[1]:
+                writer.mark_file(processed_path, abspath)
+            progress.update(1)
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                abspath, md_node, chunk_node, relation, key = item
+                success = True
+                try:
+                    nodes, relations = await self.build_md_chunk(md_node=chunk_node, abspath=abspath)
+                    nodes = [chunk_node] + nodes
+                    # markdown node goes with the first checkpointed chunk of the file
+                    if file_states[abspath][2]:
+                        file_states[abspath][2] = False
+                        nodes = [md_node] + nodes
+                    writer.write(nodes=nodes, relations=[relation] + relations, checkpoint=key)
+                    stats['done'] += 1
+                except Exception as e:
+                    logger.error('NER {} failed, {}'.format(key, str(e)))
+                    stats['failed'] += 1
+                    success = False
+                finish_chunk(abspath, success)
+
+                if (stats['done'] + stats['failed']) % self.report_interval == 0:
+                    cost = time.time() - stats['start']
+                    logger.info('kg build {} chunks done, {} failed, {:.2f} chunk/s, llm input {} output {} tokens'.format(
+                        stats['done'], stats['failed'], stats['done'] / max(cost, 1e-6),
+                        self.llm.sum_input_token_size, self.llm.sum_output_token_size))
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            for abspath in files:
+                md_node, chunks = self.split_md(abspath)
+                todo = []
+                for pageid, text in enumerate(chunks):
+                    key = chunk_key(abspath, pageid, text)
+                    if key in processed_chunks:
+                        continue
+                    chunk_node = Node(_type=KGType.CHUNK, uuid=stable_uuid(key), data=text)
+                    relation = Relation(md_node.uuid, chunk_node.uuid, 'page{}'.format(pageid))
+                    todo.append((abspath, md_node, chunk_node, relation, key))
+                # a resumed file wrote its markdown node with its first done chunk
+                md_pending = len(todo) == len(chunks)
+                if len(chunks) < 1:
+                    writer.write(nodes=[md_node], relations=[], checkpoint=None)
+                    md_pending = False
+
+                # count before enqueue, workers may finish chunks immediately
+                file_states[abspath] = [len(todo) + 1, True, md_pending]
+                for item in todo:
+                    await queue.put(item)
+                finish_chunk(abspath, True)
+
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            writer.close()
+            progress.close()
+
+        cost = time.time() - stats['start']
+        logger.info('kg build finished, {} chunks in {:.1f}s, {} failed and will be retried on next build'.format(
+            stats['done'], cost, stats['failed']))
+
+    async def build_md_chunk(self, md_node: Node, abspath: str) -> Tuple[List[Node], List[Relation]]:
         """Parse markdown chunk to nodes and relations.
 
-        LLM NER with retry policy.
+        LLM NER with retry policy. Raises ValueError if no response can be
+        parsed, the chunk is not checkpointed and runs again on next build.
         """
+        nodes = []
+        relations = []
         items = []
+        llm_raw_text = ''
+        parsed = False
         for _ in range(self.retry):
+            # done chunks are checkpointed, the response cache would only replay unparsable text
             llm_raw_text = await self.llm.chat(
-                prompt=self.prompt_template + md_node.data)
-            items += extract_json_from_str(raw=llm_raw_text)
+                prompt=self.prompt_template + md_node.data, priority='batch', task='ner', use_cache=False)
+            items = extract_json_from_str(raw=llm_raw_text)
+            # an empty list is a valid answer for text without entities
+            if len(items) > 0 or llm_raw_text.replace('```json', '').replace('```', '').strip() == '[]':
+                parsed = True
+                break
 
-        if len(items) < 1:
-            logger.warning(
-                'parse llm_raw_text failed. {}'.format(llm_raw_text))
-            return
+        if not parsed:
+            raise ValueError('parse llm_raw_text failed. {}'.format(llm_raw_text))
 
         for item in items:
             # fetch nodes and add relations
@@ -171,8 +466,8 @@ class KnowledgeGraph:
                 logger.error(item)
                 continue
 
-            self.nodes.append(Node(uuid=entity, _type=KGType.KEYWORD))
-            self.relations.append(Relation(entity, md_node.uuid, _type))
+            nodes.append(Node(uuid=entity, _type=KGType.KEYWORD))
+            relations.append(Relation(entity, md_node.uuid, _type))
 
         matches = self.md_pattern.findall(md_node.data)
         for match in matches:
@@ -183,54 +478,44 @@ class KnowledgeGraph:
 
             if not uri.startswith('http'):
                 uri = os.path.join(os.path.dirname(abspath), uri)
-            uuid, image_path = self.file_opr.save_image(
-                uri=uri, outdir=self.kg_work_dir)
+            # download in thread, do not block other NER calls
+            uuid, image_path = await asyncio.to_thread(self.file_opr.save_image, uri=uri, outdir=self.kg_work_dir)
             if image_path is not None:
-                self.nodes.append(
+                nodes.append(
                     Node(uuid=uuid, _type=KGType.IMAGE, data=image_path))
-                self.relations.append(Relation(uuid, md_node.uuid, 'file'))
+                relations.append(Relation(uuid, md_node.uuid, 'file'))
+        return nodes, relations
 
-    def build_md(self, abspath: str):
-        """Load markdown and split, build nodes and relationship."""
+    def split_md(self, abspath: str) -> Tuple[Node, List[str]]:
+        """Load markdown and split, return markdown node and chunk texts."""
         content = ''
         with open(abspath) as f:
             content = f.read()
         splits = content.split('\n')
 
+        chunks = []
         chunk = ''
-        pageid = 0
-
-        md_node = Node(_type=KGType.MARKDOWN, data=abspath)
-        self.nodes.append(md_node)
-
-        def add_chunk(md_node: Node, pageid: int, text: str):
-            chunk_node = Node(_type=KGType.CHUNK, data=text)
-            self.nodes.append(chunk_node)
-            self.build_md_chunk(md_node=chunk_node, abspath=abspath)
-            self.relations.append(
-                Relation(md_node.uuid, chunk_node.uuid,
-                         'page{}'.format(pageid)))
-
         for split in splits:
             if len(split) >= self.chunksize:
                 if len(chunk) > 0:
-                    add_chunk(md_node=md_node, pageid=pageid, text=chunk)
-                    pageid += 1
+                    chunks.append(chunk)
                     chunk = ''
-                add_chunk(md_node=md_node, pageid=pageid, text=split)
-                pageid += 1
+                chunks.append(split)
                 continue
 
             if len(chunk) + len(split) < self.chunksize:
                 chunk = chunk + '\n' + split
                 continue
 
-            add_chunk(md_node=md_node, pageid=pageid, text=chunk)
-            pageid += 1
+            chunks.append(chunk)
             chunk = split
 
         if len(chunk) > 0:
-            add_chunk(md_node=md_node, pageid=pageid, text=chunk)
+            chunks.append(chunk)
+
+        # stable uuid, resumed chunks attach to the same markdown node
+        md_node = Node(_type=KGType.MARKDOWN, uuid=stable_uuid(abspath), data=abspath)
+        return md_node, chunks
 
     def dump_neo4j(self, uri: str, user: str, passwd: str):
         # Save networkx-neo4j for better graph viewer
@@ -332,6 +617,8 @@ class KnowledgeGraph:
         # save to pickle format
         with open(self.gpickle_path, 'wb') as f:
             pickle.dump(G, f, pickle.HIGHEST_PROTOCOL)
+        # and compact format for retriever
+        KnowledgeGraphIndex.build(G, self.serving_dir)
 
     def is_available(self):
         """Check knowledge graph exist or not."""
@@ -374,7 +661,7 @@ class KnowledgeGraph:
     async def retrieve(self, query: str):
         if self.graph is None:
             self.load()
-        llm_raw_text = await self.llm.chat(prompt=self.prompt_template + query)
+        llm_raw_text = await self.llm.chat(prompt=self.prompt_template + query, task='ner')
 
         items = extract_json_from_str(raw=llm_raw_text)
         if len(items) < 1:
@@ -461,6 +748,10 @@ def parse_args():
                         type=int,
                         default=1,
                         help='Retry count for LLM NER.')
+    parser.add_argument('--concurrency',
+                        type=int,
+                        default=8,
+                        help='Max concurrent LLM NER requests.')
     args = parser.parse_args()
     return args
 
@@ -469,7 +760,8 @@ if __name__ == '__main__':
     args = parse_args()
     kg = KnowledgeGraph(args.config_path,
                         override=args.override,
-                        retry=args.retry)
+                        retry=args.retry,
+                        concurrency=args.concurrency)
 
     if args.build:
         kg.build(repodir=args.repo_dir)
@@ -484,7 +776,10 @@ if __name__ == '__main__':
         kg.dump_networkx()
 
     if args.query:
-        result = kg.retrieve(query=args.query)[0]
+        index = KnowledgeGraphIndex.load(kg.kg_work_dir)
+        if index is None:
+            raise ValueError('knowledge graph not built, use `--build` or `--dump-networkx` first')
+        result = index.retrieve(query=args.query)[0]
         reply_text = build_reply_text(code=0,
                                       query=args.query,
                                       reply=result['path'],
@@ -3,18 +3,16 @@ import json
 import os
 from ..primitive.limitter import RPM, TPM
 from ..primitive.token import encode_string, decode_tokens
+from .llm_cache import ChatCache
+from .llm_router import LLMRouter
+from .llm_scheduler import AdmissionScheduler
+from .llm_task import TaskTable
 import asyncio
-from typing import Dict
+import time
+from typing import Dict, List, Tuple
 import pytoml
 from loguru import logger
-from openai import AsyncOpenAI, APIConnectionError, RateLimitError, Timeout, APITimeoutError
-from tenacity import (
-    retry,
-    stop_after_attempt,
-    wait_exponential,
-    retry_if_exception_type,
-)
-from functools import wraps
+from openai import AsyncOpenAI, APIConnectionError, RateLimitError, APITimeoutError, InternalServerError
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
@@ -40,28 +38,6 @@ backend2model = {
     "ppio": "thudm/glm-4-9b-chat"
 }
 
-def limit_async_func_call(max_size: int, waitting_time: float = 0.1):
-    """Add restriction of maximum async calling times for a async func"""
-
-    def final_decro(func):
-        """Not using async.Semaphore to aovid use nest-asyncio"""
-        __current_size = 0
-
-        @wraps(func)
-        async def wait_func(*args, **kwargs):
-            nonlocal __current_size
-            while __current_size >= max_size:
-                await asyncio.sleep(waitting_time)
-            __current_size += 1
-            result = await func(*args, **kwargs)
-            __current_size -= 1
-            return result
-
-        return wait_func
-
-    return final_decro
-
-
 class Backend:
 
     def __init__(self, name: str, data: Dict):
@@ -70,14 +46,76 @@ class Backend:
         self.max_token_size = data.get('remote_llm_max_text_length', 32000) - 4096
         if self.max_token_size < 0:
             raise Exception(f'{self.max_token_size} < 4096')
-        self.rpm = RPM(int(data.get('rpm', 500)))
-        self.tpm = TPM(int(data.get('tpm', 50000)))
         self.name = name
+        # "" limits this process, a file or redis store shares the budget with other workers
+        store = data.get('rate_limit_store', '')
+        self.rpm = RPM(int(data.get('rpm', 500)), store=store, key='llm:{}:rpm'.format(name))
+        self.tpm = TPM(int(data.get('tpm', 50000)), store=store, key='llm:{}:tpm'.format(name))
         self.port = int(data.get('port', 23333))
         self.model = data.get('remote_llm_model', '')
         self.base_url = data.get('base_url', '')
-        if not self.base_url and name in backend2url:
-            self.base_url = backend2url[name]
+        if not self.base_url and self._type in backend2url:
+            self.base_url = backend2url[self._type]
+
+        # connection pool of the shared client
+        self.max_connections = int(data.get('max_connections', 64))
+        self.keepalive_expiry = float(data.get('keepalive_expiry', 60))
+        self.http2 = bool(data.get('http2', False))
+        self._client = None
+        self._client_loop = None
+        self.stats = {'requests': 0, 'connections': 0}
+
+    def client(self) -> AsyncOpenAI:
+        """Shared client with keep-alive connection pool, created on first
+        use in the running event loop."""
+        loop = asyncio.get_running_loop()
+        if self._client is not None and self._client_loop is loop:
+            return self._client
+
+        # connections of a closed event loop can not be reused
+        import httpx
+        http2 = self.http2
+        if http2:
+            try:
+                import h2  # noqa F401
+            except ImportError:
+                logger.warning('`h2` not installed, fallback to HTTP/1.1. Try `pip install httpx[http2]`')
+                http2 = False
+        http_client = httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(max_connections=self.max_connections,
+                                max_keepalive_connections=self.max_connections,
+                                keepalive_expiry=self.keepalive_expiry),
+            timeout=httpx.Timeout(600, connect=10),
+            event_hooks={'request': [self._on_request]})
+        self._client = AsyncOpenAI(base_url=self.base_url,
+                                   api_key=self.api_key,
+                                   http_client=http_client)
+        self._client_loop = loop
+        return self._client
+
+    async def _on_request(self, request):
+        self.stats['requests'] += 1
+        request.extensions['trace'] = self._on_trace
+
+    async def _on_trace(self, event_name: str, info: Dict):
+        if event_name in ['connection.connect_tcp.complete', 'connection.connect_unix_socket.complete']:
+            self.stats['connections'] += 1
+
+    def reuse_stats(self) -> Dict:
+        requests = self.stats['requests']
+        connections = self.stats['connections']
+        return {
+            'requests': requests,
+            'connections': connections,
+            'reuse_rate': 1 - connections / requests if requests > 0 else 0.0
+        }
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+        self._client = None
+        self._client_loop = None
 
     def jsonify(self):
         return {"api_key": self.name, "model": self.model}
@@ -99,12 +137,32 @@ class LLM:
             config = pytoml.load(f)
             self.llm_config = config['llm']['server']
             name = self.llm_config['remote_type']
-            self.backends[name] = Backend(name=name, data=self.llm_config)
-
-    def choose_model(self, backend: Backend, token_size: int) -> str:
-        model = backend.model
+            # `[[llm.server.endpoints]]` are equivalent replicas, each overrides keys of `[llm.server]`
+            endpoints = self.llm_config.get('endpoints', [])
+            if len(endpoints) < 1:
+                self.backends[name] = Backend(name=name, data=self.llm_config)
+            for index, endpoint in enumerate(endpoints):
+                data = {key: value for key, value in self.llm_config.items() if key != 'endpoints'}
+                data.update(endpoint)
+                endpoint_name = endpoint.get('name', '{}-{}'.format(data['remote_type'], index))
+                self.backends[endpoint_name] = Backend(name=endpoint_name, data=data)
+            # pick endpoint per call, fail over on connection error, timeout, 429 and 5xx
+            self.router = LLMRouter.from_config(
+                backends=list(self.backends.values()),
+                config=config['llm'].get('router', {}),
+                retry_on=(APIConnectionError, APITimeoutError, RateLimitError, InternalServerError,
+                          ConnectionError, TimeoutError))
+            # opt-in response cache of `chat`
+            self.cache = ChatCache.from_config(config['llm'].get('cache', {}))
+            # admission of API calls by priority, user queries before background work
+            self.scheduler = AdmissionScheduler.from_config(config['llm'].get('scheduler', {}))
+            # backend, model and max_tokens of each task tag, e.g. small model for scorers
+            self.tasks = TaskTable.from_config(config['llm'].get('task', {}), backends=list(self.backends.keys()))
+
+    def choose_model(self, backend: Backend, token_size: int, model: str = '') -> str:
+        model = model or backend.model
         response_reserve_length = 2048
-        if backend.name == 'kimi':
+        if backend._type == 'kimi':
             if model == 'auto':
                 if token_size <= 8192 - response_reserve_length:
                     model = 'moonshot-v1-8k'
@@ -114,7 +172,7 @@ class LLM:
                     model = 'moonshot-v1-128k'
                 else:
                     raise ValueError('Input token length exceeds 128k')
-        elif backend.name == 'step' and model == 'auto':
+        elif backend._type == 'step' and model == 'auto':
             if token_size <= 8192 - response_reserve_length:
                 model = 'step-1-8k'
             elif token_size <= 32768 - response_reserve_length:
@@ -125,33 +183,18 @@ class LLM:
                 model = 'step-1-256k'
             else:
                 raise ValueError('Input token length exceeds 256k')
-        elif not model and backend.name in backend2model:
-            model = backend2model[backend.name]
+        elif not model and backend._type in backend2model:
+            model = backend2model[backend._type]
         return model
 
-    @retry(
-        stop=stop_after_attempt(3),
-        wait=wait_exponential(multiplier=1, min=30, max=60),
-        retry=retry_if_exception_type(
-            (RateLimitError, APIConnectionError, Timeout, APITimeoutError)),
-    )
-    @limit_async_func_call(16)
-    async def chat(self,
-                   prompt: str,
-                   backend: str = 'default',
-                   system_prompt='你是茴香豆，简称豆哥。是一个微信群机器人，用于回答群友的疑问。',
-                   history=[],
-                   allow_truncate=False,
-                   max_tokens=1024,
-                   timeout=600,
-                   tools=[]) -> str:
-        # choose backend
-        # if user not specify model, use first one
-        if backend == 'default':
-            backend = list(self.backends.keys())[0]
-        instance = self.backends[backend]
-        # try truncate input prompt
-        input_tokens = encode_string(content=str(prompt)+str(history))
+    def build_request(self, instance: Backend, input_tokens: List[int], prompt: str, system_prompt: str,
+                      history: List, allow_truncate: bool, max_tokens: int, tools: List = None,
+                      model: str = '') -> Tuple[Dict, int]:
+        """Truncate input for `instance` and build completion kwargs.
+
+        Returns:
+            Tuple[Dict, int]: kwargs and input token size.
+        """
         input_token_size = len(input_tokens)
         if input_token_size > instance.max_token_size:
             if not allow_truncate:
@@ -163,8 +206,6 @@ class LLM:
             prompt = decode_tokens(tokens=tokens)
             input_token_size = len(tokens)
 
-        await instance.tpm.wait(token_count=input_token_size)
-
         # build messages
         messages = []
         if system_prompt:
@@ -172,29 +213,104 @@ class LLM:
         messages.extend(history)
         messages.append({"role": "user", "content": prompt})
 
-        content = ''
-        # try:
         model = self.choose_model(backend=instance,
-                                  token_size=input_token_size)
-        openai_async_client = AsyncOpenAI(base_url=instance.base_url,
-                                          api_key=instance.api_key,
-                                          timeout=timeout)
-
+                                  token_size=input_token_size,
+                                  model=model)
         kwargs = {
             "model": model,
             "messages": messages,
             "temperature": 0.7,
-            "top_p": 0.7,
-            "tools": tools
+            "top_p": 0.7
         }
+        if tools is not None:
+            kwargs['tools'] = tools
         if max_tokens:
             kwargs['max_tokens'] = max_tokens
+        return kwargs, input_token_size
+
+    async def chat(self,
+                   prompt: str,
+                   backend: str = 'default',
+                   system_prompt='你是茴香豆，简称豆哥。是一个微信群机器人，用于回答群友的疑问。',
+                   history=[],
+                   allow_truncate=False,
+                   max_tokens=1024,
+                   timeout=600,
+                   tools=[],
+                   use_cache=True,
+                   priority='interactive',
+                   task='chat') -> str:
+        """Chat with LLM.
+
+        With `[llm.cache]` enabled, responses are cached by backend, model,
+        messages and sampling parameters. Set `use_cache` to False for
+        prompts whose answer should change between calls.
+
+        `priority` is "interactive" for sub-prompts of a user query or "batch"
+        for background work, see `AdmissionScheduler`.
+
+        `task` tags the call site, e.g. "score" or "intention". `[llm.task.*]`
+        maps it to endpoints, a model and a `max_tokens` cap, see `TaskTable`.
+        """
+        self.scheduler.check(priority)
+        route = self.tasks.get(task)
+        max_tokens = route.cap(max_tokens)
+        # with `backend` default, the router picks an endpoint of the task and fails over
+        if backend != 'default':
+            targets = [self.backends[backend]]
+        elif route.backends:
+            targets = [self.backends[name] for name in route.backends]
+        else:
+            targets = list(self.backends.values())
+        input_tokens = encode_string(content=str(prompt)+str(history))
+
+        async def request(instance: Backend) -> str:
+            kwargs, input_token_size = self.build_request(instance=instance, input_tokens=input_tokens, prompt=prompt,
+                                                          system_prompt=system_prompt, history=history,
+                                                          allow_truncate=allow_truncate, max_tokens=max_tokens,
+                                                          tools=tools, model=route.model)
+            return await self.call_chat(instance=instance, kwargs=kwargs,
+                                        input_token_size=input_token_size, timeout=timeout, task=task)
+
+        async def call():
+            # a single endpoint is routed too, for latency and circuit accounting.
+            # errors are raised after failover, there is no sleep and retry
+            async with self.scheduler.slot(priority):
+                # hedge short sub-prompts of user queries if `hedge_delay` set
+                return await self.router.run(request, token_count=len(input_tokens), hedge=priority == 'interactive',
+                                             names=[b.name for b in targets])
+
+        async def cached_call():
+            if self.cache is None:
+                return await call()
+            if not use_cache:
+                self.cache.bypass += 1
+                return await call()
+            key = ChatCache.key(endpoints=[(b.base_url, b.model) for b in targets], model=route.model,
+                                system_prompt=system_prompt, history=history, prompt=prompt, max_tokens=max_tokens,
+                                tools=tools, temperature=0.7, top_p=0.7, allow_truncate=allow_truncate)
+            return await self.cache.get_or_call(key, call)
+
+        start = time.time()
+        try:
+            content = await cached_call()
+        except Exception as e:
+            self.tasks.record_call(task, time.time() - start, error=e)
+            raise e
+        self.tasks.record_call(task, time.time() - start)
+        return content
+
+    async def call_chat(self, instance: Backend, kwargs: Dict, input_token_size: int, timeout: float,
+                        task: str = 'chat') -> str:
+        """Request the remote API, only cache misses reach here."""
+        await instance.rpm.wait()
+        await instance.tpm.wait(token_count=input_token_size)
 
         try:
-            response = await openai_async_client.chat.completions.create(**kwargs)
+            response = await instance.client().chat.completions.create(**kwargs, timeout=timeout)
         except Exception as e:
-            logger.error(str(e) + ' input len {}'.format(len(str(messages))))
-            pass
+            logger.error(str(e) + ' input len {}'.format(len(str(kwargs['messages']))))
+            raise e
         logger.info(response.choices[0].message.content)
 
         content = response.choices[0].message.content
@@ -202,17 +318,11 @@ class LLM:
 
         self.sum_input_token_size += input_token_size
         self.sum_output_token_size += content_token_size
+        self.tasks.record_tokens(task, input_token_size, content_token_size)
 
-        await instance.tpm.wait(token_count=content_token_size)
-        await instance.rpm.wait()
+        instance.tpm.charge(token_count=content_token_size)
         return content.strip()
 
-    @retry(
-        stop=stop_after_attempt(3),
-        wait=wait_exponential(multiplier=1, min=30, max=60),
-        retry=retry_if_exception_type(
-            (RateLimitError, APIConnectionError, Timeout, APITimeoutError)),
-    )
     async def chat_stream(self,
                           prompt: str,
                           backend: str = 'default',
@@ -220,71 +330,89 @@ class LLM:
                           history=[],
                           allow_truncate=False,
                           max_tokens=1024,
-                          timeout=600):
-        # choose backend
-        # if user not specify model, use first one
-        if backend == 'default':
-            backend = list(self.backends.keys())[0]
-        instance = self.backends[backend]
-
-        # try truncate input prompt
+                          timeout=600,
+                          priority='stream',
+                          task='generate'):
+        """Stream answer of LLM, `priority` and `task` are the same as
+        `chat`."""
+        self.scheduler.check(priority)
+        route = self.tasks.get(task)
+        max_tokens = route.cap(max_tokens)
         input_tokens = encode_string(content=str(prompt)+str(history))
-        input_token_size = len(input_tokens)
-        if input_token_size > instance.max_token_size:
-            if not allow_truncate:
-                raise Exception(
-                    f'input token size {input_token_size}, max {instance.max_token_size}'
-                )
-
-            tokens = input_tokens[0:instance.max_token_size - input_token_size]
-            prompt = decode_tokens(tokens=tokens)
-            input_token_size = len(tokens)
-
-        await instance.tpm.wait(token_count=input_token_size)
-
-        # build messages
-        messages = []
-        if system_prompt:
-            messages.append({"role": "system", "content": system_prompt})
-        messages.extend(history)
-        messages.append({"role": "user", "content": prompt})
+        if backend == 'default':
+            candidates = self.router.rank(token_count=len(input_tokens), names=route.backends)
+        else:
+            candidates = [self.backends[backend]]
 
-        content = ''
+        begin = time.time()
         try:
-            model = self.choose_model(backend=instance,
-                                      token_size=input_token_size)
-            openai_async_client = AsyncOpenAI(base_url=instance.base_url,
-                                              api_key=instance.api_key,
-                                              timeout=timeout)
-
-            stream = await openai_async_client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=0.7,
-                top_p=0.7,
-                max_tokens=max_tokens,
-                stream=True)
-
-            content = ""
-            async for chunk in stream:
-                if chunk.choices is None:
-                    raise Exception(str(chunk))
-                delta = chunk.choices[0].delta
-                if delta.content:
-                    content += delta.content
-                    yield delta.content
-
+            # the slot is held until the stream ends or the consumer closes it
+            async with self.scheduler.slot(priority):
+                for index, instance in enumerate(candidates):
+                    kwargs, input_token_size = self.build_request(instance=instance, input_tokens=input_tokens,
+                                                                  prompt=prompt, system_prompt=system_prompt,
+                                                                  history=history, allow_truncate=allow_truncate,
+                                                                  max_tokens=max_tokens, model=route.model)
+                    await instance.rpm.wait()
+                    await instance.tpm.wait(token_count=input_token_size)
+
+                    state = self.router.states[instance.name]
+                    state.inflight += 1
+                    start = time.time()
+                    content = None
+                    try:
+                        stream = await instance.client().chat.completions.create(**kwargs, stream=True, timeout=timeout)
+
+                        async for chunk in stream:
+                            if chunk.choices is None:
+                                raise Exception(str(chunk))
+                            if content is None:
+                                # time to first token
+                                self.router.record_success(instance.name, time.time() - start)
+                                content = ''
+                            delta = chunk.choices[0].delta
+                            if delta.content:
+                                content += delta.content
+                                yield delta.content
+
+                    except self.router.retry_on as e:
+                        # fail over only before any token is sent
+                        logger.error(str(e) + ' input len {}'.format(len(str(kwargs['messages']))))
+                        self.router.record_failure(instance.name, e)
+                        if content is not None or index + 1 >= len(candidates):
+                            raise e
+                        continue
+                    except Exception as e:
+                        logger.error(str(e) + ' input len {}'.format(len(str(kwargs['messages']))))
+                        raise e
+                    finally:
+                        state.inflight -= 1
+
+                    content_token_size = len(encode_string(content=content or ''))
+
+                    self.sum_input_token_size += input_token_size
+                    self.sum_output_token_size += content_token_size
+
+                    instance.tpm.charge(token_count=content_token_size)
+                    self.tasks.record_tokens(task, input_token_size, content_token_size)
+                    self.tasks.record_call(task, time.time() - begin)
+                    return
         except Exception as e:
-            logger.error(str(e) + ' input len {}'.format(len(str(messages))))
+            self.tasks.record_call(task, time.time() - begin, error=e)
             raise e
-        content_token_size = len(encode_string(content=content))
 
-        self.sum_input_token_size += input_token_size
-        self.sum_output_token_size += content_token_size
+    def task_report(self) -> Dict[str, Dict]:
+        """Tokens and latency of each task tag."""
+        return self.tasks.report()
 
-        await instance.tpm.wait(token_count=content_token_size)
-        await instance.rpm.wait()
-        return
+    def reuse_stats(self) -> Dict:
+        """Connection reuse of each backend."""
+        return {name: backend.reuse_stats() for name, backend in self.backends.items()}
+
+    async def close(self):
+        """Close pooled connections on shutdown."""
+        for backend in self.backends.values():
+            await backend.close()
 
     def default_model_info(self):
         backend = list(self.backends.keys())[0]
@@ -0,0 +1,156 @@
+"""Exact-match cache of LLM chat responses."""
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from loguru import logger
+
+
+class ChatCache:
+    """Memory LRU over an optional SQLite file, keyed by the full request.
+
+    Classification prompts such as intention, scoring and NER only depend
+    on the request, repeated messages are answered without calling the
+    remote API. Identical requests in flight share one call, only non-empty
+    responses are stored, failures are never cached.
+
+    Args:
+        path: SQLite file shared by processes, None for memory only.
+        capacity: Max responses in memory.
+        ttl: Seconds a response lives.
+
+    Example:
+
+        .. code-block:: python
+
+            cache = ChatCache(path='logs/llm_cache.db')
+            key = cache.key(backend='kimi', model='moonshot-v1-8k', messages=messages)
+            content = await cache.get_or_call(key, lambda: call_api(messages))
+    """
+
+    def __init__(self, path: str = None, capacity: int = 4096, ttl: float = 86400):
+        self.capacity = max(1, capacity)
+        self.ttl = ttl
+        self.lru = OrderedDict()
+        self.inflight = dict()
+        self.lock = threading.Lock()
+        self.conn = None
+        if path:
+            dirname = os.path.dirname(path)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            self.conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, created REAL, content TEXT)')
+            self.conn.execute('DELETE FROM responses WHERE created < ?', (time.time() - ttl, ))
+            self.conn.commit()
+        self.hit = 0
+        self.miss = 0
+        self.dedup = 0
+        self.put_count = 0
+        self.bypass = 0
+
+    @classmethod
+    def from_config(cls, config: Dict) -> Optional['ChatCache']:
+        """Build from `[llm.cache]`, None if disabled."""
+        if not config.get('enable', False):
+            return None
+        return cls(path=config.get('path', ''),
+                   capacity=int(config.get('capacity', 4096)),
+                   ttl=float(config.get('ttl', 86400)))
+
+    @staticmethod
+    def key(**request) -> str:
+        text = json.dumps(request, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(text.encode('utf8')).hexdigest()
+
+    def _remember(self, key: str, created: float, content: str):
+        with self.lock:
+            self.lru[key] = (created, content)
+            self.lru.move_to_end(key)
+            while len(self.lru) > self.capacity:
+                self.lru.popitem(last=False)
+
+    def get(self, key: str) -> Optional[str]:
+        deadline = time.time() - self.ttl
+        with self.lock:
+            item = self.lru.get(key)
+            if item is not None:
+                if item[0] >= deadline:
+                    self.lru.move_to_end(key)
+                    return item[1]
+                self.lru.pop(key)
+
+        if self.conn is None:
+            return None
+        with self.lock:
+            row = self.conn.execute('SELECT created, content FROM responses WHERE key = ? AND created >= ?',
+                                    (key, deadline)).fetchone()
+        if row is None:
+            return None
+        self._remember(key, row[0], row[1])
+        return row[1]
+
+    def put(self, key: str, content: str):
+        created = time.time()
+        self._remember(key, created, content)
+        self.put_count += 1
+        if self.conn is None:
+            return
+        try:
+            with self.lock:
+                self.conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?)', (key, created, content))
+                self.conn.commit()
+        except Exception as e:
+            logger.error('llm cache put failed, {}'.format(str(e)))
+
+    async def get_or_call(self, key: str, call: Callable[[], Awaitable[str]]) -> str:
+        """Return cached response of `key`, or await `call` once for all
+        concurrent callers of the same key."""
+        content = self.get(key)
+        if content is not None:
+            self.hit += 1
+            return content
+
+        future = self.inflight.get(key)
+        if future is not None:
+            self.dedup += 1
+            content = await asyncio.shield(future)
+            if content is not None:
+                return content
+            # leader failed, call by self and let caller retry on error
+            content = await call()
+            if content:
+                self.put(key, content)
+            return content
+
+        self.miss += 1
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        content = None
+        try:
+            content = await call()
+            if content:
+                self.put(key, content)
+        finally:
+            self.inflight.pop(key, None)
+            future.set_result(content)
+        return content
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hit + self.miss + self.dedup
+        return {
+            'size': len(self.lru),
+            'hit': self.hit,
+            'miss': self.miss,
+            'dedup': self.dedup,
+            'put': self.put_count,
+            'bypass': self.bypass,
+            'hit_rate': (self.hit + self.dedup) / total if total > 0 else 0.0
+        }
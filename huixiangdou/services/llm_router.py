@@ -0,0 +1,191 @@
+"""Route LLM calls among equivalent endpoints."""
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+from loguru import logger
+
+
+class EndpointState:
+    """Live latency, load and circuit of one endpoint."""
+
+    def __init__(self):
+        self.latency = None
+        self.inflight = 0
+        self.failures = 0
+        self.open_until = 0.0
+        self.calls = 0
+        self.errors = 0
+        self.hedged = 0
+
+    def is_open(self, now: float) -> bool:
+        return self.failures > 0 and now < self.open_until
+
+
+class LLMRouter:
+    """Pick an endpoint per call and fail over to the next one.
+
+    Endpoints are ranked by expected wait: EWMA latency scaled by calls in
+    flight, plus the time their RPM and TPM buckets need to admit the call.
+    An endpoint is skipped for `cooldown` seconds after `failure_threshold`
+    consecutive failures, then one trial call closes or reopens the circuit.
+    Errors in `retry_on` (connection, timeout, 429, 5xx) fail over to the
+    next endpoint at once, other errors are raised.
+
+    With `hedge_delay` > 0, a hedged call starts the second best endpoint if
+    the first has not answered after `hedge_delay` seconds, the first reply
+    wins and the other is cancelled.
+
+    Args:
+        backends: `Backend` list, each has `name`, `rpm` and `tpm`.
+        alpha: EWMA weight of the newest latency.
+        failure_threshold: Consecutive failures to open the circuit.
+        cooldown: Seconds an open circuit skips the endpoint.
+        hedge_delay: Seconds before starting a hedged call, 0 disables hedging.
+        retry_on: Exception types to fail over on.
+    """
+
+    def __init__(self,
+                 backends: List[Any],
+                 alpha: float = 0.3,
+                 failure_threshold: int = 3,
+                 cooldown: float = 30,
+                 hedge_delay: float = 0,
+                 retry_on: Tuple = (ConnectionError, TimeoutError)):
+        self.backends = {backend.name: backend for backend in backends}
+        self.states = {backend.name: EndpointState() for backend in backends}
+        self.alpha = alpha
+        self.failure_threshold = max(1, failure_threshold)
+        self.cooldown = cooldown
+        self.hedge_delay = hedge_delay
+        self.retry_on = tuple(retry_on)
+
+    @classmethod
+    def from_config(cls, backends: List[Any], config: Dict, retry_on: Tuple) -> 'LLMRouter':
+        """Build from `[llm.router]`."""
+        return cls(backends=backends,
+                   alpha=float(config.get('alpha', 0.3)),
+                   failure_threshold=int(config.get('failure_threshold', 3)),
+                   cooldown=float(config.get('cooldown', 30)),
+                   hedge_delay=float(config.get('hedge_delay', 0)),
+                   retry_on=retry_on)
+
+    def score(self, name: str, token_count: int = 1) -> float:
+        backend = self.backends[name]
+        state = self.states[name]
+        # unmeasured endpoints score 0 and get a trial call
+        latency = state.latency or 0.0
+        budget = max(backend.rpm.bucket.delay(1), backend.tpm.bucket.delay(token_count))
+        return latency * (1 + state.inflight) + budget
+
+    def rank(self, token_count: int = 1, names: List[str] = []) -> List[Any]:
+        """Endpoints in `names` (default all) in preferred order, open
+        circuits last."""
+        now = time.time()
+        names = list(names) if names else list(self.backends.keys())
+        closed = [name for name in names if not self.states[name].is_open(now)]
+        opened = [name for name in names if self.states[name].is_open(now)]
+        closed.sort(key=lambda name: self.score(name, token_count))
+        opened.sort(key=lambda name: self.states[name].open_until)
+        return [self.backends[name] for name in closed + opened]
+
+    def record_success(self, name: str, latency: float):
+        state = self.states[name]
+        state.calls += 1
+        state.failures = 0
+        if state.latency is None:
+            state.latency = latency
+        else:
+            state.latency = self.alpha * latency + (1 - self.alpha) * state.latency
+
+    def record_failure(self, name: str, error: Exception):
+        state = self.states[name]
+        state.calls += 1
+        state.errors += 1
+        state.failures += 1
+        if state.failures >= self.failure_threshold:
+            state.open_until = time.time() + self.cooldown
+            logger.warning('LLM endpoint {} circuit open for {}s, {}'.format(name, self.cooldown, str(error)))
+
+    async def attempt(self, backend: Any, call: Callable[[Any], Awaitable[Any]]):
+        """Run `call` on `backend`, record latency or failure."""
+        state = self.states[backend.name]
+        state.inflight += 1
+        start = time.time()
+        try:
+            result = await call(backend)
+        except self.retry_on as e:
+            self.record_failure(backend.name, e)
+            raise
+        finally:
+            state.inflight -= 1
+        self.record_success(backend.name, time.time() - start)
+        return result
+
+    async def run(self,
+                  call: Callable[[Any], Awaitable[Any]],
+                  token_count: int = 1,
+                  hedge: bool = False,
+                  names: List[str] = []):
+        """Call the best endpoint of `names`, fail over on errors in `retry_on`."""
+        candidates = self.rank(token_count, names)
+        error = None
+        while len(candidates) > 0:
+            backend = candidates.pop(0)
+            try:
+                if hedge and self.hedge_delay > 0 and len(candidates) > 0:
+                    return await self.hedged(backend, candidates.pop(0), call)
+                return await self.attempt(backend, call)
+            except self.retry_on as e:
+                logger.warning('LLM endpoint {} failed, try next. {}'.format(backend.name, str(e)))
+                error = e
+        raise error
+
+    async def hedged(self, first: Any, second: Any, call: Callable[[Any], Awaitable[Any]]):
+        """Start `second` if `first` is slower than `hedge_delay`, return the
+        first success."""
+        task = asyncio.ensure_future(self.attempt(first, call))
+        try:
+            done, _ = await asyncio.wait([task], timeout=self.hedge_delay)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        if len(done) > 0:
+            if task.exception() is None:
+                return task.result()
+            if not isinstance(task.exception(), self.retry_on):
+                raise task.exception()
+            # failed fast, fail over without hedging
+            logger.warning('LLM endpoint {} failed, try next. {}'.format(first.name, str(task.exception())))
+            return await self.attempt(second, call)
+
+        self.states[second.name].hedged += 1
+        error = None
+        pending = {task, asyncio.ensure_future(self.attempt(second, call))}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                    if not isinstance(error, self.retry_on):
+                        raise error
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self) -> Dict[str, Dict]:
+        now = time.time()
+        return {
+            name: {
+                'latency_ms': 1000 * state.latency if state.latency is not None else None,
+                'inflight': state.inflight,
+                'calls': state.calls,
+                'errors': state.errors,
+                'hedged': state.hedged,
+                'open': state.is_open(now)
+            }
+            for name, state in self.states.items()
+        }
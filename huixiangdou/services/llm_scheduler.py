@@ -0,0 +1,140 @@
+"""Priority admission of LLM calls."""
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict
+
+from loguru import logger
+
+# smaller runs first
+PRIORITIES = ('stream', 'interactive', 'batch')
+
+
+class AdmissionScheduler:
+    """Admit LLM calls by priority class under a total concurrency limit.
+
+    Classes are `stream` (answers streamed to users), `interactive`
+    (intention, scoring and other sub-prompts of a user query) and `batch`
+    (knowledge graph building, annotation). A free slot goes to the oldest
+    waiter of the highest class that is under its own limit, so background
+    work never occupies more than `limits['batch']` slots. Waiters are
+    futures resolved on release, there is no polling. A cancelled waiter
+    leaves the queue, a cancelled call frees its slot.
+
+    Args:
+        max_concurrency: Calls in flight of all classes.
+        limits: Calls in flight of each class, default `max_concurrency`.
+
+    Example:
+
+        .. code-block:: python
+
+            scheduler = AdmissionScheduler(max_concurrency=16, limits={'batch': 4})
+            async with scheduler.slot('batch'):
+                await call_api()
+    """
+
+    def __init__(self, max_concurrency: int = 16, limits: Dict[str, int] = {}):
+        self.max_concurrency = max(1, max_concurrency)
+        self.limits = dict()
+        for name in PRIORITIES:
+            self.limits[name] = max(1, min(int(limits.get(name, self.max_concurrency)), self.max_concurrency))
+        self.waiters = {name: deque() for name in PRIORITIES}
+        self.running = {name: 0 for name in PRIORITIES}
+        self.metrics = {
+            name: {
+                'admitted': 0,
+                'cancelled': 0,
+                'max_waiting': 0,
+                'wait_sum': 0.0,
+                'wait_max': 0.0
+            }
+            for name in PRIORITIES
+        }
+
+    @classmethod
+    def from_config(cls, config: Dict) -> 'AdmissionScheduler':
+        """Build from `[llm.scheduler]`."""
+        limits = {name: config[name] for name in PRIORITIES if name in config}
+        return cls(max_concurrency=int(config.get('max_concurrency', 16)), limits=limits)
+
+    def check(self, priority: str):
+        if priority not in self.limits:
+            raise ValueError('Unknown priority {}, choose from {}'.format(priority, PRIORITIES))
+
+    def total_running(self) -> int:
+        return sum(self.running.values())
+
+    def _dispatch(self):
+        """Hand free slots to waiters by priority."""
+        for name in PRIORITIES:
+            waiters = self.waiters[name]
+            while waiters and self.total_running() < self.max_concurrency and self.running[name] < self.limits[name]:
+                future = waiters.popleft()
+                if future.done():
+                    continue
+                self.running[name] += 1
+                future.set_result(None)
+
+    async def acquire(self, priority: str = 'interactive'):
+        self.check(priority)
+        metric = self.metrics[priority]
+        if not self.waiters[priority] and self.total_running() < self.max_concurrency \
+                and self.running[priority] < self.limits[priority]:
+            self.running[priority] += 1
+            metric['admitted'] += 1
+            return
+
+        start = time.time()
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[priority].append(future)
+        metric['max_waiting'] = max(metric['max_waiting'], len(self.waiters[priority]))
+        try:
+            await future
+        except asyncio.CancelledError:
+            metric['cancelled'] += 1
+            if future.done() and not future.cancelled():
+                # admitted and cancelled in the same step, give the slot back
+                self.release(priority)
+            else:
+                try:
+                    self.waiters[priority].remove(future)
+                except ValueError:
+                    pass
+            raise
+
+        cost = time.time() - start
+        metric['admitted'] += 1
+        metric['wait_sum'] += cost
+        metric['wait_max'] = max(metric['wait_max'], cost)
+        if cost > 1:
+            logger.debug('{} LLM call waited {:.2f}s for admission'.format(priority, cost))
+
+    def release(self, priority: str = 'interactive'):
+        self.running[priority] -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, priority: str = 'interactive'):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release(priority)
+
+    def stats(self) -> Dict[str, Dict]:
+        """Running calls, queue depth and admission wait of each class."""
+        ret = dict()
+        for name in PRIORITIES:
+            metric = self.metrics[name]
+            ret[name] = {
+                'running': self.running[name],
+                'waiting': len(self.waiters[name]),
+                'max_waiting': metric['max_waiting'],
+                'admitted': metric['admitted'],
+                'cancelled': metric['cancelled'],
+                'wait_avg_ms': 1000 * metric['wait_sum'] / max(1, metric['admitted']),
+                'wait_max_ms': 1000 * metric['wait_max']
+            }
+        return ret
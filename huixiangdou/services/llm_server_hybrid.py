@@ -190,8 +190,10 @@ class HybridLLMServer:
             _rpm = self.server_config['rpm']
         if 'tpm' in self.server_config:
             _tpm = self.server_config['tpm']
-        self.rpm = RPM(_rpm)
-        self.tpm = TPM(_tpm)
+        # same budget as `Backend` of `LLM` if `rate_limit_store` shared
+        store = self.server_config.get('rate_limit_store', '')
+        self.rpm = RPM(_rpm, store=store, key='llm:{}:rpm'.format(self.remote_type))
+        self.tpm = TPM(_tpm, store=store, key='llm:{}:tpm'.format(self.remote_type))
 
         if self.enable_local:
             self.inference = InferenceWrapper(model_path)
@@ -427,8 +429,8 @@ class HybridLLMServer:
             life = 0
             while life < self.retry:
                 try:
-                    self.rpm.wait()
-                    self.tpm.wait(token_count=len(prompt))
+                    await self.rpm.wait()
+                    await self.tpm.wait(token_count=len(prompt))
                     async for value in target_fn(**args):
                         yield value                     
                     # skip retry
@@ -446,7 +448,7 @@ class HybridLLMServer:
                     randval = random.randint(1, int(pow(2, life)))
                     time.sleep(randval)
 
-            self.tpm.wait(token_count=len(output_text))
+            self.tpm.charge(token_count=len(output_text))
             yield output_text
 
     def chat(self, prompt: str, history=[], backend:str='local'):
@@ -0,0 +1,142 @@
+"""Per-task model routing and usage of LLM calls."""
+import threading
+from collections import deque
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+# tags of `LLM.chat` call sites
+TASKS = ('chat', 'score', 'intention', 'keywords', 'ner', 'generate')
+
+
+class TaskRoute:
+    """Where one task goes.
+
+    Args:
+        backends: Endpoint names of `[llm.server]`, empty for all.
+        model: Model name overriding `remote_llm_model`, empty to keep it.
+        max_tokens: Output cap, 0 to keep the value of the call site.
+    """
+
+    def __init__(self, backends: List[str] = [], model: str = '', max_tokens: int = 0):
+        self.backends = list(backends)
+        self.model = model
+        self.max_tokens = max_tokens
+
+    def cap(self, max_tokens: int) -> int:
+        if self.max_tokens > 0 and (not max_tokens or max_tokens > self.max_tokens):
+            return self.max_tokens
+        return max_tokens
+
+
+class TaskTable:
+    """Route each task tag to a backend/model and count its usage.
+
+    Scorers output one digit and the intention classifier a short JSON,
+    they can run on a small fast model with a low `max_tokens`, while
+    answers keep the large one. Tasks without a route use the default
+    backend, untagged calls are "chat".
+
+    Args:
+        routes: Task name to `TaskRoute`.
+        window: Latencies kept per task for percentiles.
+
+    Example:
+
+        .. code-block:: toml
+
+            [llm.task.score]
+            backend = "small"
+            max_tokens = 8
+    """
+
+    def __init__(self, routes: Dict[str, TaskRoute] = {}, window: int = 1024):
+        self.routes = dict(routes)
+        self.default = TaskRoute()
+        self.window = window
+        self.usage = dict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: Dict, backends: List[str]) -> 'TaskTable':
+        """Build from `[llm.task.*]`, check endpoint names."""
+        routes = dict()
+        for name, value in config.items():
+            if not isinstance(value, dict):
+                continue
+            if name not in TASKS:
+                logger.warning('[llm.task.{}] is not a task tag of {}'.format(name, TASKS))
+            names = value.get('backend', [])
+            if isinstance(names, str):
+                names = [names] if names else []
+            for backend in names:
+                if backend not in backends:
+                    raise ValueError('task {} uses unknown backend {}, choose from {}'.format(name, backend, backends))
+            routes[name] = TaskRoute(backends=names,
+                                     model=value.get('model', ''),
+                                     max_tokens=int(value.get('max_tokens', 0)))
+        return cls(routes=routes)
+
+    def get(self, task: str) -> TaskRoute:
+        return self.routes.get(task, self.default)
+
+    def _usage(self, task: str) -> Dict:
+        if task not in self.usage:
+            self.usage[task] = {
+                'calls': 0,
+                'errors': 0,
+                'api_calls': 0,
+                'input_tokens': 0,
+                'output_tokens': 0,
+                'latency_sum': 0.0,
+                'latency': deque(maxlen=self.window)
+            }
+        return self.usage[task]
+
+    def record_tokens(self, task: str, input_tokens: int, output_tokens: int):
+        """Tokens of one remote API call, cache hits do not reach here."""
+        with self.lock:
+            usage = self._usage(task)
+            usage['api_calls'] += 1
+            usage['input_tokens'] += input_tokens
+            usage['output_tokens'] += output_tokens
+
+    def record_call(self, task: str, latency: float, error: Optional[Exception] = None):
+        """End-to-end latency of one call, including admission and cache."""
+        with self.lock:
+            usage = self._usage(task)
+            usage['calls'] += 1
+            if error is not None:
+                usage['errors'] += 1
+                return
+            usage['latency_sum'] += latency
+            usage['latency'].append(latency)
+
+    def report(self) -> Dict[str, Dict]:
+        """Calls, tokens and latency of each task."""
+        ret = dict()
+        with self.lock:
+            for task, usage in self.usage.items():
+                latency = sorted(usage['latency'])
+                success = usage['calls'] - usage['errors']
+
+                def percentile(p: float) -> float:
+                    if len(latency) < 1:
+                        return 0.0
+                    return 1000 * latency[min(len(latency) - 1, int(p * len(latency)))]
+
+                route = self.get(task)
+                ret[task] = {
+                    'backends': route.backends,
+                    'model': route.model,
+                    'max_tokens': route.max_tokens,
+                    'calls': usage['calls'],
+                    'errors': usage['errors'],
+                    'api_calls': usage['api_calls'],
+                    'input_tokens': usage['input_tokens'],
+                    'output_tokens': usage['output_tokens'],
+                    'latency_avg_ms': 1000 * usage['latency_sum'] / max(1, success),
+                    'latency_p50_ms': percentile(0.5),
+                    'latency_p95_ms': percentile(0.95)
+                }
+        return ret
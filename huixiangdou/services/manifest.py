@@ -0,0 +1,97 @@
+"""Per-workdir manifest for incremental feature store update."""
+import json
+import os
+from typing import Dict, List, Tuple
+
+from loguru import logger
+
+
+class Manifest:
+    """Record content hash and chunk ids of each indexed file.
+
+    `manifest.json` lives in `work_dir`, it is written after all databases
+    saved, so an interrupted update never marks a file as indexed.
+
+    Example:
+
+        {
+            "version": 1,
+            "ner": {"path": "entities.json", "hash": "1a2b3c4d"},
+            "files": {
+                "repodir/a.md": {"hash": "5e6f7a8b", "type": "md", "store": "dense", "chunk_ids": [0, 1]},
+                "repodir/b.py": {"hash": "9c0d1e2f", "type": "code", "store": "sparse", "chunk_ids": []}
+            }
+        }
+    """
+    VERSION = 1
+
+    def __init__(self, work_dir: str):
+        self.path = os.path.join(work_dir, 'manifest.json')
+        self.files = dict()
+        self.ner = None
+
+    @classmethod
+    def load(cls, work_dir: str):
+        """Load manifest from `work_dir`, return None if not exist or broken."""
+        manifest = cls(work_dir)
+        if not os.path.exists(manifest.path):
+            return None
+        try:
+            with open(manifest.path, encoding='utf8') as f:
+                data = json.load(f)
+        except Exception as e:
+            logger.error('load {} failed, {}'.format(manifest.path, str(e)))
+            return None
+        if data.get('version') != cls.VERSION:
+            logger.warning('manifest version mismatch, {}'.format(data.get('version')))
+            return None
+        manifest.files = data['files']
+        manifest.ner = data.get('ner')
+        return manifest
+
+    def save(self):
+        data = {'version': self.VERSION, 'ner': self.ner, 'files': self.files}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def set(self, path: str, _hash: str, _type: str, store: str, chunk_ids: List[int] = []):
+        self.files[path] = {
+            'hash': _hash,
+            'type': _type,
+            'store': store,
+            'chunk_ids': [int(i) for i in chunk_ids]
+        }
+
+    def pop(self, path: str) -> Dict:
+        return self.files.pop(path, None)
+
+    def diff(self, hashes: Dict[str, str]) -> Tuple[List[str], List[str]]:
+        """Compare with current `{path: hash}`.
+
+        Returns:
+            List[str]: added or modified files, need to be indexed.
+            List[str]: deleted or modified files, old chunks need to be removed.
+        """
+        changed = []
+        removed = []
+        for path, _hash in hashes.items():
+            record = self.files.get(path)
+            if record is None:
+                changed.append(path)
+            elif record['hash'] != _hash:
+                changed.append(path)
+                removed.append(path)
+
+        for path in self.files.keys():
+            if path not in hashes:
+                removed.append(path)
+        return changed, removed
+
+    def remap(self, mapping: Dict[int, int]):
+        """Rewrite dense chunk ids after compaction, drop ids not in mapping."""
+        for record in self.files.values():
+            record['chunk_ids'] = [
+                mapping[i] for i in record['chunk_ids'] if i in mapping
+            ]
@@ -4,6 +4,7 @@ import argparse
 import asyncio
 import json
 import copy
+import os
 from typing import List, Tuple, Union, Generator, AsyncGenerator
 
 import pytoml
@@ -11,6 +12,7 @@ from loguru import logger
 
 from huixiangdou.primitive import Query, Chunk
 
+from .answer_cache import AnswerCache
 from .helper import ErrorCode
 from .llm import LLM
 from .retriever import CacheRetriever, Retriever
@@ -42,7 +44,7 @@ class PreprocNode:
             return
 
         prompt = self.INTENTION_TEMPLATE.format(sess.query.text)
-        json_str = await self.llm.chat(prompt=prompt)
+        json_str = await self.llm.chat(prompt=prompt, task='intention')
         sess.debug['PreprocNode_intention_response'] = json_str
         logger.info('intention response {}'.format(json_str))
         try:
@@ -115,7 +117,8 @@ class CodeRetrieval:
             sess.parallel_chunks = []
             return sess
         
-        sess.parallel_chunks = self.retriever.bm25.get_top_n(query=sess.query.text)
+        # scoring is CPU bound, keep the event loop serving other sessions
+        sess.parallel_chunks = await asyncio.to_thread(self.retriever.bm25.get_top_n, sess.query.text)
         return sess
 
 class WebSearchRetrieval:
@@ -147,7 +150,7 @@ class WebSearchRetrieval:
         engine = WebSearch(config_path=self.config_path, language=self.language)
 
         prompt = self.KEYWORDS_TEMPLATE.format(sess.groupname, sess.query.text)
-        search_keywords = await self.llm.chat(prompt)
+        search_keywords = await self.llm.chat(prompt, task='keywords')
         search_keywords = search_keywords.replace('"', '')
         sess.debug['WebSearchNode_keywords'] = prompt
 
@@ -239,6 +242,11 @@ class ParallelPipeline:
         if self.config is None:
             raise Exception('worker config can not be None')
 
+        # reuse answers of similar questions, each work_dir is a namespace
+        self.answer_cache = AnswerCache.from_config(self.config['worker'].get('answer_cache', {}),
+                                                    embedder=self.retriever.embedder,
+                                                    namespace=os.path.abspath(work_dir),
+                                                    version=self.retriever.version)
 
     async def generate(self,
                  query: Union[Query, str],
@@ -273,6 +281,16 @@ class ParallelPipeline:
                        history=history,
                        log_path=self.config['worker']['save_path'])
 
+        if self.answer_cache is not None:
+            hit = await asyncio.to_thread(self.answer_cache.lookup, query, history)
+            if hit is not None:
+                sess.code = ErrorCode.SUCCESS
+                sess.delta = sess.response = hit['response']
+                sess.references = hit['references']
+                sess.debug['answer_cache'] = {'query': hit['query'], 'score': hit['score']}
+                yield sess
+                return
+
         # build pipeline
         preproc = PreprocNode(self.config, self.llm, language)
         text2vec = Text2vecRetrieval(self.retriever)
@@ -310,8 +328,14 @@ class ParallelPipeline:
                 continue
             logger.error(result)
 
+        response = ''
         async for sess in reduce.process(sess):
+            response += sess.delta
             yield sess
+
+        # only answers grounded on retrieved knowledge are reused
+        if self.answer_cache is not None and len(sess.parallel_chunks) > 0:
+            await asyncio.to_thread(self.answer_cache.put, query, response, sess.references, history)
         return
 
 
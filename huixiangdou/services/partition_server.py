@@ -0,0 +1,143 @@
+"""Serve a partition of the dense database, for scatter-gather search by
+`PartitionedFaiss`."""
+import argparse
+import os
+import socket
+import socketserver
+from typing import List, Tuple
+
+import numpy as np
+import pytoml
+from loguru import logger
+
+from huixiangdou.primitive import Faiss, ShardedFaiss
+from huixiangdou.primitive.faiss import merge_topk
+from huixiangdou.primitive.inference_client import pack_array, unpack_array
+from huixiangdou.primitive.partition_client import chunk_to_dict, parse_address
+
+from .inference_server import InferenceHandler
+
+
+class PartitionServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Search shards `partition::partitions` of a sharded dense database.
+
+    A database built without `shard_size` is served as one partition.
+    Chunk ids in replies are global, so the coordinator merges results of
+    all partitions directly. `address` is `unix:/path` or `host:port`.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: str, dense_dir: str, partition: int = 0, partitions: int = 1):
+        self.partition = partition
+        self.partitions = partitions
+        self.parts = self.load_parts(dense_dir, partition, partitions)
+        count = sum(len(shard.chunks) for shard, _ in self.parts)
+        logger.info('partition {}/{} serves {} shards, {} chunks'.format(partition, partitions, len(self.parts), count))
+
+        self.address_family, sockaddr = parse_address(address)
+        if self.address_family == socket.AF_UNIX and os.path.exists(sockaddr):
+            os.remove(sockaddr)
+        super().__init__(sockaddr, InferenceHandler)
+
+    @staticmethod
+    def load_parts(dense_dir: str, partition: int, partitions: int) -> List[Tuple[Faiss, int]]:
+        """Return (shard, chunk id offset) of this partition."""
+        dense = Faiss.load_local(dense_dir, mmap=True)
+        if not isinstance(dense, ShardedFaiss):
+            if partitions > 1:
+                raise ValueError('{} is a single index, set `shard_size` and rebuild to serve it in partitions'.format(dense_dir))
+            return [(dense, 0)]
+        if len(dense.shards) < partitions:
+            logger.warning('{} shards less than {} partitions'.format(len(dense.shards), partitions))
+        return [(dense.shard(i), dense.shards[i]['offset']) for i in range(partition, len(dense.shards), partitions)]
+
+    def locate(self, chunk_id: int) -> Tuple[Faiss, int]:
+        for shard, offset in self.parts:
+            if offset <= chunk_id < offset + len(shard.chunks):
+                return shard, chunk_id - offset
+        raise IndexError('chunk id {} not in partition {}'.format(chunk_id, self.partition))
+
+    def search(self, embeddings: np.ndarray, k: int, ef_search: int = None, nprobe: int = None):
+        all_scores = [np.full((len(embeddings), k), -np.inf, dtype=np.float32)]
+        all_ids = [np.full((len(embeddings), k), -1, dtype=np.int64)]
+        for shard, offset in self.parts:
+            if shard.index is None or shard.index.ntotal < 1:
+                continue
+            shard.k = k
+            scores, ids = shard.similarity_search_batch(embeddings, ef_search=ef_search, nprobe=nprobe)
+            all_scores.append(scores)
+            all_ids.append(np.where(ids >= 0, ids + offset, -1))
+        return merge_topk(all_scores, all_ids, k)
+
+    def dispatch(self, header: dict, payload: bytes = b''):
+        method = header.get('method')
+        if method == 'search':
+            embeddings = unpack_array(header, payload)
+            scores, ids = self.search(embeddings, k=header['k'], ef_search=header.get('ef_search'),
+                                      nprobe=header.get('nprobe'))
+            chunks = dict()
+            for chunk_id in set(ids[ids >= 0].tolist()):
+                shard, local_id = self.locate(chunk_id)
+                chunks[str(chunk_id)] = chunk_to_dict(shard.chunks[local_id])
+            ret_header, ret_payload = pack_array(scores)
+            ret_header.update({'ids': ids.tolist(), 'chunks': chunks})
+            return ret_header, ret_payload
+        elif method == 'chunks':
+            chunks = []
+            for chunk_id in header['ids']:
+                shard, local_id = self.locate(chunk_id)
+                chunks.append(chunk_to_dict(shard.chunks[local_id]))
+            return {'chunks': chunks}, b''
+        elif method == 'info':
+            deleted = []
+            for shard, offset in self.parts:
+                deleted += [offset + i for i in shard.deleted]
+            strategy = self.parts[0][0].strategy if len(self.parts) > 0 else ''
+            return {
+                'partition': self.partition,
+                'partitions': self.partitions,
+                'ranges': [[offset, len(shard.chunks)] for shard, offset in self.parts],
+                'deleted': sorted(deleted),
+                'strategy': str(strategy)
+            }, b''
+        raise ValueError('Unknown method {}'.format(method))
+
+
+def parse_args():
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser(description='Serve a partition of dense database.')
+    parser.add_argument('--work_dir', type=str, default='workdir', help='Working directory.')
+    parser.add_argument(
+        '--config_path',
+        default='config.ini',
+        help='Configuration path, `dense_partitions` in `[feature_store]` lists listen addresses. Default value is config.ini'  # noqa E501
+    )
+    parser.add_argument('--partition', type=int, default=0, help='Index of this partition in `dense_partitions`.')
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    with open(args.config_path, encoding='utf8') as f:
+        fs_config = pytoml.load(f)['feature_store']
+    addresses = fs_config.get('dense_partitions', [])
+    if args.partition >= len(addresses):
+        raise ValueError('partition {} not in `dense_partitions` {}'.format(args.partition, addresses))
+
+    address = addresses[args.partition]
+    server = PartitionServer(address=address, dense_dir=os.path.join(args.work_dir, 'db_dense'),
+                             partition=args.partition, partitions=len(addresses))
+    logger.info('partition {} listen on {}'.format(args.partition, address))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        family, sockaddr = parse_address(address)
+        if family == socket.AF_UNIX and os.path.exists(sockaddr):
+            os.remove(sockaddr)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,9 +11,9 @@ from loguru import logger
 from sklearn.metrics import precision_recall_curve
 from typing import Any, Union, Tuple, List
 
-from huixiangdou.primitive import Embedder, Faiss, LLMReranker, Query, Chunk, BM25Okapi, FileOperation, NamedEntity2Chunk
+from huixiangdou.primitive import Embedder, Faiss, LLMReranker, Query, Chunk, BM25Okapi, FileOperation, EntityIndex, PartitionedFaiss, DocStore
 from .helper import QueryTracker
-from .kg import KnowledgeGraph
+from .kg import KnowledgeGraphIndex
 
 class Retriever:
     """Tokenize and extract features from the project's chunks, for use in the
@@ -28,22 +28,42 @@ class Retriever:
         self.embedder = embedder
         self.reranker = reranker
         self.faiss = None
+        self.kg = None
+        self.entity_index = None
+        self.doc_store = None
         self.work_dir = work_dir
+        # feature store version, changes after every build or update
+        self.version = ''
 
         if not os.path.exists(work_dir):
             logger.warning('!!!warning, workdir not exist.!!!')
             return
 
-        # load prebuilt knowledge graph gpickle
-        self.kg = KnowledgeGraph(config_path=config_path)
+        manifest_path = os.path.join(work_dir, 'manifest.json')
+        if os.path.exists(manifest_path):
+            self.version = FileOperation().md5(manifest_path)
+
+        # load prebuilt knowledge graph serving format, no LLM needed
+        self.kg = KnowledgeGraphIndex.load(os.path.join(work_dir, 'kg'))
 
         # dense retrieval, load refusal-to-answer and response feature database
+        with open(config_path, encoding='utf8') as f:
+            fs_config = pytoml.load(f)['feature_store']
         dense_dir = os.path.join(work_dir, 'db_dense')
-        if not os.path.exists(dense_dir):
+        partitions = fs_config.get('dense_partitions', [])
+        if len(partitions) > 0:
+            # partitions are served by `huixiangdou.services.partition_server`
+            self.faiss = PartitionedFaiss(partitions, timeout=float(fs_config.get('partition_timeout', 1.0)))
+        elif not os.path.exists(dense_dir):
             logger.warning('Dense retriever is None, skip load faiss')
             self.faiss = None
         else:
-            self.faiss = Faiss.load_local(dense_dir)
+            self.faiss = Faiss.load_local(dense_dir, mmap=True)
+        if self.faiss is not None:
+            # search knobs take effect without rebuild
+            for key in ['ef_search', 'nprobe']:
+                if key in fs_config:
+                    setattr(self.faiss.index_config, key, int(fs_config[key]))
 
         # sparse retrieval for python code
         sparse_dir = os.path.join(work_dir, 'db_sparse')
@@ -54,6 +74,12 @@ class Retriever:
             self.bm25 = BM25Okapi()
             self.bm25.load(sparse_dir)
 
+        # named entity inverted index, read-only and shared by all requests
+        self.entity_index = EntityIndex.load(os.path.join(work_dir, 'db_reverted_index'))
+
+        # normalized document text for context, None if built by old version
+        self.doc_store = DocStore.load(os.path.join(work_dir, 'db_doc'))
+
     def update_throttle(self,
                         config_path: str = 'config.ini',
                         good_questions=[],
@@ -63,13 +89,11 @@ class Retriever:
         if len(good_questions) == 0 or len(bad_questions) == 0:
             raise Exception('good and bad question examples cat not be empty.')
         questions = good_questions + bad_questions
-        predictions = []
         self.reject_throttle = -1
 
-        for question in questions:
-            _, score = self.is_relative(query=question,
-                                       enable_kg=True, enable_threshold=False)
-            predictions.append(max(0, score))
+        results = self.is_relative_batch(queries=questions,
+                                         enable_kg=True, enable_threshold=False)
+        predictions = [max(0, score) for _, score in results]
 
         labels = [1 for _ in range(len(good_questions))
                   ] + [0 for _ in range(len(bad_questions))]
@@ -93,27 +117,29 @@ class Retriever:
     def inverted_index_retrieve(self, query: Union[Query, str], topk=100) -> List[Chunk]:
         """Retrieve chunks by named entity."""
         # reverted index retrieval
-        
-        reverted_index_dir = os.path.join(self.work_dir, 'db_reverted_index')
-        if not os.path.exists(reverted_index_dir):
+        if self.entity_index is None:
             return []
-        
-        # In async executor, `reverted_indexer` must lazy build and destroy
-        reverted_indexer = NamedEntity2Chunk(reverted_index_dir)
         if type(query) is str:
             query = Query(text=query)
         
-        entity_ids = reverted_indexer.parse(query.text)
         # chunk_id match counter
-        chunk_id_score_list = reverted_indexer.get_chunk_ids(entity_ids=entity_ids)
-        chunk_id_score_list = chunk_id_score_list[0:topk]
-        del reverted_indexer
+        chunk_id_score_list = self.entity_index.retrieve(query.text)
         
         chunks = []
         for chunk_id, ref_count in chunk_id_score_list:
+            if chunk_id in self.faiss.deleted:
+                continue
             chunks.append(self.faiss.chunks[chunk_id])
+            if len(chunks) >= topk:
+                break
         return chunks
         
+    def graph_delta(self, text: str) -> float:
+        """Lower reject throttle for query mentions knowledge graph entities."""
+        if self.kg is None:
+            return 0.0
+        return 0.2 * min(100, self.kg.file_count(text)) / 100
+
     def text2vec_retrieve(self, query: Union[Query, str]) -> List[Chunk]:
         """Retrieve chunks by text2vec model or knowledge graph. 
         
@@ -126,16 +152,7 @@ class Retriever:
         if type(query) is str:
             query = Query(text=query)
 
-        graph_delta = 0.0
-        if self.kg.is_available():
-            try:
-                docs = self.kg.retrieve(query=query.text)
-                graph_delta = 0.2 * min(100, len(docs)) / 100
-            except Exception as e:
-                logger.warning(str(e))
-                logger.info('KG folder exists, but search failed, skip.')
-
-        threshold = self.reject_throttle - graph_delta
+        threshold = self.reject_throttle - self.graph_delta(query.text)
         t1 = time.time()
         pairs = self.faiss.similarity_search_with_query(self.embedder,
                                                         query=query, threshold=threshold)
@@ -179,10 +196,15 @@ class Retriever:
                 # url
                 file_text = content
             elif chunk.modal == 'text':
-                file_text, error = file_opr.read(chunk.metadata['read'])
-                if error is not None:
-                    # read file failed, skip
-                    continue
+                file_text = None
+                if self.doc_store is not None:
+                    file_text = self.doc_store.get(chunk.metadata['read'])
+                if file_text is None:
+                    # not built with doc store
+                    file_text, error = file_opr.read(chunk.metadata['read'])
+                    if error is not None:
+                        # read file failed, skip
+                        continue
             elif chunk.modal == 'qa':
                 file_text = chunk.metadata['qa']
      
@@ -197,7 +219,9 @@ class Retriever:
                 add_len = context_max_length - len(context)
                 if add_len <= 0:
                     break
-                content_index = file_text.find(content)
+                content_index = chunk.metadata.get('offset', -1)
+                if content_index < 0 or file_text[content_index:content_index + len(content)] != content:
+                    content_index = file_text.find(content)
                 if content_index == -1:
                     # content not in file_text
                     delta = '{}\n{}'.format(content, file_text[0:add_len - len(content) - 1])
@@ -270,13 +294,8 @@ class Retriever:
             raise ValueError('input query {}, faiss {}'.format(query, self.faiss))
 
         graph_delta = 0.0
-        if not enable_kg and self.kg.is_available():
-            try:
-                docs = self.kg.retrieve(query=query.text)
-                graph_delta = 0.2 * min(100, len(docs)) / 100
-            except Exception as e:
-                logger.warning(str(e))
-                logger.info('KG folder exists, but search failed, skip.')
+        if not enable_kg:
+            graph_delta = self.graph_delta(query.text)
 
         threshold = self.reject_throttle - graph_delta
         if enable_threshold:
@@ -287,6 +306,43 @@ class Retriever:
             return True, pairs[0][1]
         return False, -1
 
+    def is_relative_batch(self,
+                          queries: List[Union[Query, str]],
+                          enable_kg=True,
+                          enable_threshold=True) -> List[Tuple[bool, float]]:
+        """Batch version of `is_relative` for text queries.
+
+        Embed all queries in one encoder call and search them in one faiss
+        call, scores are thresholded with numpy."""
+        texts = []
+        for query in queries:
+            text = query.text if isinstance(query, Query) else query
+            if text is None or len(text) < 1 or self.faiss is None:
+                raise ValueError('input query {}, faiss {}'.format(query, self.faiss))
+            texts.append(text)
+        if len(texts) < 1:
+            return []
+
+        graph_delta = np.zeros(len(texts), dtype=np.float32)
+        if not enable_kg:
+            graph_delta[:] = [self.graph_delta(text) for text in texts]
+
+        if enable_threshold:
+            threshold = self.reject_throttle - graph_delta
+        else:
+            threshold = np.full(len(texts), -1, dtype=np.float32)
+
+        t1 = time.time()
+        features = self.embedder.embed_query_batch_text(chunks=[Chunk(content_or_path=text) for text in texts])
+        scores, _ = self.faiss.similarity_search_batch(embeddings=features)
+        t2 = time.time()
+        logger.info('Timecost for is_relative_batch {} queries {} seconds'.format(len(texts), float(t2 - t1)))
+
+        # results are sorted, the first column is the highest score
+        top = scores[:, 0]
+        relative = top >= threshold
+        return [(bool(r), float(s) if r else -1) for r, s in zip(relative, top)]
+
 class CacheRetriever:
 
     def __init__(self,
@@ -301,6 +357,9 @@ class CacheRetriever:
         # load text2vec and rerank model
         logger.info('loading test2vec and rerank models')
         self.embedder = Embedder(model_config=fs_config)
+        # concurrent queries share one forward pass
+        self.embedder.enable_batching(max_batch=int(fs_config.get('embed_batch_size', 32)),
+                                      max_wait_ms=float(fs_config.get('embed_batch_wait_ms', 5)))
         self.reranker = LLMReranker(model_config=fs_config,
                                     topn=rerank_topn)
 
@@ -1,7 +1,9 @@
 """Pipeline."""
 import argparse
+import asyncio
 import datetime
 import json
+import os
 import time
 import pdb
 from abc import ABC, abstractmethod
@@ -12,6 +14,7 @@ from loguru import logger
 
 from huixiangdou.primitive import Query
 
+from .answer_cache import AnswerCache
 from .helper import ErrorCode, is_truth
 from .llm import LLM
 from .retriever import CacheRetriever, Retriever
@@ -50,7 +53,7 @@ class PreprocNode:
             return
 
         prompt = self.INTENTION_TEMPLATE.format(sess.query.text)
-        json_str = await self.llm.chat(prompt=prompt)
+        json_str = await self.llm.chat(prompt=prompt, task='intention')
         sess.debug['PreprocNode_intention_response'] = json_str
         logger.info('intention response {}'.format(json_str))
         try:
@@ -136,8 +139,11 @@ class Text2vecNode(Node):
         # answer the question
         citation = CitationGeneratePrompt(self.language)
         prompt = citation.build(texts=context_texts, question=sess.query.text)
+        # final answers are sampled, `AnswerCache` reuses them instead
         response = await self.llm.chat(prompt=prompt,
-                                              history=sess.history)
+                                              history=sess.history,
+                                              use_cache=False,
+                                              task='generate')
 
         sess.code = ErrorCode.SUCCESS
         sess.response = response
@@ -177,7 +183,7 @@ class WebSearchNode(Node):
         engine = WebSearch(config_path=self.config_path)
 
         prompt = self.KEYWORDS_TEMPLATE.format(sess.groupname, sess.query.text)
-        search_keywords = await self.llm.chat(prompt)
+        search_keywords = await self.llm.chat(prompt, task='keywords')
         sess.debug['WebSearchNode_keywords'] = prompt
         articles, error = engine.get(query=search_keywords, max_article=2)
 
@@ -203,7 +209,7 @@ class WebSearchNode(Node):
 
         citation = CitationGeneratePrompt(self.language)
         prompt = citation.build(texts=texts, question=sess.query.text)
-        sess.response = await self.llm.chat(prompt=prompt, history=sess.history)
+        sess.response = await self.llm.chat(prompt=prompt, history=sess.history, use_cache=False, task='generate')
         sess.code = ErrorCode.SUCCESS
         yield sess
 
@@ -284,6 +290,11 @@ class SerialPipeline:
         if self.config is None:
             raise Exception('worker config can not be None')
 
+        self.answer_cache = AnswerCache.from_config(self.config['worker'].get('answer_cache', {}),
+                                                    embedder=self.retriever.embedder,
+                                                    namespace=os.path.abspath(self.retriever.work_dir),
+                                                    version=self.retriever.version)
+
     def notify_badcase(self):
         """Receiving revert command means the current threshold is too low, use
         higher one."""
@@ -362,6 +373,18 @@ class SerialPipeline:
                        log_path=self.config['worker']['save_path'],
                        groupchats=groupchats)
 
+        # group chats change the question by coreference resolution, not cached
+        use_cache = self.answer_cache is not None and len(groupchats) < 1
+        if use_cache:
+            hit = await asyncio.to_thread(self.answer_cache.lookup, query, history)
+            if hit is not None:
+                sess.code = ErrorCode.SUCCESS
+                sess.response = hit['response']
+                sess.references = hit['references']
+                sess.debug['answer_cache'] = {'query': hit['query'], 'score': hit['score']}
+                yield sess
+                return
+
         # build pipeline
         preproc = PreprocNode(self.config, self.llm, self.language)
         text2vec = Text2vecNode(self.config, self.llm, self.retriever,
@@ -395,6 +418,9 @@ class SerialPipeline:
 
         logger.debug(sess.debug)
         yield sess
+
+        if use_cache and sess.code == ErrorCode.SUCCESS:
+            await asyncio.to_thread(self.answer_cache.put, query, sess.response, sess.references, history)
         # return sess.code, sess.response, sess.references
 
 def parse_args():
@@ -9,19 +9,21 @@ import time
 import csv
 from dataclasses import dataclass
 from multiprocessing import Pool
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Union
 import random
 import pytoml
 from loguru import logger
 from tqdm import tqdm
 
 
-from ..primitive import (ChineseRecursiveTextSplitter, Chunk, Embedder, Faiss,
-                         FileName, FileOperation,
+from ..primitive import (ChineseRecursiveTextSplitter, Chunk, DocStore, Embedder, Faiss,
+                         EmbeddingCache, FileName, FileOperation, IndexConfig, ShardedFaiss,
                          RecursiveCharacterTextSplitter, nested_split_markdown,
                          split_python_code,
                          BM25Okapi, NamedEntity2Chunk)
 from .helper import histogram
+from .ingest import IngestPipeline
+from .manifest import Manifest
 from .retriever import CacheRetriever, Retriever
 
 
@@ -82,9 +84,16 @@ class FeatureStore:
         with open(config_path, encoding='utf8') as f:
             config = pytoml.load(f)['feature_store']
             self.reject_throttle = config['reject_throttle']
+            embedding_cache_dir = config.get('embedding_cache_dir', '')
+            self.index_config = IndexConfig.from_config(config)
+            self.shard_size = int(config.get('shard_size', 0))
+            self.ingest = IngestPipeline.from_config(store=self, config=config)
 
         logger.debug('loading text2vec model..')
         self.embedder = embedder
+        self.embedding_cache = None
+        if embedding_cache_dir:
+            self.embedding_cache = EmbeddingCache(cache_dir=embedding_cache_dir, model_id=embedder.model_id)
         self.retriever = None
         self.chunk_size = chunk_size
         self.analyze_reject = analyze_reject
@@ -128,8 +137,25 @@ class FeatureStore:
             length += len(c.content_or_path)
         return chunks, length
     
-    def build_inverted_index(self, chunks: List[Chunk], ner_file: str, work_dir: str):
-        """Build inverted index based on named entity for knowledge base."""
+    def map_entities(self, indexer: NamedEntity2Chunk, chunks: Iterable[Tuple[int, Chunk]]) -> Dict[int, List[int]]:
+        """Parse (chunk_id, chunk) with named entities, return {entity_id: [chunk_id]}."""
+        map_entity2chunks = dict()
+        for chunk_id, chunk in chunks:
+            if chunk.modal != 'text':
+                continue
+            entity_ids = indexer.parse(text=chunk.content_or_path)
+            for entity_id in entity_ids:
+                if entity_id not in map_entity2chunks:
+                    map_entity2chunks[entity_id] = [chunk_id]
+                else:
+                    map_entity2chunks[entity_id].append(chunk_id)
+        return map_entity2chunks
+
+    def build_inverted_index(self, chunks: Union[List[Chunk], Iterable[Tuple[int, Chunk]]], ner_file: str, work_dir: str):
+        """Build inverted index based on named entity for knowledge base.
+
+        `chunks` is the chunk list saved in dense database, or (chunk_id, chunk) pairs.
+        """
         if ner_file is None:
             return
         # 倒排索引 retrieve 建库
@@ -141,32 +167,52 @@ class FeatureStore:
             entities = json.load(f)
             
         time0 = time.time()
-        map_entity2chunks = dict()
         indexer = NamedEntity2Chunk(file_dir=index_dir)
         indexer.clean()
         indexer.set_entity(entities=entities)
         
         # build inverted index
-        for chunk_id, chunk in enumerate(chunks):
-            if chunk.modal != 'text':
-                continue
-            entity_ids = indexer.parse(text=chunk.content_or_path)
-            for entity_id in entity_ids:
-                if entity_id not in map_entity2chunks:
-                    map_entity2chunks[entity_id] = [chunk_id]
-                else:
-                    map_entity2chunks[entity_id].append(chunk_id)
-    
-        for entity_id, chunk_indexes in map_entity2chunks.items():
-            indexer.insert_relation(eid = entity_id, chunk_ids=chunk_indexes)
+        if type(chunks) is list:
+            chunks = enumerate(chunks)
+        map_entity2chunks = self.map_entities(indexer=indexer, chunks=chunks)
+        indexer.set_relations(map_entity2chunks)
         del indexer
         time1 = time.time()
         logger.info('Timecost for build_inverted_index {}s'.format(time1-time0))
-        
-    def build_sparse(self, files: List[FileName], work_dir: str):
-        """Use BM25 for building code feature"""
-        # split by function, class and annotation, remove blank
-        # build bm25 pickle
+
+    def update_inverted_index(self, chunks: Iterable[Tuple[int, Chunk]], removed_ids: Set[int], work_dir: str):
+        """Incremental update inverted index with entities saved in `work_dir`."""
+        index_dir = os.path.join(work_dir, 'db_reverted_index')
+        if not os.path.exists(os.path.join(index_dir, 'entities.json')):
+            return
+
+        indexer = NamedEntity2Chunk(file_dir=index_dir)
+        relations = indexer.get_relations()
+        for entity_id in relations.keys():
+            relations[entity_id] = [i for i in relations[entity_id] if i not in removed_ids]
+
+        for entity_id, chunk_ids in self.map_entities(indexer=indexer, chunks=chunks).items():
+            if entity_id not in relations:
+                relations[entity_id] = chunk_ids
+            else:
+                relations[entity_id] += chunk_ids
+        indexer.set_relations(relations)
+        del indexer
+
+    def remap_inverted_index(self, mapping: Dict[int, int], work_dir: str):
+        """Rewrite chunk ids of inverted index after compaction."""
+        index_dir = os.path.join(work_dir, 'db_reverted_index')
+        if not os.path.exists(os.path.join(index_dir, 'entity2chunk.sql')):
+            return
+        indexer = NamedEntity2Chunk(file_dir=index_dir)
+        relations = indexer.get_relations()
+        for entity_id in relations.keys():
+            relations[entity_id] = [mapping[i] for i in relations[entity_id] if i in mapping]
+        indexer.set_relations(relations)
+        del indexer
+
+    def split_codes(self, files: List[FileName]) -> List[Chunk]:
+        """Split python code by function, class and annotation, remove blank."""
         fileopr = FileOperation()
         chunks = []
         
@@ -176,7 +222,12 @@ class FeatureStore:
                 continue
             file_chunks = split_python_code(filepath=file.origin, text=content, metadata={'source': file.origin, 'read': file.copypath})
             chunks += file_chunks
-        
+        return chunks
+
+    def build_sparse(self, files: List[FileName], work_dir: str):
+        """Use BM25 for building code feature"""
+        # build bm25 postings
+        chunks = self.split_codes(files=files)
         sparse_dir = os.path.join(work_dir, 'db_sparse')
         bm25 = BM25Okapi()
         bm25.save(chunks, sparse_dir)
@@ -242,14 +293,37 @@ class FeatureStore:
             logger.error(f"Error processing QA pairs from {qa_pair_file}: {str(e)}")
             return []
 
-    def build_dense(self, files: List[FileName], work_dir: str, markdown_as_txt: bool=False, qa_pair_file: str = None):
-        """Extract the features required for the response pipeline based on the
-        document."""
-        feature_dir = os.path.join(work_dir, 'db_dense')
-        if not os.path.exists(feature_dir):
-            os.makedirs(feature_dir)
+    def split_file(self, file: FileName, markdown_as_txt: bool = False) -> List[Chunk]:
+        """Split one preprocessed document, `file.state` and `file.reason` are updated."""
+        metadata = {'source': file.origin, 'read': file.copypath}
 
-        file_opr = FileOperation()
+        # If you need higher rejection precision, set `markdown_as_txt` as True
+        if not markdown_as_txt and file._type == 'md':
+            chunks, md_length = self.parse_markdown(file=file, metadata=metadata)
+            file.reason = str(md_length)
+            text, error = FileOperation().read(file.copypath)
+        else:
+            # now read pdf/word/excel/ppt text
+            text, error = FileOperation().read(file.copypath)
+            if error is not None:
+                file.state = False
+                file.reason = str(error)
+                return []
+            file.reason = str(len(text))
+            chunks = self.text_splitter.create_chunks(texts=[file.prefix + text], metadatas=[metadata])
+
+        if not self.embedder.support_image:
+            chunks = list(filter(lambda x: x.modal=='text' or x.modal=='qa', chunks))
+
+        # position in the text saved by `build_doc_store`, context is sliced from it when answering
+        if error is None:
+            texts = [c for c in chunks if c.modal == 'text']
+            for chunk, offset in zip(texts, DocStore.locate(text, [c.content_or_path for c in texts])):
+                chunk.metadata['offset'] = offset
+        return chunks
+
+    def split_documents(self, files: List[FileName], markdown_as_txt: bool=False, qa_pair_file: str = None) -> List[Chunk]:
+        """Split documents and QA pairs to chunks."""
         chunks = []
         
         # Process QA pairs if provided
@@ -262,36 +336,27 @@ class FeatureStore:
         for i, file in tqdm(enumerate(files), 'split'):
             if not file.state:
                 continue
-            metadata = {'source': file.origin, 'read': file.copypath}
+            chunks += self.split_file(file=file, markdown_as_txt=markdown_as_txt)
+        return chunks
 
-            # If you need higher rejection precision, set `markdown_as_txt` as True
-            if not markdown_as_txt and file._type == 'md':
-                md_chunks, md_length = self.parse_markdown(file=file,
-                                                           metadata=metadata)
-                chunks += md_chunks
-                file.reason = str(md_length)
+    def build_dense(self, files: List[FileName], work_dir: str, markdown_as_txt: bool=False, qa_pair_file: str = None):
+        """Extract the features required for the response pipeline based on the
+        document.
 
-            else:
-                # now read pdf/word/excel/ppt text
-                text, error = file_opr.read(file.copypath)
-                if error is not None:
-                    file.state = False
-                    file.reason = str(error)
-                    continue
-                file.reason = str(len(text))
-                text = file.prefix + text
-                chunks += self.text_splitter.create_chunks(
-                    texts=[text], metadatas=[metadata])
+        Returns:
+            List[Chunk]: saved chunks, list index is the chunk id.
+        """
+        feature_dir = os.path.join(work_dir, 'db_dense')
+        if not os.path.exists(feature_dir):
+            os.makedirs(feature_dir)
 
-        if not self.embedder.support_image:
-            filtered_chunks = list(filter(lambda x: x.modal=='text' or x.modal=='qa', chunks))
-        else:
-            filtered_chunks = chunks
+        chunks = self.split_documents(files=files, markdown_as_txt=markdown_as_txt, qa_pair_file=qa_pair_file)
         if len(chunks) < 1:
             return chunks
 
-        self.analyze(filtered_chunks)
-        Faiss.save_local(folder_path=feature_dir, chunks=filtered_chunks, embedder=self.embedder)
+        self.analyze(chunks)
+        Faiss.save_local(folder_path=feature_dir, chunks=chunks, embedder=self.embedder,
+                         cache=self.embedding_cache, index_config=self.index_config)
         return chunks
 
     def analyze(self, chunks: List[Chunk]):
@@ -343,59 +408,75 @@ class FeatureStore:
             os.makedirs(preproc_dir)
 
         pool = Pool(processes=8)
-        file_opr = FileOperation()
+        parse_files = []
         for idx, file in tqdm(enumerate(files), 'preprocess'):
-            if not os.path.exists(file.origin):
-                file.state = False
-                file.reason = 'skip not exist'
-                continue
-
-            if file._type == 'image':
-                file.state = False
-                file.reason = 'skip image'
-
-            elif file._type in ['pdf', 'word', 'excel', 'ppt', 'html']:
-                # read pdf/word/excel file and save to text format
-                md5 = file_opr.md5(file.origin)
-                file.copypath = os.path.join(preproc_dir,
-                                             '{}.text'.format(md5))
+            if self.prepare_file(file=file, preproc_dir=preproc_dir):
                 pool.apply_async(read_and_save, (file, ))
-
-            elif file._type in ['code']:
-                md5 = file_opr.md5(file.origin)
-                file.copypath = os.path.join(preproc_dir,
-                                             '{}.code'.format(md5))
-                read_and_save(file)
-
-            elif file._type in ['md', 'text']:
-                # rename text files to new dir
-                md5 = file_opr.md5(file.origin)
-                file.copypath = os.path.join(
-                    preproc_dir,
-                    file.origin.replace('/', '_')[-84:])
-                try:
-                    shutil.copy(file.origin, file.copypath)
-                    file.state = True
-                    file.reason = 'preprocessed'
-                except Exception as e:
-                    file.state = False
-                    file.reason = str(e)
-            else:
-                file.state = False
-                file.reason = 'skip unknown format'
+                parse_files.append(file)
         pool.close()
         logger.debug('waiting for file preprocess finish..')
         pool.join()
 
         # check process result
-        for file in files:
-            if file._type in ['pdf', 'word', 'excel']:
-                if os.path.exists(file.copypath):
-                    file.state = True
-                    file.reason = 'preprocessed'
-                else:
-                    file.state = False
-                    file.reason = 'read error'
+        for file in parse_files:
+            self.check_parsed(file)
+
+    def prepare_file(self, file: FileName, preproc_dir: str) -> bool:
+        """Hash one file and set its `copypath` in `preproc_dir`, text and code
+        are copied directly.
+
+        Returns:
+            bool: True if it is pdf/word/excel/ppt/html and needs `read_and_save`.
+        """
+        file_opr = FileOperation()
+        if not os.path.exists(file.origin):
+            file.state = False
+            file.reason = 'skip not exist'
+            return False
+
+        if file._type == 'image':
+            file.state = False
+            file.reason = 'skip image'
+
+        elif file._type in ['pdf', 'word', 'excel', 'ppt', 'html']:
+            # read pdf/word/excel file and save to text format
+            md5 = file_opr.md5(file.origin)
+            file.copypath = os.path.join(preproc_dir,
+                                         '{}.text'.format(md5))
+            return True
+
+        elif file._type in ['code']:
+            md5 = file_opr.md5(file.origin)
+            file.copypath = os.path.join(preproc_dir,
+                                         '{}.code'.format(md5))
+            read_and_save(file)
+
+        elif file._type in ['md', 'text']:
+            # rename text files to new dir
+            md5 = file_opr.md5(file.origin)
+            file.copypath = os.path.join(
+                preproc_dir,
+                file.origin.replace('/', '_')[-84:])
+            try:
+                shutil.copy(file.origin, file.copypath)
+                file.state = True
+                file.reason = 'preprocessed'
+            except Exception as e:
+                file.state = False
+                file.reason = str(e)
+        else:
+            file.state = False
+            file.reason = 'skip unknown format'
+        return False
+
+    def check_parsed(self, file: FileName):
+        """Set state of file parsed by `read_and_save`."""
+        if os.path.exists(file.copypath):
+            file.state = True
+            file.reason = 'preprocessed'
+        else:
+            file.state = False
+            file.reason = 'read error'
 
     def initialize(self, config: InitializeConfig):
         """Initializes response and reject feature store.
@@ -410,14 +491,265 @@ class FeatureStore:
         logger.info(
             'initialize response and reject feature store, you only need call this once.'  # noqa E501
         )
-        self.preprocess(files=config.files, work_dir=config.work_dir)
-        # build dense retrieval refusal-to-answer and response database
-        documents = list(filter(lambda x: x._type != 'code', config.files))
-        chunks = self.build_dense(files=documents, work_dir=config.work_dir, qa_pair_file=config.qa_pair_file)
+        # preprocess, split and embed documents as a stream, code files are only preprocessed
+        dense_dir = os.path.join(config.work_dir, 'db_dense')
+        dense = self.create_dense(dense_dir, shard_size=self.shard_size)
+        self.ingest.run(files=config.files, work_dir=config.work_dir, dense=dense, qa_pair_file=config.qa_pair_file)
+        self.finish_initialize(config=config, dense=dense, dense_dir=dense_dir)
+
+    def create_dense(self, dense_dir: str, shard_size: int) -> Faiss:
+        """Empty dense database, sharded if `shard_size` > 0."""
+        if shard_size > 0:
+            return ShardedFaiss.create(dense_dir, strategy=self.embedder.distance_strategy,
+                                       shard_size=shard_size, index_config=self.index_config)
+        # stale shards would shadow the single index
+        ShardedFaiss.clear(dense_dir)
+        return Faiss(index=None, chunks=[], strategy=self.embedder.distance_strategy, index_config=self.index_config)
+
+    def finish_initialize(self, config: InitializeConfig, dense: Faiss, dense_dir: str):
+        """Save dense database, build sparse database, inverted index and manifest."""
+        chunks = dense.chunks
+        if len(chunks) > 0:
+            self.analyze(chunks)
+            dense.save(dense_dir)
 
         codes = list(filter(lambda x: x._type == 'code', config.files))
         self.build_sparse(files=codes, work_dir=config.work_dir)
         self.build_inverted_index(chunks=chunks, ner_file=config.ner_file, work_dir=config.work_dir)
+        self.build_doc_store(chunks=enumerate(chunks), work_dir=config.work_dir, refresh_all=True)
+
+        # record what is indexed, for incremental `update`
+        manifest = Manifest(config.work_dir)
+        self.record(manifest=manifest, files=config.files, chunks=enumerate(chunks), qa_pair_file=config.qa_pair_file)
+        if config.ner_file is not None:
+            manifest.ner = {'path': config.ner_file, 'hash': FileOperation().md5(config.ner_file)}
+        manifest.save()
+
+    def build_doc_store(self, chunks: Iterable[Tuple[int, Chunk]], work_dir: str,
+                        refresh: Iterable[str] = (), refresh_all: bool = False):
+        """Save normalized text of documents referenced by text `chunks` to `db_doc`.
+
+        Text of unchanged documents is copied from the old store, `refresh`
+        lists `read` paths to read again.
+        """
+        doc_dir = os.path.join(work_dir, 'db_doc')
+        if refresh_all and os.path.exists(doc_dir):
+            shutil.rmtree(doc_dir)
+
+        def paths():
+            for _, chunk in chunks:
+                source = chunk.metadata.get('source', '')
+                if chunk.modal == 'text' and 'read' in chunk.metadata and '://' not in source:
+                    yield chunk.metadata['read']
+
+        lengths = DocStore.build(doc_dir, paths=paths(), refresh=refresh)
+        logger.info('doc store saved {} documents, {} chars'.format(len(lengths), sum(lengths.values())))
+
+    @staticmethod
+    def part_dir(work_dir: str, part: int) -> str:
+        return os.path.join(work_dir, 'db_dense_parts', 'part_{}'.format(part))
+
+    def initialize_part(self, config: InitializeConfig, part: int, num_parts: int):
+        """Build dense shards of every `num_parts`-th file, starting from `part`.
+
+        Parts run in parallel processes or machines sharing `work_dir`,
+        then `merge_parts` combines them. QA pairs go to part 0.
+        """
+        part_dir = self.part_dir(config.work_dir, part)
+        files = config.files[part::num_parts]
+        qa_pair_file = config.qa_pair_file if part == 0 else None
+        logger.info('build part {}/{} with {} files'.format(part, num_parts, len(files)))
+
+        # without `shard_size` each part is a single shard
+        shard_size = self.shard_size if self.shard_size > 0 else 1 << 30
+        dense = self.create_dense(part_dir, shard_size=shard_size)
+        self.ingest.run(files=files, work_dir=config.work_dir, dense=dense, qa_pair_file=qa_pair_file)
+        dense.save(part_dir)
+
+        states = [{'origin': f.origin, 'state': f.state, 'reason': f.reason} for f in files]
+        with open(os.path.join(part_dir, 'files.json'), 'w', encoding='utf8') as f:
+            json.dump(states, f, ensure_ascii=False)
+
+    def merge_parts(self, config: InitializeConfig, num_parts: int):
+        """Merge dense shards built by `initialize_part`, then finish `initialize`."""
+        part_dirs = [self.part_dir(config.work_dir, part) for part in range(num_parts)]
+        states = dict()
+        for part_dir in part_dirs:
+            if not os.path.exists(os.path.join(part_dir, 'files.json')):
+                raise ValueError('{} not built, run `--shard-part` first'.format(part_dir))
+            with open(os.path.join(part_dir, 'files.json'), encoding='utf8') as f:
+                states.update((s['origin'], s) for s in json.load(f))
+        for file in config.files:
+            state = states.get(file.origin)
+            if state is None:
+                file.state = False
+                file.reason = 'not built by any part'
+            else:
+                file.state = state['state']
+                file.reason = state['reason']
+
+        dense_dir = os.path.join(config.work_dir, 'db_dense')
+        dense = ShardedFaiss.merge(part_dirs, dense_dir)
+        self.finish_initialize(config=config, dense=dense, dense_dir=dense_dir)
+        shutil.rmtree(os.path.join(config.work_dir, 'db_dense_parts'), ignore_errors=True)
+
+    def record(self, manifest: Manifest, files: List[FileName], chunks: Iterable[Tuple[int, Chunk]], qa_pair_file: str = None):
+        """Save content hash and dense chunk ids of successfully indexed files to manifest."""
+        file_opr = FileOperation()
+        source2ids = dict()
+        for chunk_id, chunk in chunks:
+            source = chunk.metadata.get('source')
+            if source not in source2ids:
+                source2ids[source] = [chunk_id]
+            else:
+                source2ids[source].append(chunk_id)
+
+        for file in files:
+            if not file.state or not os.path.exists(file.origin):
+                continue
+            store = 'sparse' if file._type == 'code' else 'dense'
+            manifest.set(path=file.origin, _hash=file_opr.md5(file.origin), _type=file._type,
+                         store=store, chunk_ids=source2ids.get(file.origin, []))
+
+        if qa_pair_file is not None:
+            manifest.set(path=qa_pair_file, _hash=file_opr.md5(qa_pair_file), _type='qa',
+                         store='dense', chunk_ids=source2ids.get(qa_pair_file, []))
+
+    def update(self, config: InitializeConfig, compact_ratio: float = 0.3):
+        """Incrementally update feature store, only changed files are processed.
+
+        Files are compared with `manifest.json` by content hash. Chunks of
+        modified or removed files are tombstoned in dense index, removed
+        from BM25 and inverted index; added or modified files are split,
+        embedded and appended. Compact dense index when tombstones exceed
+        `compact_ratio`.
+
+        Fallback to `initialize` if there is no manifest, the dense index
+        is built by old version or `index_type` changed.
+        
+        Args:
+            config: Configuration object, `files` is the full file list of the knowledge base.
+            compact_ratio: Tombstone ratio to trigger compaction.
+        """
+        work_dir = config.work_dir
+        dense_dir = os.path.join(work_dir, 'db_dense')
+        manifest = Manifest.load(work_dir)
+        if manifest is None or not os.path.exists(dense_dir):
+            logger.info('manifest or dense database not exist, full build')
+            return self.initialize(config)
+
+        dense = Faiss.load_local(dense_dir)
+        if not dense.is_updatable():
+            logger.info('dense database not support incremental update, full build')
+            return self.initialize(config)
+        if dense.index_config.index_type != self.index_config.index_type:
+            logger.info('index_type changed from {} to {}, full build'.format(
+                dense.index_config.index_type, self.index_config.index_type))
+            return self.initialize(config)
+
+        ner_hash = None
+        if config.ner_file is not None:
+            ner_hash = FileOperation().md5(config.ner_file)
+
+        # diff by content hash
+        file_opr = FileOperation()
+        current = dict()
+        hashes = dict()
+        for file in config.files:
+            if not os.path.exists(file.origin):
+                file.state = False
+                file.reason = 'skip not exist'
+                continue
+            if file._type not in ['pdf', 'word', 'excel', 'ppt', 'html', 'code', 'md', 'text']:
+                file.state = False
+                file.reason = 'skip unknown format' if file._type != 'image' else 'skip image'
+                continue
+            current[file.origin] = file
+            hashes[file.origin] = file_opr.md5(file.origin)
+        if config.qa_pair_file is not None:
+            hashes[config.qa_pair_file] = file_opr.md5(config.qa_pair_file)
+
+        changed, removed = manifest.diff(hashes)
+        for path, file in current.items():
+            if path not in changed:
+                file.state = True
+                file.reason = 'unchanged'
+        logger.info('incremental update, {} changed, {} removed, {} unchanged'.format(
+            len(changed), len(removed), len(hashes) - len(changed)))
+
+        if len(changed) < 1 and len(removed) < 1 and (ner_hash is None or (manifest.ner or {}).get('hash') == ner_hash):
+            return
+
+        # remove old chunks
+        removed_ids = set()
+        removed_sparse = []
+        for path in removed:
+            record = manifest.pop(path)
+            if record['store'] == 'sparse':
+                removed_sparse.append(path)
+            else:
+                removed_ids.update(record['chunk_ids'])
+        dense.remove(removed_ids)
+
+        # add new chunks
+        files = [current[path] for path in changed if path in current]
+        qa_pair_file = config.qa_pair_file if config.qa_pair_file in changed else None
+        chunk_ids = self.ingest.run(files=files, work_dir=work_dir, dense=dense, qa_pair_file=qa_pair_file)
+        new_chunks = [(chunk_id, dense.chunks[chunk_id]) for chunk_id in chunk_ids]
+        if len(new_chunks) > 0:
+            self.analyze([chunk for _, chunk in new_chunks])
+
+        codes = list(filter(lambda x: x._type == 'code', files))
+        if len(codes) > 0 or len(removed_sparse) > 0:
+            self.update_sparse(files=codes, remove_sources=removed_sparse, work_dir=work_dir)
+
+        # inverted index, rebuild if NER file changed
+        if ner_hash is not None and (manifest.ner or {}).get('hash') != ner_hash:
+            self.build_inverted_index(chunks=dense.live_chunks(), ner_file=config.ner_file, work_dir=work_dir)
+            manifest.ner = {'path': config.ner_file, 'hash': ner_hash}
+        else:
+            self.update_inverted_index(chunks=new_chunks, removed_ids=removed_ids, work_dir=work_dir)
+
+        self.record(manifest=manifest, files=files, chunks=new_chunks, qa_pair_file=qa_pair_file)
+        self.build_doc_store(chunks=dense.live_chunks(), work_dir=work_dir,
+                             refresh=set(c.metadata.get('read') for _, c in new_chunks))
+
+        if dense.tombstone_ratio() > compact_ratio:
+            self.compact_dense(dense=dense, manifest=manifest, work_dir=work_dir)
+        dense.save(dense_dir)
+        manifest.save()
+
+    def update_sparse(self, files: List[FileName], remove_sources: List[str], work_dir: str):
+        """Incremental update BM25 for code files."""
+        sparse_dir = os.path.join(work_dir, 'db_sparse')
+        bm25 = BM25Okapi()
+        if BM25Okapi.exists(sparse_dir):
+            bm25.load(sparse_dir)
+
+        bm25.update(chunks=self.split_codes(files=files), remove_sources=remove_sources)
+        if bm25.corpus_size < 1:
+            # `Retriever` loads bm25 if `db_sparse` exists
+            if os.path.exists(sparse_dir):
+                shutil.rmtree(sparse_dir)
+            return
+        bm25.dump(sparse_dir)
+
+    def compact_dense(self, dense: Faiss, manifest: Manifest, work_dir: str):
+        """Drop tombstones in dense index, rewrite chunk ids in manifest and inverted index."""
+        mapping = dense.compact()
+        manifest.remap(mapping)
+        self.remap_inverted_index(mapping=mapping, work_dir=work_dir)
+
+    def compact(self, work_dir: str):
+        """Compact dense database in `work_dir`."""
+        dense_dir = os.path.join(work_dir, 'db_dense')
+        manifest = Manifest.load(work_dir)
+        if manifest is None:
+            raise ValueError('manifest not exist in {}, please initialize first'.format(work_dir))
+        dense = Faiss.load_local(dense_dir)
+        self.compact_dense(dense=dense, manifest=manifest, work_dir=work_dir)
+        dense.save(dense_dir)
+        manifest.save()
 
 def parse_args():
     """Parse command-line arguments."""
@@ -465,6 +797,31 @@ def parse_args():
         action='store_true',
         default=False,
         help='Remove old data and rebuild knowledge graph from scratch.')
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        default=False,
+        help='Only process added, modified and removed files compared with last build.')
+    parser.add_argument(
+        '--compact',
+        action='store_true',
+        default=False,
+        help='Drop removed chunks in dense database, works with `--incremental`.')
+    parser.add_argument(
+        '--shard-part',
+        type=int,
+        default=None,
+        help='Only build dense shards of this part, run one process per part then `--merge-parts`.')
+    parser.add_argument(
+        '--shard-parts',
+        type=int,
+        default=1,
+        help='Number of parts built in parallel, works with `--shard-part` and `--merge-parts`.')
+    parser.add_argument(
+        '--merge-parts',
+        action='store_true',
+        default=False,
+        help='Merge parts built by `--shard-part` into the dense database and finish the build.')
     args = parser.parse_args()
     return args
 
@@ -487,9 +844,8 @@ def test_reject(retriever: Retriever, sample: str = None):
         with open(sample) as f:
             real_questions = json.load(f)
 
-    for example in real_questions:
-        relative, score = retriever.is_relative(example)
-
+    results = retriever.is_relative_batch(real_questions)
+    for example, (relative, score) in zip(real_questions, results):
         if relative:
             logger.warning(f'process query: {example}')
         else:
@@ -555,7 +911,20 @@ if __name__ == '__main__':
         qa_pair_file=args.qa_pair
     )
 
-    fs_init.initialize(config=init_config)
+    if args.shard_part is not None:
+        # parts are merged and tested by `--merge-parts`
+        fs_init.initialize_part(config=init_config, part=args.shard_part, num_parts=args.shard_parts)
+        file_opr.summarize(files)
+        raise SystemExit(0)
+
+    if args.merge_parts:
+        fs_init.merge_parts(config=init_config, num_parts=args.shard_parts)
+    elif args.incremental:
+        fs_init.update(config=init_config)
+        if args.compact:
+            fs_init.compact(work_dir=args.work_dir)
+    else:
+        fs_init.initialize(config=init_config)
     file_opr.summarize(files)
     del fs_init
 
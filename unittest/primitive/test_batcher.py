@@ -0,0 +1,81 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from huixiangdou.primitive.batcher import MicroBatcher
+
+
+def test_micro_batcher():
+    sizes = []
+
+    def encode(texts):
+        sizes.append(len(texts))
+        # slow forward, later queries queue up
+        time.sleep(0.02)
+        return np.array([[len(t)] for t in texts], dtype=np.float32)
+
+    batcher = MicroBatcher(encode, max_batch=8, max_wait_ms=10)
+    texts = ['x' * i for i in range(40)]
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        features = list(pool.map(batcher, texts))
+
+    for text, feature in zip(texts, features):
+        assert feature.shape == (1, 1) and feature[0][0] == len(text)
+    assert sum(sizes) == 40
+    assert max(sizes) <= 8 and len(sizes) < 40
+    assert batcher.items == 40 and batcher.batches == len(sizes)
+    batcher.close()
+
+
+def test_micro_batcher_error():
+
+    def encode(texts):
+        if 'bad' in texts:
+            raise ValueError('bad input')
+        return np.zeros((len(texts), 2), dtype=np.float32)
+
+    batcher = MicroBatcher(encode, max_batch=4, max_wait_ms=0)
+    try:
+        batcher('bad')
+        assert False
+    except ValueError:
+        pass
+    # worker survives failed batch
+    assert batcher('good').shape == (1, 2)
+    batcher.close()
+    assert batcher.thread is None
+    try:
+        batcher('good')
+        assert False
+    except RuntimeError:
+        pass
+
+
+def test_micro_batcher_close():
+    # items submitted while closing are all answered before the worker stops
+    for _ in range(20):
+        batcher = MicroBatcher(lambda texts: np.zeros((len(texts), 1), dtype=np.float32), max_wait_ms=1)
+        futures = []
+
+        def submit():
+            for i in range(50):
+                try:
+                    futures.append(batcher.submit(str(i)))
+                except RuntimeError:
+                    return
+
+        thread = threading.Thread(target=submit)
+        thread.start()
+        time.sleep(0.001)
+        batcher.close()
+        thread.join()
+        for future in futures:
+            assert future.result(timeout=1).shape == (1, 1)
+
+
+if __name__ == '__main__':
+    test_micro_batcher()
+    test_micro_batcher_error()
+    test_micro_batcher_close()
@@ -1,3 +1,8 @@
+import os
+import shutil
+
+import numpy as np
+
 from huixiangdou.primitive import BM25Okapi, Chunk
 import pdb
 
@@ -26,6 +31,42 @@ def test_bm25_load():
     res = bm25.get_top_n(query=query_text)
     print(res)
 
+def test_bm25_update_and_tokenizer():
+    work_dir = '/tmp/huixiangdou_unittest_bm25'
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+
+    chunks = [
+        Chunk(content_or_path='install mmpose with pip', metadata={'source': 'a.md'}),
+        Chunk(content_or_path='mmdet is a detection toolbox', metadata={'source': 'b.md'}),
+        Chunk(content_or_path='the weather is windy', metadata={'source': 'c.md'})
+    ]
+    bm25 = BM25Okapi(tokenizer='split')
+    bm25.save(chunks, work_dir)
+
+    # tokenizer name is persisted with postings
+    bm25 = BM25Okapi()
+    bm25.load(work_dir)
+    assert bm25.tokenizer_name == 'split'
+    assert bm25.get_top_n(query='mmpose install', n=1)[0].metadata['source'] == 'a.md'
+
+    scores = bm25.get_scores(['mmdet', 'toolbox'])
+    assert scores.shape == (3, )
+    assert np.argmax(scores) == 1
+    assert list(bm25.get_batch_scores(['mmdet', 'toolbox'], [1, 2])) == list(scores[[1, 2]])
+
+    bm25.update(chunks=[Chunk(content_or_path='mmdet tutorial', metadata={'source': 'd.md'})],
+                remove_sources=['b.md'])
+    bm25.dump(work_dir)
+    bm25 = BM25Okapi()
+    bm25.load(work_dir)
+    assert bm25.corpus_size == 3
+    assert 'toolbox' not in bm25.term2id
+    sources = [c.metadata['source'] for c in bm25.get_top_n(query='mmdet', n=3)]
+    assert sources[0] == 'd.md' and 'b.md' not in sources
+
+
 if __name__ == '__main__':
     test_bm25_dump()
     test_bm25_load()
+    test_bm25_update_and_tokenizer()
@@ -0,0 +1,28 @@
+from huixiangdou.primitive import Chunk, ChunkStore
+
+
+def test_chunk_store():
+    chunks = [
+        Chunk('hello world', {'source': 'a.md', 'read': 'preprocess/a.md'}),
+        Chunk('你好，世界', {'source': 'a.md', 'read': 'preprocess/a.md', 'Header 1': '标题'}),
+        Chunk('resource/figures/inside-mmpose.jpg', {'source': 'b.md'}, 'image'),
+        Chunk('question', {'read': 'qa.csv', 'source': 'qa.csv', 'qa': 'question: answer'}, 'qa'),
+        Chunk('')
+    ]
+    ChunkStore.write('/tmp', chunks, name='unittest_chunks')
+
+    store = ChunkStore('/tmp', name='unittest_chunks')
+    assert len(store) == len(chunks)
+    assert store.paths == ['a.md', 'preprocess/a.md', 'b.md', 'qa.csv']
+    for origin, loaded in zip(chunks, store):
+        assert origin == loaded
+    assert store.source(3) == 'qa.csv'
+
+    store += [Chunk('appended', {'source': 'c.md'})]
+    assert store[-1].content_or_path == 'appended'
+    ChunkStore.write('/tmp', store, name='unittest_chunks')
+    assert ChunkStore('/tmp', name='unittest_chunks')[5].metadata == {'source': 'c.md'}
+
+
+if __name__ == '__main__':
+    test_chunk_store()
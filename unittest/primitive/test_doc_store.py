@@ -0,0 +1,45 @@
+import os
+import shutil
+
+from huixiangdou.primitive import DocStore, FileOperation
+
+
+def test_doc_store():
+    root = '/tmp/huixiangdou_unittest_doc_store'
+    shutil.rmtree(root, ignore_errors=True)
+    os.makedirs(root)
+    paths = [os.path.join(root, name) for name in ['a.md', 'b.text', 'missing.md']]
+    for path, text in zip(paths[0:2], ['# 标题\n\n\n第一段  内容\n\nsecond', 'hello world']):
+        with open(path, 'w', encoding='utf8') as f:
+            f.write(text)
+
+    doc_dir = os.path.join(root, 'db_doc')
+    assert DocStore.load(doc_dir) is None
+    lengths = DocStore.build(doc_dir, paths=paths + paths[0:1])
+    assert sorted(lengths.keys()) == paths[0:2]
+
+    store = DocStore.load(doc_dir, capacity=1)
+    # same text as reading the file when answering
+    assert store.get(paths[0]) == FileOperation().read(paths[0])[0]
+    assert store.get(paths[1]) == 'hello world'
+    assert store.get(paths[0]) == store.get(paths[0])
+    assert len(store.lru) == 1
+    assert store.get(os.path.join(root, 'other.md')) is None
+
+    # unchanged documents come from the old store
+    with open(paths[1], 'w', encoding='utf8') as f:
+        f.write('changed')
+    os.remove(paths[0])
+    DocStore.build(doc_dir, paths=paths[0:2])
+    assert DocStore.load(doc_dir).get(paths[1]) == 'hello world'
+    DocStore.build(doc_dir, paths=paths[0:2], refresh=[paths[1]])
+    store = DocStore.load(doc_dir)
+    assert store.get(paths[1]) == 'changed'
+    assert store.get(paths[0]).startswith('# 标题')
+
+    text = 'abc def abc xyz'
+    assert DocStore.locate(text, ['abc', 'def', 'abc', 'none', 'xyz']) == [0, 4, 8, -1, 12]
+
+
+if __name__ == '__main__':
+    test_doc_store()
@@ -0,0 +1,144 @@
+import os
+import shutil
+
+import numpy as np
+
+from huixiangdou.primitive import Chunk, Embedder, EmbeddingCache, Faiss, QueryEmbeddingCache
+
+from test_faiss import HashEmbedder
+
+
+def test_embedding_cache_reload():
+    cache_dir = '/tmp/embedding_cache'
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+
+    cache = EmbeddingCache(cache_dir=cache_dir, model_id='unittest')
+    features = np.random.rand(3, 8).astype(np.float32)
+    assert cache.get(['a', 'b', 'c']) == [None, None, None]
+    cache.put(['a', 'b', 'c'], features)
+    assert np.allclose(cache.get(['b'])[0], features[1])
+
+    # simulate a crashed writer, partial vector row is dropped
+    with open(cache.vector_path, 'ab') as f:
+        f.write(b'\x00' * 7)
+    cache = EmbeddingCache(cache_dir=cache_dir, model_id='unittest')
+    assert len(cache) == 3
+    ret = cache.get(['c', 'd'])
+    assert np.allclose(ret[0], features[2]) and ret[1] is None
+    cache.put(['d'], features[0:1])
+    assert np.allclose(cache.get(['d'])[0], features[0])
+
+    # another model never hits
+    assert EmbeddingCache(cache_dir=cache_dir, model_id='other').get(['a']) == [None]
+
+
+def test_embedding_cache_shared():
+    cache_dir = '/tmp/embedding_cache_shared'
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+
+    # two workers started before any record exists
+    reader = EmbeddingCache(cache_dir=cache_dir, model_id='unittest', max_rows=8)
+    writer = EmbeddingCache(cache_dir=cache_dir, model_id='unittest', max_rows=8)
+    features = np.random.rand(12, 8).astype(np.float32)
+    writer.put(['a', 'b'], features[0:2])
+    assert np.allclose(reader.get(['b'])[0], features[1])
+    writer.put(['c'], features[2:3])
+    assert np.allclose(reader.get(['c'])[0], features[2])
+
+    # appended records are folded into the sorted index
+    reader.FOLD_SIZE = 2
+    writer.put(['d', 'e'], features[3:5])
+    ret = reader.get(['a', 'd', 'e'])
+    assert len(reader.recent) == 0 and np.allclose(ret[1], features[3])
+
+    # full disk tier starts over, readers reload
+    writer.put(['f{}'.format(i) for i in range(4)], features[5:9])
+    assert len(reader) == 5 and reader.get(['a'])[0] is None
+    assert np.allclose(reader.get(['f3'])[0], features[8])
+    assert len(reader) == 4
+
+
+def test_faiss_with_embedding_cache():
+    cache_dir = '/tmp/embedding_cache_faiss'
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+
+    class CountEmbedder(HashEmbedder):
+        count = 0
+
+        def embed_query(self, text: str = None, path: str = None):
+            self.count += 1
+            return super().embed_query(text=text, path=path)
+
+    embedder = CountEmbedder()
+    chunks = [Chunk('chunk {}'.format(i)) for i in range(10)]
+    cache = EmbeddingCache(cache_dir=cache_dir, model_id='unittest')
+    Faiss.save_local('/tmp/faiss_cache', chunks=chunks, embedder=embedder, cache=cache)
+    assert embedder.count == 10
+
+    cache = EmbeddingCache(cache_dir=cache_dir, model_id='unittest')
+    chunks.append(Chunk('new chunk'))
+    Faiss.save_local('/tmp/faiss_cache', chunks=chunks, embedder=embedder, cache=cache)
+    assert embedder.count == 11
+
+    g = Faiss.load_local('/tmp/faiss_cache')
+    chunk, score = g.similarity_search(embedder.embed_query(text='chunk 3'))[0]
+    assert chunk.content_or_path == 'chunk 3'
+
+
+def test_query_embedding_cache():
+    cache_dir = '/tmp/query_embedding_cache'
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+
+    # remote embedder builds without model weights, count API calls
+    config = {
+        'embedding_model_path': 'https://api.siliconflow.cn/v1/embeddings',
+        'api_token': 'unittest',
+        'api_rpm': 1000,
+        'api_tpm': 40000,
+        'query_cache_size': 2,
+        'query_cache_dir': cache_dir
+    }
+    hash_embedder = HashEmbedder()
+    calls = []
+
+    def embed(text: str = None, path: str = None):
+        calls.append(text)
+        return hash_embedder.embed_query(text=text)
+
+    embedder = Embedder(model_config=config)
+    embedder._embed_query = embed
+    a = embedder.embed_query(text='how to  install mmpose ?')
+    b = embedder.embed_query(text=' how to install mmpose ?\n')
+    assert calls == ['how to install mmpose ?'] and np.allclose(a, b)
+    embedder.embed_query(text='b')
+    embedder.embed_query(text='c')
+    assert len(embedder.query_cache) == 2
+    assert embedder.query_cache.hit == 1 and embedder.query_cache.miss == 3
+
+    # another worker process reads the shared disk tier
+    embedder = Embedder(model_config=config)
+    embedder._embed_query = embed
+    assert np.allclose(embedder.embed_query(text='how to install mmpose ?'), a)
+    assert len(calls) == 3 and embedder.query_cache.disk_hit == 1
+
+    # disk tier rotation must not wipe the build cache
+    try:
+        Embedder(model_config=dict(config, embedding_cache_dir=cache_dir + '/'))
+        assert False, 'equal cache dirs should be rejected'
+    except ValueError:
+        pass
+
+    cache = QueryEmbeddingCache(model_id='unittest', capacity=0)
+    cache.put(cache.key(text='a'), a)
+    assert cache.get(cache.key(text='a')) is None
+
+
+if __name__ == '__main__':
+    test_embedding_cache_reload()
+    test_embedding_cache_shared()
+    test_faiss_with_embedding_cache()
+    test_query_embedding_cache()
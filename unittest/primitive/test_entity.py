@@ -1,7 +1,7 @@
 import os
 import pdb
 
-from huixiangdou.primitive import NamedEntity2Chunk, Chunk
+from huixiangdou.primitive import EntityAutomaton, EntityIndex, NamedEntity2Chunk, Chunk
 
 
 def test_entity_build_and_query():
@@ -39,5 +39,46 @@ def test_entity_build_and_query():
     assert chunk_id_list[0][0] == 0
 
 
+def test_entity_automaton():
+    entities = ['he', 'she', 'his', 'hers', 'MMPose', '']
+    automaton = EntityAutomaton().build(entities)
+    # overlapped and nested entities in one pass
+    assert automaton.match('ushers') == [0, 1, 3]
+    assert automaton.match('install mmpose') == [4]
+    assert automaton.match('nothing') == []
+
+    for text in ['this is hers', 'MMPOSE shell', 'Hi']:
+        expected = [i for i, e in enumerate(entities) if e and e.lower() in text.lower()]
+        assert automaton.match(text) == expected
+
+    path = '/tmp/huixiangdou_unittest_entities.ac.npz'
+    automaton.save(path)
+    loaded = EntityAutomaton.load(path)
+    assert loaded.match('ushers') == [0, 1, 3]
+
+    case_sensitive = EntityAutomaton(ignore_case=False).build(entities)
+    assert case_sensitive.match('install mmpose') == []
+
+
+def test_entity_index():
+    index_dir = '/tmp/huixiangdou_unittest_entity_index'
+    indexer = NamedEntity2Chunk(index_dir)
+    indexer.clean()
+    indexer.set_entity(entities=['mmpose', 'mmdet', 'install'])
+    indexer.set_relations({0: [1, 2, 3], 1: [3, 7], 2: [2, 3]})
+    assert indexer.get_relations()[1] == [3, 7]
+    assert indexer.get_chunk_ids(entity_ids=[0, 2])[0:2] == [(2, 2), (3, 2)]
+    del indexer
+
+    # read-only handle, sqlite is closed after load
+    index = EntityIndex.load(index_dir)
+    assert index.get_chunk_ids([0, 1, 2])[0] == (3, 3)
+    assert index.retrieve('How to install MMPose ?') == [(2, 2), (3, 2), (1, 1)]
+    assert index.retrieve('nothing') == []
+    assert EntityIndex.load('/tmp/huixiangdou_unittest_not_exist') is None
+
+
 if __name__ == '__main__':
     test_entity_build_and_query()
+    test_entity_automaton()
+    test_entity_index()
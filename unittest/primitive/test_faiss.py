@@ -1,7 +1,27 @@
+import hashlib
 import os
 import pdb
+import shutil
 
-from huixiangdou.primitive import Chunk, Embedder, Faiss, Query
+import numpy as np
+
+from huixiangdou.primitive import Chunk, Embedder, Faiss, IndexConfig, Query, ShardedFaiss
+from huixiangdou.primitive.query import DistanceStrategy
+
+
+class HashEmbedder:
+    """Deterministic fake text2vec, same text same feature."""
+    support_image = False
+    model_id = 'unittest-hash'
+    distance_strategy = DistanceStrategy.EUCLIDEAN_DISTANCE
+
+    def embed_query(self, text: str = None, path: str = None):
+        seed = int(hashlib.md5(text.encode('utf8')).hexdigest()[0:8], 16)
+        emb = np.random.RandomState(seed).rand(1, 32).astype(np.float32)
+        return emb / np.linalg.norm(emb)
+
+    def embed_query_batch_text(self, chunks=[]):
+        return np.concatenate([self.embed_query(text=c.content_or_path) for c in chunks])
 
 
 def test_faiss():
@@ -33,5 +53,210 @@ def test_faiss():
     assert score >= 0.9999
 
 
+def test_faiss_incremental():
+    embedder = HashEmbedder()
+    chunks = [Chunk('chunk {}'.format(i), {'source': 'a.md'}) for i in range(8)]
+    save_path = '/tmp/faiss_incremental'
+    Faiss.save_local(folder_path=save_path, chunks=chunks, embedder=embedder)
+
+    g = Faiss.load_local(save_path)
+    assert g.is_updatable()
+    g.remove([0, 1, 2])
+    ids = g.add(chunks=[Chunk('new chunk', {'source': 'b.md'})], embedder=embedder)
+    assert ids == [8]
+    g.save(save_path)
+
+    g = Faiss.load_local(save_path)
+    assert g.deleted == {0, 1, 2}
+    chunk, score = g.similarity_search(embedder.embed_query(text='chunk 0'))[0]
+    assert chunk.content_or_path != 'chunk 0'
+    chunk, score = g.similarity_search(embedder.embed_query(text='new chunk'))[0]
+    assert chunk.content_or_path == 'new chunk'
+    assert score >= 0.9999
+
+    mapping = g.compact()
+    assert mapping[3] == 0 and mapping[8] == 5
+    assert len(g.chunks) == 6 and g.index.ntotal == 6
+    chunk, score = g.similarity_search(embedder.embed_query(text='chunk 7'))[0]
+    assert chunk.content_or_path == 'chunk 7'
+    assert score >= 0.9999
+
+    # serving, memory-mapped and read-only
+    g.save(save_path)
+    g = Faiss.load_local(save_path, mmap=True)
+    chunk, score = g.similarity_search(embedder.embed_query(text='new chunk'))[0]
+    assert chunk.content_or_path == 'new chunk'
+    try:
+        g.add(chunks=[Chunk('read only')], embedder=embedder)
+        assert False
+    except ValueError:
+        pass
+
+
+def test_faiss_index_types():
+    embedder = HashEmbedder()
+    chunks = [Chunk('chunk {}'.format(i), {'source': 'a.md'}) for i in range(300)]
+    for index_type in IndexConfig.TYPES:
+        save_path = '/tmp/faiss_{}'.format(index_type)
+        config = IndexConfig(index_type=index_type, train_size=260, nlist=4, pq_m=8)
+        Faiss.save_local(folder_path=save_path, chunks=chunks, embedder=embedder, index_config=config)
+
+        g = Faiss.load_local(save_path, mmap=True)
+        assert g.index.ntotal == 300
+        assert g.index_config.index_type == index_type
+        chunk, score = g.similarity_search(embedder.embed_query(text='chunk 42'), ef_search=64, nprobe=4)[0]
+        assert chunk.content_or_path == 'chunk 42'
+
+        # compact keeps trained index type
+        g = Faiss.load_local(save_path)
+        g.remove(range(0, 300, 2))
+        g.compact()
+        assert g.index.ntotal == 150
+        chunk, _ = g.similarity_search(embedder.embed_query(text='chunk 41'), nprobe=4)[0]
+        assert chunk.content_or_path == 'chunk 41'
+
+
+def test_faiss_search_batch():
+    embedder = HashEmbedder()
+    chunks = [Chunk('chunk {}'.format(i), {'source': 'a.md'}) for i in range(40)]
+    save_path = '/tmp/faiss_search_batch'
+    Faiss.save_local(folder_path=save_path, chunks=chunks, embedder=embedder)
+    g = Faiss.load_local(save_path)
+    g.k = 5
+    g.remove([3, 4])
+
+    texts = ['chunk 3', 'chunk 7', 'chunk 21']
+    features = embedder.embed_query_batch_text(chunks=[Chunk(t) for t in texts])
+    scores, ids = g.similarity_search_batch(features)
+    assert scores.shape == (3, 5) and ids.shape == (3, 5)
+    assert not np.isin(ids, [3, 4]).any()
+    assert ids[1][0] == 7 and ids[2][0] == 21
+    for i, text in enumerate(texts):
+        pairs = g.similarity_search(embedder.embed_query(text=text))
+        assert [c.content_or_path for c, _ in pairs] == [chunks[j].content_or_path for j in ids[i]]
+        assert np.allclose([s for _, s in pairs], scores[i])
+
+
+
+def test_faiss_search_tombstones():
+    embedder = HashEmbedder()
+    chunks = [Chunk('chunk {}'.format(i), {'source': 'a.md'}) for i in range(1000)]
+    for index_type in ['flat', 'hnsw', 'ivf_flat']:
+        save_path = '/tmp/faiss_tombstones_{}'.format(index_type)
+        config = IndexConfig(index_type=index_type, nlist=4, nprobe=4)
+        Faiss.save_local(folder_path=save_path, chunks=chunks, embedder=embedder, index_config=config)
+        g = Faiss.load_local(save_path)
+        g.k = 5
+        g.remove(range(0, 900))
+
+        # k asked from faiss does not grow with tombstones
+        requested = []
+        search = g.index.search
+
+        def spy(x, k, **kwargs):
+            requested.append(k)
+            return search(x, k, **kwargs)
+        g.index.search = spy
+
+        features = embedder.embed_query_batch_text(chunks=[Chunk('chunk 10'), Chunk('chunk 950')])
+        scores, ids = g.similarity_search_batch(features)
+        assert requested == [5]
+        assert (ids >= 900).all()
+        assert ids[1][0] == 950
+        selector = g.deleted_selector()
+        g.similarity_search_batch(features)
+        assert g.deleted_selector() is selector
+
+        # selector follows new tombstones
+        g.remove([950])
+        scores, ids = g.similarity_search_batch(features)
+        assert 950 not in ids
+
+
+def test_faiss_sharded():
+    embedder = HashEmbedder()
+    chunks = [Chunk('chunk {}'.format(i), {'source': 'a.md'}) for i in range(40)]
+    config = IndexConfig(index_type='flat')
+    Faiss.save_local(folder_path='/tmp/faiss_single', chunks=chunks, embedder=embedder, index_config=config)
+    single = Faiss.load_local('/tmp/faiss_single')
+
+    # crash after 2 sealed shards, resume only embeds the rest
+    save_path = '/tmp/faiss_sharded'
+    shutil.rmtree(save_path, ignore_errors=True)
+    g = ShardedFaiss.create(save_path, strategy=embedder.distance_strategy, shard_size=7, index_config=config)
+    assert g.add(chunks=chunks[0:17], embedder=embedder) == list(range(17))
+    assert len(g.shards) == 2
+    del g
+
+    embedded = []
+    embedder.embed_query_batch_text = lambda chunks: embedded.extend(chunks) or HashEmbedder.embed_query_batch_text(embedder, chunks)
+    g = ShardedFaiss.create(save_path, strategy=embedder.distance_strategy, shard_size=7, index_config=config)
+    assert g.add(chunks=chunks, embedder=embedder, batchsize=8) == list(range(40))
+    g.save(save_path)
+    assert len(embedded) == 26
+    assert [s['count'] for s in g.shards] == [7, 7, 7, 7, 7, 5]
+
+    g = Faiss.load_local(save_path, mmap=True)
+    assert isinstance(g, ShardedFaiss) and len(g.chunks) == 40
+    assert [c.content_or_path for c in g.chunks] == [c.content_or_path for c in chunks]
+    features = embedder.embed_query_batch_text(chunks=[Chunk(t) for t in ['chunk 3', 'chunk 38']])
+    for k in [5, 30]:
+        g.k = single.k = k
+        scores, ids = g.similarity_search_batch(features)
+        expect_scores, expect_ids = single.similarity_search_batch(features)
+        assert (ids == expect_ids).all() and np.allclose(scores, expect_scores)
+
+    # incremental update and compact across shards
+    g = Faiss.load_local(save_path)
+    g.remove([0, 8, 9, 39])
+    assert g.add(chunks=[Chunk('new chunk', {'source': 'b.md'})], embedder=embedder) == [40]
+    chunk, _ = g.similarity_search(embedder.embed_query(text='chunk 8'))[0]
+    assert chunk.content_or_path != 'chunk 8'
+    g.save(save_path)
+
+    # crash before the manifest is rewritten, old shards are still there
+    g = Faiss.load_local(save_path)
+    old_names = [s['name'] for s in g.shards]
+
+    def crash(complete):
+        raise RuntimeError('crash')
+    g.write_manifest = crash
+    try:
+        g.compact()
+        assert False
+    except RuntimeError:
+        pass
+    g = Faiss.load_local(save_path)
+    assert [s['name'] for s in g.shards] == old_names and len(g.chunks) == 41
+    chunk, _ = g.similarity_search(embedder.embed_query(text='chunk 10'))[0]
+    assert chunk.content_or_path == 'chunk 10'
+
+    mapping = g.compact()
+    names = [s['name'] for s in g.shards]
+    assert names[0] not in old_names and names[2] == old_names[2]
+    assert sorted(n for n in os.listdir(save_path) if n.startswith('shard_')) == sorted(names)
+    g.save(save_path)
+    assert mapping[1] == 0 and mapping[10] == 7 and mapping[40] == 36
+    g = Faiss.load_local(save_path)
+    assert len(g.chunks) == 37 and len(g.deleted) == 0
+    chunk, score = g.similarity_search(embedder.embed_query(text='new chunk'))[0]
+    assert chunk.content_or_path == 'new chunk' and score >= 0.9999
+
+    # parts built in parallel, then merged
+    parts = ['/tmp/faiss_sharded_part0', '/tmp/faiss_sharded_part1']
+    for part, part_chunks in zip(parts, [chunks[0:25], chunks[25:]]):
+        shutil.rmtree(part, ignore_errors=True)
+        g = ShardedFaiss.create(part, strategy=embedder.distance_strategy, shard_size=10, index_config=config)
+        g.add(chunks=part_chunks, embedder=embedder)
+        g.remove([0])
+        g.save(part)
+    ShardedFaiss.merge(parts, save_path)
+    g = Faiss.load_local(save_path, mmap=True)
+    assert [s['offset'] for s in g.shards] == [0, 10, 20, 25, 35]
+    assert g.deleted == {0, 25}
+    chunk, _ = g.similarity_search(embedder.embed_query(text='chunk 33'))[0]
+    assert chunk.content_or_path == 'chunk 33'
+
+
 if __name__ == '__main__':
     test_faiss()
@@ -1,25 +1,81 @@
+import asyncio
+import multiprocessing
+import os
 import time
-from huixiangdou.services.llm_server_hybrid import RPM, TPM
 
-def test_rpm():
-    rpm = RPM(30)
+from huixiangdou.primitive import RPM, TPM
+from huixiangdou.primitive.limitter import FileState, TokenBucket, build_state
+
 
-    for i in range(40):
-        rpm.wait()
-        print(i)
+def test_rpm():
+    # 600 rpm is 10 requests per second, burst of 60
+    rpm = RPM(600)
+    start = time.time()
+    for _ in range(65):
+        rpm.wait_sync()
+    assert 0.4 < time.time() - start < 1.0
 
-    time.sleep(5)
+    async def run():
+        begin = time.time()
+        await asyncio.gather(*[rpm.wait() for _ in range(3)])
+        return time.time() - begin
+    # async callers are throttled too
+    assert asyncio.run(run()) > 0.2
 
-    for i in range(40):
-        rpm.wait()
-        print(i)
 
 def test_tpm():
-    tpm = TPM(2000)
+    tpm = TPM(6000)
+    # per second for a fast test
+    tpm.bucket = TokenBucket(rate=1000, period=1, burst=100)
+    start = time.time()
+    # larger than burst runs at once on an idle bucket, later callers pay
+    tpm.wait_sync(token_count=300)
+    assert time.time() - start < 0.1
+    tpm.charge(token_count=100)
+    tpm.wait_sync(token_count=100)
+    assert 0.3 < time.time() - start < 0.6
+
+
+def test_fifo():
+    bucket = TokenBucket(rate=20, period=1, burst=1)
+    order = []
+
+    async def waiter(i):
+        await bucket.wait(1)
+        order.append(i)
+
+    async def run():
+        await asyncio.gather(*[waiter(i) for i in range(8)])
+    start = time.time()
+    asyncio.run(run())
+    assert order == list(range(8))
+    assert 0.3 < time.time() - start < 0.6
+
+
+def consume(path: str, count: int):
+    bucket = TokenBucket(rate=40, period=1, burst=1, state=FileState(path))
+    for _ in range(count):
+        bucket.wait_sync(1)
+
+
+def test_file_state():
+    path = '/tmp/huixiangdou_unittest_limitter/llm_kimi_rpm'
+    if os.path.exists(path):
+        os.remove(path)
+    assert isinstance(build_state('file:/tmp/huixiangdou_unittest_limitter', 'llm:kimi:rpm'), FileState)
+
+    # two processes share one budget
+    start = time.time()
+    workers = [multiprocessing.Process(target=consume, args=(path, 10)) for _ in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert 0.4 < time.time() - start < 1.5
 
-    for i in range(20):
-        tpm.wait(silent=False, token_count=150)
-        print(i)
 
 if __name__ == '__main__':
-    test_tpm()
\ No newline at end of file
+    test_rpm()
+    test_tpm()
+    test_fifo()
+    test_file_state()
@@ -0,0 +1,102 @@
+import hashlib
+import os
+import shutil
+
+import numpy as np
+import onnx
+from onnx import TensorProto, helper, numpy_helper
+from transformers import BertTokenizerFast
+
+from huixiangdou.primitive import Chunk, Embedder, LLMReranker
+
+VOCAB = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + ['mmpose', 'mmdet', 'install', 'how', 'to', 'ncnn', 'vulkan', 'a', 'b']
+
+
+def build_graph(path: str, task: str, hidden: int = 8):
+    """Tiny encoder graph, embedding lookup and a MatMul to quantize."""
+    rng = np.random.RandomState(0)
+    table = numpy_helper.from_array(rng.rand(len(VOCAB), hidden).astype(np.float32), 'table')
+    weight = numpy_helper.from_array(rng.rand(hidden, hidden).astype(np.float32), 'weight')
+    nodes = [
+        helper.make_node('Gather', ['table', 'input_ids'], ['embed']),
+        helper.make_node('Cast', ['attention_mask'], ['mask'], to=TensorProto.FLOAT),
+        helper.make_node('Unsqueeze', ['mask', 'axes'], ['mask3']),
+        helper.make_node('Mul', ['embed', 'mask3'], ['masked']),
+        helper.make_node('MatMul', ['masked', 'weight'], ['last_hidden_state'])
+    ]
+    initializers = [table, weight, numpy_helper.from_array(np.array([2], dtype=np.int64), 'axes')]
+    output = helper.make_tensor_value_info('last_hidden_state', TensorProto.FLOAT, ['batch', 'sequence', hidden])
+    if task == 'rerank':
+        score = numpy_helper.from_array(rng.rand(hidden, 1).astype(np.float32) - 0.5, 'score')
+        initializers.append(score)
+        nodes += [
+            helper.make_node('ReduceMean', ['last_hidden_state'], ['pooled'], axes=[1], keepdims=0),
+            helper.make_node('MatMul', ['pooled', 'score'], ['logits'])
+        ]
+        output = helper.make_tensor_value_info('logits', TensorProto.FLOAT, ['batch', 1])
+    graph = helper.make_graph(nodes, task, [
+        helper.make_tensor_value_info('input_ids', TensorProto.INT64, ['batch', 'sequence']),
+        helper.make_tensor_value_info('attention_mask', TensorProto.INT64, ['batch', 'sequence'])
+    ], [output], initializers)
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid('', 13)])
+    model.ir_version = 8
+    onnx.save(model, path)
+
+
+def prepare(cache_dir: str, model_path: str, task: str):
+    """Place a pre-exported graph in cache, so no torch is needed."""
+    onnx_dir = os.path.join(cache_dir, hashlib.md5(model_path.encode('utf8')).hexdigest()[0:16], task)
+    os.makedirs(onnx_dir)
+    vocab_path = os.path.join(onnx_dir, 'vocab.txt')
+    with open(vocab_path, 'w') as f:
+        f.write('\n'.join(VOCAB))
+    BertTokenizerFast(vocab_file=vocab_path).save_pretrained(onnx_dir)
+    build_graph(os.path.join(onnx_dir, 'model.onnx'), task)
+    with open(os.path.join(onnx_dir, 'meta.json'), 'w') as f:
+        f.write('{"task": "%s", "pooling": "cls", "max_length": 16}' % task)
+
+
+def test_onnx_embedder_reranker():
+    cache_dir = '/tmp/onnx_unittest'
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    config = {
+        'embedding_model_path': 'unittest/bce-embedding',
+        'reranker_model_path': 'unittest/bce-reranker',
+        'model_backend': 'onnx',
+        'onnx_dir': cache_dir,
+        'onnx_quantize': False,
+        'onnx_batch_size': 2
+    }
+    prepare(cache_dir, config['embedding_model_path'], 'embedding')
+    prepare(cache_dir, config['reranker_model_path'], 'rerank')
+
+    embedder = Embedder(model_config=config)
+    assert embedder._type == 'onnx'
+    texts = ['how to install mmpose', 'a', 'ncnn vulkan', 'mmdet', 'b b b b b']
+    features = embedder.embed_query_batch_text(chunks=[Chunk(t) for t in texts])
+    assert features.shape == (5, 8)
+    assert np.allclose(np.linalg.norm(features, axis=1), 1, atol=1e-5)
+    # length bucketing keeps input order
+    for text, feature in zip(texts, features):
+        assert np.allclose(embedder.embed_query(text=text)[0], feature, atol=1e-5)
+    assert embedder.token_length('how to install mmpose') == 6
+
+    # int8 graph is cached beside fp32 graph, features drift little
+    config['onnx_quantize'] = True
+    quantized = Embedder(model_config=config)
+    assert os.path.exists(os.path.join(quantized.client.dir, 'model.int8.onnx'))
+    assert quantized.model_id != embedder.model_id
+    drift = np.sum(quantized.embed_query_batch_text(chunks=[Chunk(t) for t in texts]) * features, axis=1)
+    assert drift.min() > 0.95
+
+    reranker = LLMReranker(model_config=config, topn=3)
+    chunks = [Chunk(t) for t in texts]
+    ranked = reranker.rerank(query='how to install mmpose', chunks=chunks)
+    assert len(ranked) == 3
+    scores = reranker.onnx_client.score([('how', t) for t in texts])
+    assert scores.shape == (5, ) and np.all((scores > 0) & (scores < 1))
+
+
+if __name__ == '__main__':
+    test_onnx_embedder_reranker()
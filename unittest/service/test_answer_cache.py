@@ -0,0 +1,121 @@
+import hashlib
+import os
+import time
+
+import numpy as np
+
+from huixiangdou.primitive import Query
+from huixiangdou.services.answer_cache import AnswerCache, RedisAnswerStore, SQLiteAnswerStore
+
+
+class HashEmbedder:
+    """Same text same vector, `ALIAS` maps paraphrases to one text."""
+    ALIAS = {'what is huixiangdou?': 'What is HuixiangDou?'}
+
+    def embed_query(self, text: str = None, path: str = None):
+        text = self.ALIAS.get(text, text)
+        seed = int(hashlib.md5(text.encode('utf8')).hexdigest()[0:8], 16)
+        return np.random.RandomState(seed).rand(1, 16).astype(np.float32) - 0.5
+
+
+class FakeRedis:
+    """Hash and sorted set subset of redis-py."""
+
+    def __init__(self):
+        self.hashes = dict()
+        self.zsets = dict()
+
+    def hset(self, name, key, value):
+        self.hashes.setdefault(name, dict())[key] = value
+
+    def hmget(self, name, keys):
+        return [self.hashes.get(name, {}).get(key) for key in keys]
+
+    def hdel(self, name, *keys):
+        for key in keys:
+            self.hashes.get(name, {}).pop(key, None)
+
+    def zadd(self, name, mapping):
+        self.zsets.setdefault(name, dict()).update(mapping)
+
+    def zrem(self, name, *keys):
+        for key in keys:
+            self.zsets.get(name, {}).pop(key, None)
+
+    def _sorted(self, name):
+        return sorted(self.zsets.get(name, {}).items(), key=lambda x: x[1])
+
+    def zrangebyscore(self, name, low, high):
+        def above(score, bound):
+            return score > float(bound[1:]) if bound.startswith('(') else score >= float(bound)
+
+        def below(score, bound):
+            return score < float(bound[1:]) if bound.startswith('(') else score <= float(bound)
+        return [k for k, s in self._sorted(name) if above(s, low) and below(s, high)]
+
+    def zrange(self, name, start, end):
+        keys = [k for k, _ in self._sorted(name)]
+        end = len(keys) + end if end < 0 else end
+        return keys[start:end + 1]
+
+
+def test_answer_cache():
+    embedder = HashEmbedder()
+    cache = AnswerCache(embedder=embedder, namespace='a', version='v1', threshold=0.95, capacity=2)
+    query = Query(text='What is HuixiangDou?')
+    assert cache.lookup(query) is None
+
+    cache.put(query, response='A group chat assistant.', references=['README.md'])
+    hit = cache.lookup(Query(text='what is huixiangdou?'))
+    assert hit['response'] == 'A group chat assistant.' and hit['references'] == ['README.md']
+    assert hit['score'] > 0.99
+
+    # unrelated question, follow-up and image query never hit
+    assert cache.lookup(Query(text='How to deploy?')) is None
+    assert cache.lookup(query, history=[('hi', 'hello')]) is None
+    assert cache.lookup(Query(text='What is HuixiangDou?', image='a.png')) is None
+
+    # LRU keeps recently used
+    cache.put(Query(text='q1'), response='r1', references=[])
+    cache.lookup(query)
+    cache.put(Query(text='q2'), response='r2', references=[])
+    assert cache.lookup(Query(text='q1')) is None
+    assert cache.lookup(query) is not None
+
+    stats = cache.stats()
+    assert stats['hit'] == 3 and stats['miss'] == 3 and stats['put'] == 3
+    assert stats['hit_rate'] == 0.5 and stats['size'] == 2
+
+    # expired
+    cache.ttl = 0.1
+    time.sleep(0.2)
+    assert cache.lookup(query) is None
+
+
+def test_answer_cache_store():
+    path = '/tmp/huixiangdou_unittest_answer_cache.db'
+    if os.path.exists(path):
+        os.remove(path)
+    query = Query(text='What is HuixiangDou?')
+
+    for store in [SQLiteAnswerStore(path), RedisAnswerStore(client=FakeRedis())]:
+        writer = AnswerCache(embedder=HashEmbedder(), store=store, namespace='a', version='v1', capacity=2)
+        writer.put(query, response='assistant', references=['README.md'])
+
+        # another worker of the same tenant and version
+        reader = AnswerCache(embedder=HashEmbedder(), store=store, namespace='a', version='v1', sync_interval=0)
+        assert reader.lookup(query)['response'] == 'assistant'
+        # other tenant and other feature store version
+        assert AnswerCache(embedder=HashEmbedder(), store=store, namespace='b', version='v1').lookup(query) is None
+        assert AnswerCache(embedder=HashEmbedder(), store=store, namespace='a', version='v2').lookup(query) is None
+
+        # entries written later are synced, store keeps `capacity`
+        for i in range(3):
+            writer.put(Query(text='q{}'.format(i)), response='r{}'.format(i), references=[])
+        assert reader.lookup(Query(text='q2'))['response'] == 'r2'
+        assert len(store.since('a', 0)) == 2
+
+
+if __name__ == '__main__':
+    test_answer_cache()
+    test_answer_cache_store()
@@ -0,0 +1,98 @@
+import hashlib
+import os
+import socketserver
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from huixiangdou.primitive import Chunk, Embedder, LLMReranker
+from huixiangdou.primitive.query import DistanceStrategy
+from huixiangdou.services.inference_server import (InferenceHandler,
+                                                   InferenceServer)
+
+
+class FakeEmbedder:
+    _type = 'bce'
+    support_image = False
+    distance_strategy = DistanceStrategy.EUCLIDEAN_DISTANCE
+
+    def embed_query(self, text: str = None, path: str = None):
+        seed = int(hashlib.md5(text.encode('utf8')).hexdigest()[0:8], 16)
+        feature = np.random.RandomState(seed).rand(1, 16).astype(np.float32)
+        return feature / np.linalg.norm(feature)
+
+    def embed_query_batch_text(self, chunks):
+        return np.concatenate([self.embed_query(text=c.content_or_path) for c in chunks])
+
+    def token_length(self, text: str):
+        return len(text)
+
+
+class FakeReranker:
+    _type = 'bce'
+
+    def _sort(self, texts, query):
+        # longest common prefix first
+        scores = [len(os.path.commonprefix([t, query])) for t in texts]
+        return np.argsort(scores)[::-1]
+
+
+class FakeInferenceServer(InferenceServer):
+    """Serve fake models, no model weights in unittest."""
+
+    def __init__(self, socket_path: str):
+        self.embedder = FakeEmbedder()
+        self.reranker = FakeReranker()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        socketserver.UnixStreamServer.__init__(self, socket_path, InferenceHandler)
+
+
+def test_inference_server():
+    socket_path = '/tmp/huixiangdou_unittest_inference.sock'
+    server = FakeInferenceServer(socket_path)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    config = {
+        'embedding_model_path': 'maidalun1020/bce-embedding-base_v1',
+        'reranker_model_path': 'maidalun1020/bce-reranker-base_v1',
+        'inference_socket': socket_path,
+        'query_cache_size': 0
+    }
+    try:
+        # thin clients, no model loaded in this process
+        embedder = Embedder(model_config=config)
+        assert embedder.inference is not None
+        assert embedder.distance_strategy == DistanceStrategy.EUCLIDEAN_DISTANCE
+        feature = embedder.embed_query(text='hello')
+        assert np.allclose(feature, FakeEmbedder().embed_query(text='hello'))
+        features = embedder.embed_query_batch_text(chunks=[Chunk('a'), Chunk('hello')])
+        assert features.shape == (2, 16) and np.allclose(features[1:2], feature)
+        assert embedder.token_length('abc') == 3
+
+        # each thread owns a connection
+        texts = ['text {}'.format(i) for i in range(32)]
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(lambda t: embedder.embed_query(text=t), texts))
+        for text, result in zip(texts, results):
+            assert np.allclose(result, FakeEmbedder().embed_query(text=text))
+
+        reranker = LLMReranker(model_config=config, topn=2)
+        chunks = [Chunk('mmdet'), Chunk('mmpose install'), Chunk('mmpose')]
+        ranked = reranker.rerank(query='mmpose install', chunks=chunks)
+        assert [c.content_or_path for c in ranked] == ['mmpose install', 'mmpose']
+
+        try:
+            embedder.inference.call({'method': 'unknown'})
+            assert False
+        except ValueError:
+            pass
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    test_inference_server()
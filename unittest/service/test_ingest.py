@@ -0,0 +1,62 @@
+import hashlib
+import shutil
+
+import numpy as np
+
+from huixiangdou.primitive import Faiss, FileOperation, IndexConfig
+from huixiangdou.primitive.query import DistanceStrategy
+from huixiangdou.services.store import FeatureStore
+
+
+class HashEmbedder:
+    """Deterministic fake text2vec, same text same feature."""
+    support_image = False
+    model_id = 'unittest-hash'
+    distance_strategy = DistanceStrategy.EUCLIDEAN_DISTANCE
+
+    def embed_query(self, text: str = None, path: str = None):
+        seed = int(hashlib.md5(text.encode('utf8')).hexdigest()[0:8], 16)
+        emb = np.random.RandomState(seed).rand(1, 32).astype(np.float32)
+        return emb / np.linalg.norm(emb)
+
+    def embed_query_batch_text(self, chunks=[]):
+        return np.concatenate([self.embed_query(text=c.content_or_path) for c in chunks])
+
+    def token_length(self, text: str):
+        return len(text)
+
+
+def test_ingest_pipeline():
+    work_dir = '/tmp/huixiangdou_unittest_ingest'
+    shutil.rmtree(work_dir, ignore_errors=True)
+    store = FeatureStore(embedder=HashEmbedder(), config_path='config.ini')
+    store.embedding_cache = None
+    qa_pair_file = 'resource/data/qa_pair.csv'
+
+    # serial reference
+    files = FileOperation().scan_dir('resource/data')
+    store.preprocess(files=files, work_dir=work_dir + '/serial')
+    expected = store.split_documents(files=files, qa_pair_file=qa_pair_file)
+
+    # small batches and queues, trained index waits for all vectors
+    store.ingest.batch_size = 2
+    store.ingest.queue_size = 1
+    store.ingest.parse_workers = 2
+    store.index_config = IndexConfig(index_type='ivf_flat', train_size=1 << 20)
+    dense = Faiss(index=None, chunks=[], strategy=HashEmbedder.distance_strategy, index_config=store.index_config)
+    files = FileOperation().scan_dir('resource/data')
+    ids = store.ingest.run(files=files, work_dir=work_dir + '/stream', dense=dense, qa_pair_file=qa_pair_file)
+
+    assert ids == list(range(len(expected)))
+    assert [c.content_or_path for c in dense.chunks] == [c.content_or_path for c in expected]
+    assert dense.index.ntotal == len(expected)
+    for file in files:
+        assert file.state
+
+    query = dense.chunks[-1].content_or_path
+    scores, ids = dense.similarity_search_batch(HashEmbedder().embed_query(text=query))
+    assert ids[0][0] == len(expected) - 1
+
+
+if __name__ == '__main__':
+    test_ingest_pipeline()
@@ -0,0 +1,137 @@
+import asyncio
+import json
+import os
+import shutil
+
+import networkx as nx
+import pytoml
+
+from huixiangdou.services.kg import KnowledgeGraph, KnowledgeGraphIndex
+
+
+class FakeLLM:
+    """NER by keyword list, fail the first call of each chunk if `flaky`,
+    reply unparsable text the first time a chunk contains `garbled`."""
+
+    def __init__(self, flaky: bool = False, garbled: str = None):
+        self.flaky = flaky
+        self.garbled = garbled
+        self.calls = 0
+        self.cached = 0
+        self.failed = set()
+        self.sum_input_token_size = 0
+        self.sum_output_token_size = 0
+
+    async def chat(self, prompt: str, **kwargs):
+        self.calls += 1
+        if kwargs.get('use_cache', True):
+            self.cached += 1
+        await asyncio.sleep(0.001)
+        if self.flaky and 'mmdet' in prompt and prompt not in self.failed:
+            self.failed.add(prompt)
+            raise ConnectionError('fake connection error')
+        if self.garbled is not None and self.garbled in prompt and prompt not in self.failed:
+            self.failed.add(prompt)
+            return 'sorry, I can not answer'
+        entities = [e for e in ['mmpose', 'mmdet'] if e in prompt]
+        return json.dumps([{'entity': e, 'type': 'tool'} for e in entities])
+
+
+def test_kg_serving_format():
+    G = nx.Graph()
+    G.add_node('md0', type='markdown', data='/repo/install.md')
+    G.add_node('md1', type='markdown', data='/repo/faq.md')
+    G.add_node('chunk0', type='chunk', data='pip install mmpose')
+    G.add_node('chunk1', type='chunk', data='mmpose 安装失败')
+    G.add_node('chunk2', type='chunk', data='mmdet faq')
+    G.add_edge('md0', 'chunk0', desc='page0')
+    G.add_edge('md1', 'chunk1', desc='page0')
+    G.add_edge('md1', 'chunk2', desc='page1')
+    for entity, chunk in [('MMPose', 'chunk0'), ('MMPose', 'chunk1'), ('mmdet', 'chunk2'), ('安装', 'chunk1')]:
+        G.add_node(entity, type='keyword', data='')
+        G.add_edge(entity, chunk, desc='tool')
+    G.add_node('image0', type='image', data='/repo/a.png')
+    G.add_edge('image0', 'chunk0', desc='file')
+
+    kg_dir = '/tmp/huixiangdou_unittest_kg'
+    shutil.rmtree(kg_dir, ignore_errors=True)
+    assert KnowledgeGraphIndex.load(kg_dir) is None
+    KnowledgeGraphIndex.build(G, kg_dir + '/serving')
+
+    index = KnowledgeGraphIndex.load(kg_dir)
+    assert index.file_count('how to install mmpose') == 2
+    assert index.file_count('nothing related') == 0
+
+    candidates = index.retrieve('mmpose 安装')
+    assert candidates[0] == {'path': '/repo/install.md', 'chunks': ['pip install mmpose']}
+    assert candidates[1]['path'] == '/repo/faq.md'
+    assert candidates[1]['chunks'] == ['mmpose 安装失败', 'mmpose 安装失败']
+    assert index.retrieve('nothing related') == []
+
+
+def test_kg_build_resume():
+    root = '/tmp/huixiangdou_unittest_kg_build'
+    shutil.rmtree(root, ignore_errors=True)
+    os.makedirs(os.path.join(root, 'repo'))
+    for name, text in [('a.md', 'install mmpose'), ('b.md', 'mmdet faq'), ('c.md', 'nothing')]:
+        with open(os.path.join(root, 'repo', name), 'w') as f:
+            f.write(text)
+
+    with open('config.ini', encoding='utf8') as f:
+        config = pytoml.load(f)
+    config['feature_store']['work_dir'] = os.path.join(root, 'workdir')
+    config_path = os.path.join(root, 'config.ini')
+    with open(config_path, 'w', encoding='utf8') as f:
+        pytoml.dump(config, f)
+
+    kg = KnowledgeGraph(config_path=config_path, concurrency=2)
+    kg.llm = FakeLLM(flaky=True, garbled='install')
+    kg.build(repodir=os.path.join(root, 'repo'))
+    assert kg.llm.calls == 3
+
+    # only failed and unparsable chunks run again
+    kg = KnowledgeGraph(config_path=config_path, concurrency=2)
+    kg.llm = FakeLLM()
+    kg.build(repodir=os.path.join(root, 'repo'))
+    assert kg.llm.calls == 2
+
+    # markdown nodes are not written twice on resume
+    with open(kg.nodes_path) as f:
+        types = [json.loads(line)['_type'] for line in f]
+    assert types.count('markdown') == 3
+
+    kg.dump_networkx()
+    index = KnowledgeGraphIndex.load(kg.kg_work_dir)
+    assert index.file_count('mmdet and mmpose') == 2
+
+
+def test_kg_build_retry():
+    root = '/tmp/huixiangdou_unittest_kg_retry'
+    shutil.rmtree(root, ignore_errors=True)
+    os.makedirs(os.path.join(root, 'repo'))
+    with open(os.path.join(root, 'repo', 'a.md'), 'w') as f:
+        f.write('install mmpose')
+
+    with open('config.ini', encoding='utf8') as f:
+        config = pytoml.load(f)
+    config['feature_store']['work_dir'] = os.path.join(root, 'workdir')
+    config_path = os.path.join(root, 'config.ini')
+    with open(config_path, 'w', encoding='utf8') as f:
+        pytoml.dump(config, f)
+
+    # unparsable reply is retried without the response cache, parsed reply stops the loop
+    kg = KnowledgeGraph(config_path=config_path, concurrency=1, retry=3)
+    kg.llm = FakeLLM(garbled='install')
+    kg.build(repodir=os.path.join(root, 'repo'))
+    assert kg.llm.calls == 2
+    assert kg.llm.cached == 0
+
+    with open(kg.nodes_path) as f:
+        names = [json.loads(line)['uuid'] for line in f]
+    assert names.count('mmpose') == 1
+
+
+if __name__ == '__main__':
+    test_kg_serving_format()
+    test_kg_build_resume()
+    test_kg_build_retry()
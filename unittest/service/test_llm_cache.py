@@ -0,0 +1,63 @@
+import asyncio
+import os
+import time
+
+from huixiangdou.services.llm_cache import ChatCache
+
+
+def test_chat_cache():
+    path = '/tmp/huixiangdou_unittest_llm_cache.db'
+    if os.path.exists(path):
+        os.remove(path)
+    cache = ChatCache(path=path, capacity=2, ttl=60)
+    calls = []
+
+    def api(content: str, delay: float = 0.1, error: bool = False):
+        async def call():
+            calls.append(content)
+            await asyncio.sleep(delay)
+            if error:
+                raise ConnectionError('remote error')
+            return content
+        return call
+
+    key = ChatCache.key(backend='kimi', model='m', messages=[{'role': 'user', 'content': 'hi'}], temperature=0.7)
+    assert key == ChatCache.key(temperature=0.7, model='m', backend='kimi', messages=[{'role': 'user', 'content': 'hi'}])
+    assert key != ChatCache.key(backend='kimi', model='m', messages=[{'role': 'user', 'content': 'hi'}], temperature=0.1)
+
+    async def run():
+        # identical requests in flight share one call
+        results = await asyncio.gather(*[cache.get_or_call(key, api('hello')) for _ in range(4)])
+        assert results == ['hello'] * 4 and calls == ['hello']
+        assert await cache.get_or_call(key, api('other')) == 'hello'
+
+        # failure is not cached, waiting callers retry by themselves
+        failed = ChatCache.key(prompt='fail')
+        results = await asyncio.gather(cache.get_or_call(failed, api('x', error=True)),
+                                       cache.get_or_call(failed, api('y')),
+                                       return_exceptions=True)
+        assert isinstance(results[0], ConnectionError) and results[1] == 'y'
+        assert await cache.get_or_call(failed, api('z')) == 'y'
+
+        # empty response is not cached
+        empty = ChatCache.key(prompt='empty')
+        assert await cache.get_or_call(empty, api('')) == ''
+        assert await cache.get_or_call(empty, api('full')) == 'full'
+
+    asyncio.run(run())
+    stats = cache.stats()
+    assert stats['hit'] == 2 and stats['dedup'] == 4 and stats['miss'] == 4 and stats['put'] == 3
+    assert len(cache.lru) == 2
+
+    # evicted from memory, still in sqlite tier of another process
+    other = ChatCache(path=path, capacity=2, ttl=60)
+    assert other.get(key) == 'hello'
+    assert ChatCache(path=None).get(key) is None
+
+    other.ttl = 0.1
+    time.sleep(0.2)
+    assert other.get(key) is None
+
+
+if __name__ == '__main__':
+    test_chat_cache()
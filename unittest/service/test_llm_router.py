@@ -0,0 +1,147 @@
+import asyncio
+import time
+
+from openai import RateLimitError
+
+from huixiangdou.services import llm as llm_module
+from huixiangdou.services.llm import LLM, Backend
+from huixiangdou.services.llm_router import LLMRouter
+
+
+def build_router(**kwargs):
+    backends = [Backend(name, {'remote_type': 'kimi'}) for name in ['fast', 'slow']]
+    return LLMRouter(backends, **kwargs)
+
+
+def stand_in(delays: dict, errors: dict = {}):
+    """Fake API call, sleep or raise per endpoint."""
+    called = []
+
+    async def call(backend):
+        called.append(backend.name)
+        if backend.name in errors:
+            raise errors[backend.name]
+        await asyncio.sleep(delays[backend.name])
+        return backend.name
+    return call, called
+
+
+def test_router_rank_and_failover():
+    router = build_router()
+    call, called = stand_in({'fast': 0.01, 'slow': 0.1})
+
+    async def run():
+        # both unmeasured, then the faster one is preferred
+        for _ in range(4):
+            await router.run(call)
+        router.states['fast'].latency = 0.01
+        router.states['slow'].latency = 0.1
+        return await router.run(call)
+
+    assert asyncio.run(run()) == 'fast'
+    assert [b.name for b in router.rank()] == ['fast', 'slow']
+
+    # connection errors fail over
+    call, called = stand_in({'fast': 0.01, 'slow': 0.01}, {'fast': ConnectionError('refused')})
+    assert asyncio.run(router.run(call)) == 'slow'
+    assert called == ['fast', 'slow']
+    assert router.stats()['fast']['errors'] == 1
+
+    # other errors are raised
+    call, called = stand_in({'fast': 0.01, 'slow': 0.01}, {'fast': ValueError('bad request')})
+    try:
+        asyncio.run(router.run(call))
+        assert False
+    except ValueError:
+        pass
+    assert called == ['fast']
+
+
+def test_router_circuit():
+    router = build_router(failure_threshold=2, cooldown=0.2)
+    router.states['fast'].latency = 0.01
+    router.states['slow'].latency = 0.1
+    call, called = stand_in({'fast': 0.01, 'slow': 0.01}, {'fast': TimeoutError()})
+    for _ in range(2):
+        assert asyncio.run(router.run(call)) == 'slow'
+    assert router.stats()['fast']['open']
+
+    # open circuit is tried last
+    called.clear()
+    asyncio.run(router.run(call))
+    assert called == ['slow']
+
+    # trial call after cooldown closes it
+    time.sleep(0.25)
+    call, called = stand_in({'fast': 0.01, 'slow': 0.01})
+    assert asyncio.run(router.run(call)) == 'fast'
+    assert not router.stats()['fast']['open']
+
+
+def test_router_hedge():
+    router = build_router(hedge_delay=0.05)
+    router.states['fast'].latency = 0.01
+    router.states['slow'].latency = 0.1
+    # the preferred endpoint stalls, the hedged one answers first
+    call, called = stand_in({'fast': 1.0, 'slow': 0.01})
+    start = time.time()
+    assert asyncio.run(router.run(call, hedge=True)) == 'slow'
+    assert time.time() - start < 0.5
+    assert called == ['fast', 'slow']
+    assert router.stats()['slow']['hedged'] == 1
+    assert router.stats()['fast']['inflight'] == 0
+
+    # candidates limited to the endpoints of a task
+    call, called = stand_in({'fast': 0.01, 'slow': 0.01})
+    assert asyncio.run(router.run(call, hedge=True, names=['slow'])) == 'slow'
+    assert called == ['slow']
+
+    # no hedge without the flag
+    call, called = stand_in({'fast': 0.1, 'slow': 0.01})
+    assert asyncio.run(router.run(call)) == 'fast'
+    assert called == ['fast']
+
+
+def test_llm_chat_fails_fast(monkeypatch):
+    with open('config.ini', encoding='utf8') as f:
+        text = f.read()
+    # two endpoints from the commented example
+    start = text.index('# [[llm.server.endpoints]]')
+    end = text.index('[llm.cache]')
+    text = text[:start] + text[start:end].replace('# ', '').replace('#\n', '\n') + text[end:]
+    config_path = '/tmp/huixiangdou_unittest_router.ini'
+    with open(config_path, 'w', encoding='utf8') as f:
+        f.write(text)
+
+    # tokenizer data needs network, count characters instead
+    monkeypatch.setattr(llm_module, 'encode_string', lambda content: list(content))
+    llm = LLM(config_path)
+    called = []
+
+    async def rate_limited(instance, kwargs, input_token_size, timeout, task='chat'):
+        called.append(instance.name)
+        # every endpoint replies 429
+        error = RateLimitError.__new__(RateLimitError)
+        Exception.__init__(error, 'rate limited')
+        raise error
+    llm.call_chat = rate_limited
+
+    for backend in ['default', 'local']:
+        called.clear()
+        begin = time.time()
+        try:
+            asyncio.run(llm.chat('hello', backend=backend, use_cache=False))
+            assert False
+        except RateLimitError:
+            pass
+        # failover only, no sleep and retry
+        assert time.time() - begin < 1
+        assert sorted(called) == (['local', 'siliconcloud'] if backend == 'default' else ['local'])
+    # a single endpoint is accounted by the router too
+    assert llm.router.stats()['local']['errors'] == 2
+
+
+if __name__ == '__main__':
+    test_router_rank_and_failover()
+    test_router_circuit()
+    test_router_hedge()
@@ -0,0 +1,65 @@
+import asyncio
+import time
+
+from huixiangdou.services.llm_scheduler import AdmissionScheduler
+
+
+def test_admission_priority():
+    scheduler = AdmissionScheduler(max_concurrency=2, limits={'batch': 1})
+    order = []
+
+    async def call(name: str, priority: str, cost: float = 0.05):
+        async with scheduler.slot(priority):
+            order.append(name)
+            await asyncio.sleep(cost)
+
+    async def run():
+        # batch work fills its own limit only
+        tasks = [asyncio.create_task(call('batch{}'.format(i), 'batch')) for i in range(3)]
+        await asyncio.sleep(0.01)
+        assert scheduler.stats()['batch']['running'] == 1
+        # user queries arrive later and still go first
+        tasks += [asyncio.create_task(call('interactive', 'interactive'))]
+        tasks += [asyncio.create_task(call('stream{}'.format(i), 'stream')) for i in range(2)]
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert order[0:2] == ['batch0', 'interactive']
+    assert order.index('stream0') < order.index('batch1')
+    assert order.index('stream1') < order.index('batch2')
+
+    stats = scheduler.stats()
+    assert stats['batch']['admitted'] == 3 and stats['batch']['max_waiting'] == 2
+    assert stats['stream']['running'] == 0 and stats['stream']['waiting'] == 0
+    assert stats['batch']['wait_max_ms'] > 50
+
+
+def test_admission_cancel():
+    scheduler = AdmissionScheduler(max_concurrency=1)
+
+    async def run():
+        await scheduler.acquire('batch')
+        waiter = asyncio.create_task(scheduler.acquire('interactive'))
+        await asyncio.sleep(0.01)
+        assert scheduler.stats()['interactive']['waiting'] == 1
+        waiter.cancel()
+        await asyncio.sleep(0.01)
+        assert scheduler.stats()['interactive']['waiting'] == 0
+
+        # waiter is woken on release, not polled
+        waiter = asyncio.create_task(scheduler.acquire('stream'))
+        await asyncio.sleep(0.01)
+        start = time.time()
+        scheduler.release('batch')
+        await waiter
+        assert time.time() - start < 0.01
+        scheduler.release('stream')
+        assert scheduler.total_running() == 0
+
+    asyncio.run(run())
+    assert scheduler.stats()['interactive']['cancelled'] == 1
+
+
+if __name__ == '__main__':
+    test_admission_priority()
+    test_admission_cancel()
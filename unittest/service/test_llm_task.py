@@ -0,0 +1,47 @@
+from huixiangdou.services.llm_task import TaskTable
+
+
+def test_task_route():
+    config = {
+        'score': {'backend': 'small', 'model': 'internlm2_5-1_8b-chat', 'max_tokens': 32},
+        'intention': {'backend': ['small', 'large'], 'max_tokens': 256}
+    }
+    tasks = TaskTable.from_config(config, backends=['small', 'large'])
+    score = tasks.get('score')
+    assert score.backends == ['small'] and score.model == 'internlm2_5-1_8b-chat'
+    assert score.cap(1024) == 32 and score.cap(8) == 8 and score.cap(None) == 32
+    assert tasks.get('intention').backends == ['small', 'large']
+
+    # untagged and unrouted tasks keep the call site value
+    generate = tasks.get('generate')
+    assert generate.backends == [] and generate.model == '' and generate.cap(1024) == 1024
+
+    try:
+        TaskTable.from_config({'score': {'backend': 'tiny'}}, backends=['small'])
+        assert False
+    except ValueError:
+        pass
+
+
+def test_task_report():
+    tasks = TaskTable.from_config({'score': {'max_tokens': 32}}, backends=['kimi'])
+    for i in range(10):
+        tasks.record_tokens('score', input_tokens=100, output_tokens=1)
+        tasks.record_call('score', latency=0.01 * (i + 1))
+    # a cache hit counts latency without tokens
+    tasks.record_call('score', latency=0.001)
+    tasks.record_call('generate', latency=1.0, error=TimeoutError())
+
+    report = tasks.report()
+    score = report['score']
+    assert score['calls'] == 11 and score['api_calls'] == 10
+    assert score['input_tokens'] == 1000 and score['output_tokens'] == 10
+    assert score['max_tokens'] == 32
+    assert 45 < score['latency_avg_ms'] < 55
+    assert score['latency_p50_ms'] == 50.0 and score['latency_p95_ms'] == 100.0
+    assert report['generate']['errors'] == 1 and report['generate']['latency_avg_ms'] == 0
+
+
+if __name__ == '__main__':
+    test_task_route()
+    test_task_report()
@@ -0,0 +1,88 @@
+import hashlib
+import shutil
+import threading
+import time
+
+import numpy as np
+
+from huixiangdou.primitive import Chunk, IndexConfig, PartitionedFaiss, Query, ShardedFaiss
+from huixiangdou.primitive.query import DistanceStrategy
+from huixiangdou.services.partition_server import PartitionServer
+
+
+class HashEmbedder:
+    support_image = False
+    distance_strategy = DistanceStrategy.EUCLIDEAN_DISTANCE
+
+    def embed_query(self, text: str = None, path: str = None):
+        seed = int(hashlib.md5(text.encode('utf8')).hexdigest()[0:8], 16)
+        emb = np.random.RandomState(seed).rand(1, 32).astype(np.float32)
+        return emb / np.linalg.norm(emb)
+
+    def embed_query_batch_text(self, chunks=[]):
+        return np.concatenate([self.embed_query(text=c.content_or_path) for c in chunks])
+
+
+class SlowPartitionServer(PartitionServer):
+    delay = 0.0
+
+    def dispatch(self, header: dict, payload: bytes = b''):
+        if header.get('method') == 'search':
+            time.sleep(self.delay)
+        return super().dispatch(header, payload)
+
+
+def test_partitioned_search():
+    embedder = HashEmbedder()
+    dense_dir = '/tmp/huixiangdou_unittest_partition'
+    shutil.rmtree(dense_dir, ignore_errors=True)
+    chunks = [Chunk('chunk {}'.format(i), {'source': 'a.md'}) for i in range(50)]
+    local = ShardedFaiss.create(dense_dir, strategy=embedder.distance_strategy, shard_size=8,
+                                index_config=IndexConfig(index_type='flat'))
+    local.add(chunks=chunks, embedder=embedder)
+    local.remove([3, 20])
+    local.save(dense_dir)
+
+    addresses = ['unix:/tmp/huixiangdou_unittest_partition.sock', '127.0.0.1:0']
+    servers = []
+    for i, address in enumerate(addresses):
+        server = SlowPartitionServer(address=address, dense_dir=dense_dir, partition=i, partitions=2)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    # port chosen by system
+    addresses[1] = '127.0.0.1:{}'.format(servers[1].server_address[1])
+
+    try:
+        dense = PartitionedFaiss(addresses, timeout=0.5)
+        assert len(dense.chunks) == 50 and dense.deleted == {3, 20}
+        assert dense.chunks[41].content_or_path == 'chunk 41'
+
+        local = ShardedFaiss.load_local(dense_dir, mmap=True)
+        features = embedder.embed_query_batch_text(chunks=[Chunk('chunk 3'), Chunk('chunk 17'), Chunk('chunk 44')])
+        for k in [5, 30]:
+            dense.k = local.k = k
+            scores, ids = dense.similarity_search_batch(features)
+            expect_scores, expect_ids = local.similarity_search_batch(features)
+            assert (ids == expect_ids).all() and np.allclose(scores, expect_scores)
+
+        pairs = dense.similarity_search_with_query(embedder, Query(text='chunk 17'), threshold=0.9)
+        assert [c.content_or_path for c, _ in pairs] == ['chunk 17']
+
+        # slow partition is skipped, the other answers
+        servers[0].delay = 1.0
+        scores, ids = dense.similarity_search_batch(features)
+        assert ids[2][0] == 44 and not np.isin(ids, range(0, 8)).any()
+        assert dense.stats['partial'] == 1 and dense.missed[addresses[0]] == 1
+
+        servers[0].delay = 0.0
+        time.sleep(1.0)
+        scores, ids = dense.similarity_search_batch(features)
+        assert ids[1][0] == 17 and dense.stats['partial'] == 1
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    test_partitioned_search()
@@ -18,6 +18,7 @@ from huixiangdou.services import (CacheRetriever, ErrorCode, FeatureStore,
                                   Queue, Retriever, parse_json_str)
 from huixiangdou.services import (TaskCode, feature_store_base_dir,
                                  redis_host, redis_passwd, redis_port)
+from huixiangdou.services.store import InitializeConfig
 
 from .web_worker import OpenXLabWorker
 import asyncio
@@ -213,7 +214,8 @@ def build_feature_store(cache: CacheRetriever, payload: types.SimpleNamespace):
                          _type=TaskCode.FS_ADD_DOC.value)
 
     # try:
-    fs.initialize(files=files, work_dir=workdir, ner_file=None)
+    # `file_list` is all files of the knowledge base, only changed ones would be processed
+    fs.update(config=InitializeConfig(files=files, work_dir=workdir))
     files_state = []
 
     success_cnt = 0
@@ -147,7 +147,7 @@ class OpenXLabWorker:
             return False
 
         score = default
-        relation = await self.llm.chat(prompt=prompt)
+        relation = await self.llm.chat(prompt=prompt, task='score')
         tracker.log('score' + prompt[0:20], [relation, throttle, default])
         filtered_relation = ''.join([c for c in relation if c.isdigit()])
         try:
@@ -185,10 +185,11 @@ class OpenXLabWorker:
                 throttle=6,
                 default=2):
             # not a question, give LLM response
-            response = await self.llm.chat(prompt=query, history=history)
+            # answers are sampled, never replay a cached one
+            response = await self.llm.chat(prompt=query, history=history, use_cache=False, task='generate')
             return ErrorCode.NOT_A_QUESTION, response, []
 
-        topic = await self.llm.chat(self.TOPIC_TEMPLATE.format(query))
+        topic = await self.llm.chat(self.TOPIC_TEMPLATE.format(query), task='keywords')
         tracker.log('topic', topic)
 
         if len(topic) < 2:
@@ -221,7 +222,7 @@ class OpenXLabWorker:
             context=db_context,
             history_pair=history,
             template=self.GENERATE_TEMPLATE)
-        response = await self.llm.chat(prompt=prompt, history=history)
+        response = await self.llm.chat(prompt=prompt, history=history, use_cache=False, task='generate')
         tracker.log('feature store doc', [chunk, response])
         if response is not None and len(response) < 1:
             # llm error
@@ -278,7 +279,7 @@ class OpenXLabWorker:
                     context=web_context,
                     history_pair=history,
                     template=self.GENERATE_TEMPLATE)
-                response = self.llm.chat(prompt=prompt, history=history)
+                response = await self.llm.chat(prompt=prompt, history=history, use_cache=False, task='generate')
             else:
                 reborn_code = ErrorCode.NO_SEARCH_RESULT
 